@@ -1,124 +1,340 @@
-from flask import Flask, jsonify, request
+from flask import Blueprint, Flask, Response, current_app, jsonify, request
 from datetime import datetime
-import sqlite3
 import os
 
-app = Flask(__name__)
+import batch
+import bulk_import
+import cache
+import changefeed
+import compression
+import db_pool
+import etags
+import group_commit
+import metrics
+import migrations
+import probes
+import profiling
+import queries
+import ratelimit
+import replication
+import search
+import serialization
+import snapshot
+import storage
 
-# Database configuration
-DATABASE = '/app/data/books.db'
+bp = Blueprint('books', __name__)
+
+# Per-app extensions, resolved for the current request
+book_cache = cache.current_cache
 
 def get_db_connection():
-    """Create a database connection"""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def init_db():
-    """Initialize the database with schema"""
-    os.makedirs(os.path.dirname(DATABASE), exist_ok=True)
-    conn = get_db_connection()
-    with open('/app/init_db.sql', 'r') as f:
-        conn.executescript(f.read())
-    conn.commit()
-    conn.close()
+    """Borrow a pooled read-only connection for the current request"""
+    return db_pool.get_connection()
+
+def get_db_write_connection():
+    """Borrow the serialized writer connection for the current request"""
+    return db_pool.get_write_connection()
+
+def create_app(config=None):
+    """Create and configure the Books API application"""
+    app = Flask(__name__)
+    serialization.init_app(app)
+
+    # Database configuration
+    app.config.update(
+        DATABASE=os.environ.get('DATABASE_PATH', '/app/data/books.db'),
+        INIT_SQL=os.environ.get('INIT_SQL_PATH', '/app/init_db.sql'),
+        DB_POOL_SIZE=int(os.environ.get('DB_POOL_SIZE', '8')),
+        PRAGMAS=storage.load_pragmas(),
+    )
+    if config:
+        app.config.update(config)
+    database, pragmas = app.config['DATABASE'], app.config['PRAGMAS']
 
-# Initialize database on startup
-if not os.path.exists(DATABASE):
-    init_db()
+    # Create or upgrade the database schema on startup
+    migrations.migrate(database, pragmas, app.config['INIT_SQL'])
 
-@app.route('/')
+    db_pool.init_app(app, database, size=app.config['DB_POOL_SIZE'], pragmas=pragmas,
+                     factory=metrics.TimedConnection)
+    profiling.init_app(app, database)
+    cache.init_app(app, database)
+    metrics.init_app(app)
+    ratelimit.init_app(app)
+    group_commit.init_app(app)
+    probes.init_app(app, database, pragmas)
+    replication.init_app(app, database, pragmas)
+    compression.init_app(app)
+    migrations.init_app(app, database, pragmas, app.config['INIT_SQL'])
+    search.init_app(app, database, pragmas)
+    changefeed.init_app(app, database, pragmas)
+    snapshot.init_app(app, database, pragmas)
+    bulk_import.init_app(app, database, pragmas)
+    app.register_blueprint(bp)
+    return app
+
+@bp.route('/')
 def home():
     return jsonify({
         "message": "Welcome to the Books API",
         "version": "1.0",
         "endpoints": {
-            "GET /books": "List all books",
+            "GET /books": "List books (?author=&year_min=&year_max=&title_prefix=&sort=&after=&limit=&fields=)",
+            "GET /books/export": "Stream every matching book (same filters, ?format=json|ndjson)",
+            "GET /books/search": "Full-text search on title and author (?q=&limit=&offset=)",
+            "GET /books/changes": "Changes since a sequence number (?since=&limit=)",
+            "GET /books/changes/stream": "Live changes as server-sent events (?since= or Last-Event-ID)",
             "GET /books/<id>": "Get a specific book",
             "POST /books": "Add a new book",
+            "POST /books/batch": "Add books from a JSON array or NDJSON stream",
             "PUT /books/<id>": "Update a book",
+            "PUT /books/batch": "Update books from [{\"id\": ..., <fields>}]",
             "DELETE /books/<id>": "Delete a book",
-            "GET /health": "Health check"
+            "DELETE /books/batch": "Delete books from [<id>, ...]",
+            "GET /health": "Readiness report with pool and cache counters (503 if not ready)",
+            "GET /health/live": "Liveness probe",
+            "GET /health/ready": "Readiness probe (503 if not ready)",
+            "GET /metrics": "Prometheus metrics",
+            "POST /admin/snapshots": "Take a snapshot of books.db (admin token)",
+            "GET /admin/snapshots": "List snapshots (admin token)"
         }
     })
 
-@app.route('/health')
+@bp.route('/health')
 def health():
+    report = current_app.extensions['readiness'].report()
     return jsonify({
-        "status": "healthy",
-        "timestamp": datetime.now().isoformat()
-    })
+        "status": "healthy" if report["status"] == "ready" else "unhealthy",
+        "timestamp": datetime.now().isoformat(),
+        "checks": report["checks"],
+        "db_pool": db_pool.get_pool().stats(),
+        "cache": book_cache.stats()
+    }), probes.status_code(report)
+
+@bp.route('/health/live')
+def liveness():
+    return jsonify(probes.liveness())
+
+@bp.route('/health/ready')
+def readiness():
+    return probes.readiness_response()
+
+@bp.route('/metrics')
+def metrics_endpoint():
+    return metrics.metrics_response()
+
+@bp.route('/admin/snapshots', methods=['POST'])
+def create_snapshot():
+    refused = snapshot.admin_error(request.headers.get('Authorization'))
+    if refused:
+        return jsonify({"error": refused[0]}), refused[1]
+    try:
+        name = current_app.extensions['snapshots'].start()
+    except snapshot.SnapshotBusy as e:
+        return jsonify({"error": str(e)}), 409
+    return jsonify({"snapshot": name, "status": "running"}), 202, {'Location': '/admin/snapshots'}
 
-@app.route('/books', methods=['GET'])
+@bp.route('/admin/snapshots', methods=['GET'])
+def list_snapshots():
+    refused = snapshot.admin_error(request.headers.get('Authorization'))
+    if refused:
+        return jsonify({"error": refused[0]}), refused[1]
+    return jsonify(current_app.extensions['snapshots'].status())
+
+@bp.route('/books', methods=['GET'])
 def get_books():
     conn = get_db_connection()
-    books = conn.execute('SELECT * FROM books').fetchall()
-    conn.close()
+    version = etags.changes(conn)
+    etag = etags.collection_etag(version, 'books', request.args)
+    compression.cache_as('books', request.args, version)
+    if etags.is_fresh(etag):
+        return etags.not_modified(etag)
+
+    cached = book_cache.get_list('books', request.args, version)
+    if cached is not None:
+        return etags.with_etag(serialization.json_response(cached), etag)
+
+    try:
+        listing = queries.Listing.from_args(request.args)
+    except queries.QueryError as e:
+        return jsonify({"error": str(e)}), 400
+
+    books, next_after = listing.page(conn)
+    body = serialization.collection(listing.fields, books, count=len(books), next_after=next_after)
+    book_cache.set_list('books', request.args, body, version)
+    return etags.with_etag(serialization.json_response(body), etag)
+
+@bp.route('/books/export', methods=['GET'])
+def export_books():
+    fmt = request.args.get('format', 'json')
+    try:
+        listing = queries.Listing.from_args(request.args)
+        if fmt not in queries.EXPORT_FORMATS:
+            raise queries.QueryError(f"Unsupported format: {fmt}")
+    except queries.QueryError as e:
+        return jsonify({"error": str(e)}), 400
+
+    encode, mimetype = queries.EXPORT_FORMATS[fmt]
+
+    pool = db_pool.get_pool()
+
+    def generate():
+        # The response outlives the app context, so borrow a connection for it
+        with db_pool.pooled_connection(pool) as conn:
+            yield from encode(listing.iter_pages(conn), listing.fields)
+
+    return Response(generate(), mimetype=mimetype)
+
+@bp.route('/books/search', methods=['GET'])
+def search_books():
+    conn = get_db_connection()
+    version = etags.changes(conn)
+    etag = etags.collection_etag(version, 'search', request.args)
+    compression.cache_as('search', request.args, version)
+    if etags.is_fresh(etag):
+        return etags.not_modified(etag)
+
+    cached = book_cache.get_list('search', request.args, version)
+    if cached is not None:
+        return etags.with_etag(serialization.json_response(cached), etag)
+
+    q = request.args.get('q', '').strip()
+    try:
+        if not q:
+            raise queries.QueryError("q is required")
+        limit, offset = search.parse_paging(request.args)
+    except queries.QueryError as e:
+        return jsonify({"error": str(e)}), 400
+
+    books, next_offset = search.search(conn, q, limit, offset)
     books_list = [dict(book) for book in books]
-    return jsonify({"books": books_list, "count": len(books_list)})
+    body = serialization.dumps({"books": books_list, "count": len(books_list), "next_offset": next_offset})
+    book_cache.set_list('search', request.args, body, version)
+    return etags.with_etag(serialization.json_response(body), etag)
+
+@bp.route('/books/changes', methods=['GET'])
+def get_changes():
+    try:
+        since = changefeed.parse_since(request.args.get('since'))
+        limit = changefeed.parse_limit(request.args.get('limit'))
+    except queries.QueryError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        body = changefeed.page(get_db_connection(), since, limit)
+    except changefeed.ChangesGone as e:
+        return jsonify({"error": str(e), "floor": e.floor}), 410
+    return serialization.json_response(body)
+
+@bp.route('/books/changes/stream', methods=['GET'])
+def stream_changes():
+    try:
+        since = changefeed.stream_since(request.args, request.headers)
+    except queries.QueryError as e:
+        return jsonify({"error": str(e)}), 400
+    streams = current_app.extensions['changefeed_streams']
+    if not streams.acquire():
+        response = jsonify({"error": "Too many change streams, retry later"})
+        response.headers['Retry-After'] = str(int(changefeed.CHANGES_POLL_INTERVAL) + 1)
+        return response, 503
+
+    pool = db_pool.get_pool()
 
-@app.route('/books/<int:book_id>', methods=['GET'])
+    def fetch(since):
+        # Borrow a connection per poll rather than for the whole stream
+        with db_pool.pooled_connection(pool) as conn:
+            return changefeed.read(conn, since)
+
+    response = Response(changefeed.iter_events(fetch, since), mimetype='text/event-stream',
+                        headers=changefeed.STREAM_HEADERS)
+    response.call_on_close(streams.release)
+    return response
+
+@bp.route('/books/<int:book_id>', methods=['GET'])
 def get_book(book_id):
-    conn = get_db_connection()
-    book = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
-    conn.close()
-    if book:
-        return jsonify(dict(book))
-    return jsonify({"error": "Book not found"}), 404
+    entry = book_cache.get_book(book_id)
+    if entry is None:
+        token = book_cache.read_token()
+        conn = get_db_connection()
+        book = conn.execute(f'SELECT {etags.BOOK_COLUMNS} FROM books WHERE id = ?', (book_id,)).fetchone()
+        if not book:
+            return jsonify({"error": "Book not found"}), 404
+        entry = etags.book_entry(book)
+        book_cache.set_book(book_id, entry, token)
 
-@app.route('/books', methods=['POST'])
+    if etags.is_fresh(entry["etag"]):
+        return etags.not_modified(entry["etag"])
+    return etags.with_etag(jsonify(entry["book"]), entry["etag"])
+
+@bp.route('/books', methods=['POST'])
 def add_book():
     if not request.json or not all(k in request.json for k in ['title', 'author', 'year']):
         return jsonify({"error": "Missing required fields"}), 400
     
-    conn = get_db_connection()
-    cursor = conn.execute(
-        'INSERT INTO books (title, author, year) VALUES (?, ?, ?)',
-        (request.json['title'], request.json['author'], request.json['year'])
-    )
-    conn.commit()
-    new_id = cursor.lastrowid
-    new_book = conn.execute('SELECT * FROM books WHERE id = ?', (new_id,)).fetchone()
-    conn.close()
-    return jsonify(dict(new_book)), 201
+    entry = group_commit.run(group_commit.insert_book,
+                             request.json['title'], request.json['author'], request.json['year'])
+    return etags.with_etag(jsonify(entry["book"]), entry["etag"]), 201
 
-@app.route('/books/<int:book_id>', methods=['PUT'])
+@bp.route('/books/<int:book_id>', methods=['PUT'])
 def update_book(book_id):
-    conn = get_db_connection()
-    book = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
-    if not book:
-        conn.close()
-        return jsonify({"error": "Book not found"}), 404
-    
+    updates = []
+    values = []
     if request.json:
-        updates = []
-        values = []
         for key in ['title', 'author', 'year']:
             if key in request.json:
                 updates.append(f'{key} = ?')
                 values.append(request.json[key])
-        
-        if updates:
-            values.append(book_id)
-            conn.execute(f'UPDATE books SET {", ".join(updates)} WHERE id = ?', values)
-            conn.commit()
-    
-    updated_book = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
-    conn.close()
-    return jsonify(dict(updated_book))
+    condition, condition_values = etags.if_match_clause(request.if_match, book_id)
 
-@app.route('/books/<int:book_id>', methods=['DELETE'])
+    status, entry = group_commit.run(group_commit.update_book, book_id, updates, values,
+                                     condition, condition_values)
+    if status != 200:
+        return jsonify({"error": etags.WRITE_ERRORS[status]}), status
+
+    book_cache.invalidate(book_id)
+    return etags.with_etag(jsonify(entry["book"]), entry["etag"])
+
+@bp.route('/books/<int:book_id>', methods=['DELETE'])
 def delete_book(book_id):
-    conn = get_db_connection()
-    book = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
-    if not book:
-        conn.close()
-        return jsonify({"error": "Book not found"}), 404
-    
-    conn.execute('DELETE FROM books WHERE id = ?', (book_id,))
-    conn.commit()
-    conn.close()
+    condition, condition_values = etags.if_match_clause(request.if_match, book_id)
+    status, title = group_commit.run(group_commit.delete_book, book_id, condition, condition_values)
+    if status != 200:
+        return jsonify({"error": etags.WRITE_ERRORS[status]}), status
+
+    book_cache.invalidate(book_id)
     return jsonify({"message": "Book deleted successfully"})
 
+@bp.route('/books/batch', methods=['POST'])
+def add_books_batch():
+    try:
+        items = batch.read_items(request)
+    except batch.BatchError as e:
+        return jsonify({"error": str(e)}), 400
+    results = batch.insert_books(get_db_write_connection(), items)
+    succeeded = sum(1 for result in results if "error" not in result)
+    return jsonify({"results": results, "added": succeeded}), batch.status_code(results, 201)
+
+@bp.route('/books/batch', methods=['PUT'])
+def update_books_batch():
+    try:
+        items = batch.read_items(request)
+    except batch.BatchError as e:
+        return jsonify({"error": str(e)}), 400
+    results = batch.update_books(get_db_write_connection(), items)
+    book_cache.invalidate(*(result["id"] for result in results if "error" not in result))
+    succeeded = sum(1 for result in results if "error" not in result)
+    return jsonify({"results": results, "updated": succeeded}), batch.status_code(results, 200)
+
+@bp.route('/books/batch', methods=['DELETE'])
+def delete_books_batch():
+    try:
+        items = batch.read_items(request)
+    except batch.BatchError as e:
+        return jsonify({"error": str(e)}), 400
+    results = batch.delete_books(get_db_write_connection(), items)
+    book_cache.invalidate(*(result["id"] for result in results if "error" not in result))
+    succeeded = sum(1 for result in results if "error" not in result)
+    return jsonify({"results": results, "deleted": succeeded}), batch.status_code(results, 200)
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    # Development server only; production runs under gunicorn (see gunicorn.conf.py)
+    create_app().run(host='0.0.0.0', port=int(os.environ.get('PORT', '5000')),
+                     debug=os.environ.get('FLASK_DEBUG') == '1')
\ No newline at end of file
@@ -0,0 +1,643 @@
+"""
+Asyncio variant of the Books API, for an ASGI server.
+
+    gunicorn --config gunicorn.conf.py -k uvicorn_worker.UvicornWorker "app_async:create_app()"
+    uvicorn --factory app_async:create_app --port 5000
+
+Same routes, JSON bodies, status codes, ETags and compression as app.py.
+An in-flight request holds no thread: requests are parsed and answered
+on the event loop, and SQLite work runs on the bounded executor of
+async_db.AsyncDatabase.
+
+ASYNC_REQUEST_TIMEOUT  seconds a request has to produce its response;
+                       504 afterwards (default: 10). Streamed exports are
+                       only bound until their first byte.
+ASYNC_MAX_IN_FLIGHT    requests handled at once per process; past it new
+                       ones get a 503 with Retry-After (default: 1000).
+                       /health and /metrics are exempt.
+ASYNC_RETRY_AFTER      Retry-After of that 503, in seconds (default: 1)
+
+Cache lookups (books and list pages), list stores and invalidations run
+on the event loop, which suits the default in-process backend. A book
+missed by the cache is read and stored on the executor, and compressed
+list bodies are looked up and stored there along with the compression.
+With CACHE_BACKEND=redis the calls on the event loop block it for a round
+trip each.
+"""
+
+import asyncio
+import io
+import os
+import re
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from starlette.applications import Starlette
+from starlette.responses import RedirectResponse, Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_accept_header, parse_etags
+
+import async_db
+import batch
+import cache
+import changefeed
+import compression
+import db_pool
+import etags
+import group_commit
+import metrics
+import migrations
+import probes
+import queries
+import replication
+import search
+import serialization
+import snapshot
+import storage
+
+ASYNC_REQUEST_TIMEOUT = float(os.environ.get('ASYNC_REQUEST_TIMEOUT', '10'))
+ASYNC_MAX_IN_FLIGHT = int(os.environ.get('ASYNC_MAX_IN_FLIGHT', '1000'))
+ASYNC_RETRY_AFTER = int(os.environ.get('ASYNC_RETRY_AFTER', '1'))
+
+JSON_MIMETYPE = 'application/json'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+class BodyError(Exception):
+    """Unusable request body; status is 400 or 415, as with flask.Request.json"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+# Request helpers
+
+def query_args(request):
+    """Query string as a werkzeug MultiDict, the type the shared helpers expect"""
+    return MultiDict(request.query_params.multi_items())
+
+
+def mimetype(request):
+    return request.headers.get('content-type', '').partition(';')[0].strip().lower()
+
+
+def _is_json(mimetype):
+    return mimetype == JSON_MIMETYPE or (mimetype.startswith('application/') and mimetype.endswith('+json'))
+
+
+async def get_json(request):
+    """The decoded body, like flask.Request.json"""
+    if not _is_json(mimetype(request)):
+        raise BodyError("Request body must be JSON", 415)
+    try:
+        return serialization.loads(await request.body())
+    except ValueError:
+        raise BodyError("Malformed JSON body")
+
+
+def negotiate(request):
+    """Encoding to use for the response, like compression.negotiate"""
+    return parse_accept_header(request.headers.get('accept-encoding')).best_match(compression.ENCODINGS)
+
+
+def is_fresh(request, etag):
+    return etags.matches(parse_etags(request.headers.get('if-none-match')), etag)
+
+
+# Responses
+
+def json_response(obj, status=200, headers=None):
+    """Like flask.jsonify: sorted keys and a trailing newline"""
+    return Response(serialization.dumps(obj, sort_keys=True) + '\n', status, headers, media_type=JSON_MIMETYPE)
+
+
+def error(message, status):
+    return json_response({"error": message}, status)
+
+
+def json_body(body, etag=None, status=200):
+    """Response for an already encoded JSON body"""
+    headers = {'ETag': f'"{etag}"'} if etag else None
+    return Response(body, status, headers, media_type=JSON_MIMETYPE)
+
+
+def book_response(entry, status=200):
+    return json_body(serialization.dumps(entry["book"], sort_keys=True) + '\n', entry["etag"], status)
+
+
+def not_modified(etag):
+    return Response(status_code=304, headers={'ETag': f'"{etag}"'})
+
+
+def _compressible(response):
+    mimetype = (response.media_type or '').partition(';')[0]
+    return (
+        response.status_code == 304
+        or response.status_code == 200
+        and 'content-encoding' not in response.headers
+        and compression.compressible_type(mimetype)
+    )
+
+
+async def compress_response(request, response):
+    """compression.compress_response for Starlette responses"""
+    if request.method == 'HEAD' or not _compressible(response):
+        return response
+    response.headers.append('Vary', 'Accept-Encoding')
+    encoding = negotiate(request)
+    if encoding is None:
+        return response
+
+    etag = response.headers.get('etag', '').strip('"')
+    if response.status_code == 304:
+        # Echo the variant the client holds
+        if etag and is_fresh(request, f'{etag}-{encoding}'):
+            response.headers['ETag'] = f'"{etag}-{encoding}"'
+        return response
+
+    if isinstance(response, StreamingResponse):
+        response.body_iterator = compressed_stream(response.body_iterator, encoding)
+    else:
+        if len(response.body) < compression.COMPRESS_MIN_SIZE:
+            return response
+        state = request.app.state
+        key = getattr(request.state, 'compression_cache_key', None)
+        response.body = await state.db.run(compression.compressed_body, response.body, encoding, state.cache, key)
+        response.headers['Content-Length'] = str(len(response.body))
+
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        response.headers['ETag'] = f'"{etag}-{encoding}"'
+    return response
+
+
+async def compressed_stream(chunks, encoding):
+    """Compress an async iterable of str/bytes chunks incrementally"""
+    process, finish = compression.compressor(encoding)
+    try:
+        async for chunk in chunks:
+            data = process(chunk.encode() if isinstance(chunk, str) else chunk)
+            if data:
+                yield data
+        yield finish()
+    finally:
+        await chunks.aclose()
+
+
+# Database jobs, run on the executor with a connection
+
+def _books_page(conn, listing):
+    books, next_after = listing.page(conn)
+    return serialization.collection(listing.fields, books, count=len(books), next_after=next_after)
+
+
+def _search_page(conn, q, limit, offset):
+    books, next_offset = search.search(conn, q, limit, offset)
+    books_list = [dict(book) for book in books]
+    return serialization.dumps({"books": books_list, "count": len(books_list), "next_offset": next_offset})
+
+
+def _export(conn, listing, encode):
+    return encode(listing.iter_pages(conn), listing.fields)
+
+
+def _load_book(conn, book_cache, book_id):
+    """Cache entry of a book read from SQLite, stored in the cache unless
+    written meanwhile"""
+    token = book_cache.read_token()
+    book = conn.execute(f'SELECT {etags.BOOK_COLUMNS} FROM books WHERE id = ?', (book_id,)).fetchone()
+    if not book:
+        return None
+    entry = etags.book_entry(book)
+    book_cache.set_book(book_id, entry, token)
+    return entry
+
+
+def _batch_items(body_mimetype, body):
+    """Every item of a batch body, or the reason the body is invalid"""
+    try:
+        if body_mimetype == NDJSON_MIMETYPE:
+            return list(batch.iter_ndjson(io.BytesIO(body))), None
+        try:
+            decoded = serialization.loads(body) if _is_json(body_mimetype) else None
+        except ValueError:
+            decoded = None
+        return list(batch.json_items(decoded)), None
+    except batch.BatchError as e:
+        return None, str(e)
+
+
+# Routes
+
+async def home(request):
+    return json_response({
+        "message": "Welcome to the Books API",
+        "version": "1.0",
+        "endpoints": {
+            "GET /books": "List books (?author=&year_min=&year_max=&title_prefix=&sort=&after=&limit=&fields=)",
+            "GET /books/export": "Stream every matching book (same filters, ?format=json|ndjson)",
+            "GET /books/search": "Full-text search on title and author (?q=&limit=&offset=)",
+            "GET /books/changes": "Changes since a sequence number (?since=&limit=)",
+            "GET /books/changes/stream": "Live changes as server-sent events (?since= or Last-Event-ID)",
+            "GET /books/<id>": "Get a specific book",
+            "POST /books": "Add a new book",
+            "POST /books/batch": "Add books from a JSON array or NDJSON stream",
+            "PUT /books/<id>": "Update a book",
+            "PUT /books/batch": "Update books from [{\"id\": ..., <fields>}]",
+            "DELETE /books/<id>": "Delete a book",
+            "DELETE /books/batch": "Delete books from [<id>, ...]",
+            "GET /health": "Readiness report with pool and cache counters (503 if not ready)",
+            "GET /health/live": "Liveness probe",
+            "GET /health/ready": "Readiness probe (503 if not ready)",
+            "GET /metrics": "Prometheus metrics",
+            "POST /admin/snapshots": "Take a snapshot of books.db (admin token)",
+            "GET /admin/snapshots": "List snapshots (admin token)"
+        }
+    })
+
+
+async def health(request):
+    state = request.app.state
+    # Probes block on SQLite and the disk: run them beside the event loop
+    report = await state.db.run(state.readiness.report)
+    return json_response({
+        "status": "healthy" if report["status"] == "ready" else "unhealthy",
+        "timestamp": datetime.now().isoformat(),
+        "checks": report["checks"],
+        "db_pool": state.db.pool.stats(),
+        "db_executor": state.db.stats(),
+        "cache": state.cache.stats(),
+        "requests": {
+            "in_flight": state.in_flight,
+            "rejected": state.rejected,
+            "timed_out": state.timed_out,
+        }
+    }, probes.status_code(report))
+
+
+async def liveness(request):
+    return json_response(probes.liveness())
+
+
+async def readiness(request):
+    report = await request.app.state.db.run(request.app.state.readiness.report)
+    return json_response(report, probes.status_code(report))
+
+
+async def metrics_endpoint(request):
+    return Response(metrics.REGISTRY.render(), media_type='text/plain; version=0.0.4')
+
+
+async def create_snapshot(request):
+    refused = snapshot.admin_error(request.headers.get('Authorization'))
+    if refused:
+        return error(*refused)
+    try:
+        name = request.app.state.snapshots.start()
+    except snapshot.SnapshotBusy as e:
+        return error(str(e), 409)
+    return json_response({"snapshot": name, "status": "running"}, 202, {'Location': '/admin/snapshots'})
+
+
+async def list_snapshots(request):
+    refused = snapshot.admin_error(request.headers.get('Authorization'))
+    if refused:
+        return error(*refused)
+    return json_response(request.app.state.snapshots.status())
+
+
+async def get_books(request):
+    state = request.app.state
+    args = query_args(request)
+    version = await state.db.read(etags.changes)
+    etag = etags.collection_etag(version, 'books', args)
+    # Keep the compressed body in the list cache (compression.cache_as)
+    request.state.compression_cache_key = ('books', args, version)
+    if is_fresh(request, etag):
+        return not_modified(etag)
+
+    body = state.cache.get_list('books', args, version)
+    if body is None:
+        try:
+            listing = queries.Listing.from_args(args)
+        except queries.QueryError as e:
+            return error(str(e), 400)
+        body = await state.db.read(_books_page, listing)
+        state.cache.set_list('books', args, body, version)
+    return json_body(body, etag)
+
+
+async def export_books(request):
+    args = query_args(request)
+    fmt = args.get('format', 'json')
+    try:
+        listing = queries.Listing.from_args(args)
+        if fmt not in queries.EXPORT_FORMATS:
+            raise queries.QueryError(f"Unsupported format: {fmt}")
+    except queries.QueryError as e:
+        return error(str(e), 400)
+
+    encode, export_mimetype = queries.EXPORT_FORMATS[fmt]
+    chunks = request.app.state.db.stream(_export, listing, encode)
+    return StreamingResponse(chunks, media_type=export_mimetype)
+
+
+async def search_books(request):
+    state = request.app.state
+    args = query_args(request)
+    version = await state.db.read(etags.changes)
+    etag = etags.collection_etag(version, 'search', args)
+    # Keep the compressed body in the list cache (compression.cache_as)
+    request.state.compression_cache_key = ('search', args, version)
+    if is_fresh(request, etag):
+        return not_modified(etag)
+
+    body = state.cache.get_list('search', args, version)
+    if body is None:
+        q = args.get('q', '').strip()
+        try:
+            if not q:
+                raise queries.QueryError("q is required")
+            limit, offset = search.parse_paging(args)
+        except queries.QueryError as e:
+            return error(str(e), 400)
+        body = await state.db.read(_search_page, q, limit, offset)
+        state.cache.set_list('search', args, body, version)
+    return json_body(body, etag)
+
+
+async def get_changes(request):
+    args = query_args(request)
+    try:
+        since = changefeed.parse_since(args.get('since'))
+        limit = changefeed.parse_limit(args.get('limit'))
+    except queries.QueryError as e:
+        return error(str(e), 400)
+    try:
+        body = await request.app.state.db.read(changefeed.page, since, limit)
+    except changefeed.ChangesGone as e:
+        return json_response({"error": str(e), "floor": e.floor}, 410)
+    return json_body(body)
+
+
+async def stream_changes(request):
+    try:
+        since = changefeed.stream_since(query_args(request), request.headers)
+    except queries.QueryError as e:
+        return error(str(e), 400)
+    return StreamingResponse(change_events(request.app.state.db, since), headers=changefeed.STREAM_HEADERS,
+                             media_type='text/event-stream')
+
+
+async def change_events(db, since):
+    """changefeed.iter_events, waiting on the event loop instead of a thread"""
+    yield changefeed.stream_start(since)
+    started = last_sent = time.monotonic()
+    while time.monotonic() - started < changefeed.CHANGES_STREAM_MAX:
+        try:
+            entries, more = await db.read(changefeed.read, since)
+        except changefeed.ChangesGone as gone:
+            yield changefeed.format_reset(gone)
+            return
+        if entries:
+            yield ''.join(changefeed.format_event(entry) for entry in entries)
+            since = entries[-1]["seq"]
+            last_sent = time.monotonic()
+            if more:
+                continue
+        elif time.monotonic() - last_sent >= changefeed.CHANGES_HEARTBEAT:
+            yield changefeed.HEARTBEAT
+            last_sent = time.monotonic()
+        await asyncio.sleep(changefeed.CHANGES_POLL_INTERVAL)
+
+
+async def get_book(request):
+    state = request.app.state
+    book_id = request.path_params['book_id']
+    entry = state.cache.get_book(book_id)
+    if entry is None:
+        entry = await state.db.read(_load_book, state.cache, book_id)
+    if entry is None:
+        return error("Book not found", 404)
+
+    if is_fresh(request, entry["etag"]):
+        return not_modified(entry["etag"])
+    return book_response(entry)
+
+
+async def add_book(request):
+    state = request.app.state
+    data = await get_json(request)
+    if not data or not all(k in data for k in ['title', 'author', 'year']):
+        return error("Missing required fields", 400)
+
+    entry = await state.db.group_write(group_commit.insert_book, data['title'], data['author'], data['year'])
+    return book_response(entry, 201)
+
+
+async def update_book(request):
+    state = request.app.state
+    book_id = request.path_params['book_id']
+    data = await get_json(request)
+    updates = []
+    values = []
+    if data:
+        for key in ['title', 'author', 'year']:
+            if key in data:
+                updates.append(f'{key} = ?')
+                values.append(data[key])
+    condition, condition_values = etags.if_match_clause(parse_etags(request.headers.get('if-match')), book_id)
+
+    status, entry = await state.db.group_write(group_commit.update_book, book_id, updates, values, condition, condition_values)
+    if entry is None:
+        return error(etags.WRITE_ERRORS[status], status)
+    state.cache.invalidate(book_id)
+    return book_response(entry)
+
+
+async def delete_book(request):
+    state = request.app.state
+    book_id = request.path_params['book_id']
+    condition, condition_values = etags.if_match_clause(parse_etags(request.headers.get('if-match')), book_id)
+    status, _ = await state.db.group_write(group_commit.delete_book, book_id, condition, condition_values)
+    if status != 200:
+        return error(etags.WRITE_ERRORS[status], status)
+    state.cache.invalidate(book_id)
+    return json_response({"message": "Book deleted successfully"})
+
+
+def batch_endpoint(operation, counter, success):
+    async def endpoint(request):
+        state = request.app.state
+        body = await request.body()
+        # Parsed before the writer is taken, so only the SQL holds it
+        items, problem = await state.db.run(_batch_items, mimetype(request), body)
+        if problem is not None:
+            return error(problem, 400)
+        results = await state.db.write(operation, items)
+        if operation is not batch.insert_books:
+            state.cache.invalidate(*(result["id"] for result in results if "error" not in result))
+        succeeded = sum(1 for result in results if "error" not in result)
+        return json_response({"results": results, counter: succeeded}, batch.status_code(results, success))
+    return endpoint
+
+
+# Timeouts, backpressure and request metrics
+
+def _replicated(handler, rule):
+    """Wrap a route handler to serve it as a replica does (see
+    replication.py); on a primary, tag successful writes with their seq"""
+
+    async def endpoint(request):
+        state = request.app.state
+        replica = state.replica
+        if replica is None:
+            response = await handler(request)
+            if request.method not in replication.READ_METHODS and response.status_code < 300:
+                response.headers[replication.SEQ_HEADER] = str(await state.db.read(replication.applied_seq))
+            return response
+        if rule in replication.LOCAL_ROUTES:
+            return await handler(request)
+        if request.method not in replication.READ_METHODS:
+            return RedirectResponse(replica.primary_url(request.url.path, request.url.query), 307)
+        position = await state.db.read(replication.position)
+        try:
+            behind = replica.falls_behind(*position, request.headers.get(replication.MIN_SEQ_HEADER))
+        except queries.QueryError as e:
+            return error(str(e), 400)
+        if behind:
+            response = RedirectResponse(replica.primary_url(request.url.path, request.url.query), 307)
+        else:
+            response = await handler(request)
+        response.headers.update(replication.position_headers(*position))
+        return response
+
+    return endpoint
+
+
+def _timed(handler, rule, limited=True):
+    """Wrap a route handler; rule is the route as app.py spells it, the
+    label of its request metrics"""
+
+    async def endpoint(request):
+        state = request.app.state
+        start = time.perf_counter()
+        if limited and state.in_flight >= ASYNC_MAX_IN_FLIGHT:
+            state.rejected += 1
+            response = json_response({"error": "Server busy, retry later"}, 503,
+                                     {'Retry-After': str(ASYNC_RETRY_AFTER)})
+        else:
+            state.in_flight += 1
+            metrics.REGISTRY.add(metrics.HTTP_IN_FLIGHT, (), 1)
+            try:
+                response = await asyncio.wait_for(handler(request), ASYNC_REQUEST_TIMEOUT)
+                response = await compress_response(request, response)
+            except asyncio.TimeoutError:
+                state.timed_out += 1
+                response = error("Request timed out", 504)
+            except BodyError as e:
+                response = error(str(e), e.status)
+            finally:
+                state.in_flight -= 1
+                metrics.REGISTRY.add(metrics.HTTP_IN_FLIGHT, (), -1)
+        labels = (('method', request.method), ('route', rule), ('status', str(response.status_code)))
+        metrics.REGISTRY.observe(metrics.HTTP_LATENCY, labels, time.perf_counter() - start)
+        return response
+
+    return endpoint
+
+
+ROUTES = (
+    ('/', ['GET'], home),
+    ('/health', ['GET'], health),
+    ('/health/live', ['GET'], liveness),
+    ('/health/ready', ['GET'], readiness),
+    ('/metrics', ['GET'], metrics_endpoint),
+    ('/admin/snapshots', ['POST'], create_snapshot),
+    ('/admin/snapshots', ['GET'], list_snapshots),
+    ('/books', ['GET'], get_books),
+    ('/books/export', ['GET'], export_books),
+    ('/books/search', ['GET'], search_books),
+    ('/books/changes', ['GET'], get_changes),
+    ('/books/changes/stream', ['GET'], stream_changes),
+    ('/books/<int:book_id>', ['GET'], get_book),
+    ('/books', ['POST'], add_book),
+    ('/books/<int:book_id>', ['PUT'], update_book),
+    ('/books/<int:book_id>', ['DELETE'], delete_book),
+    ('/books/batch', ['POST'], batch_endpoint(batch.insert_books, 'added', 201)),
+    ('/books/batch', ['PUT'], batch_endpoint(batch.update_books, 'updated', 200)),
+    ('/books/batch', ['DELETE'], batch_endpoint(batch.delete_books, 'deleted', 200)),
+)
+
+UNLIMITED_ROUTES = {'/health', '/health/live', '/health/ready', '/metrics'}
+
+
+def starlette_path(rule):
+    """/books/<int:book_id> -> /books/{book_id:int}"""
+    return re.sub(r'<int:(\w+)>', r'{\1:int}', rule)
+
+
+def create_app(config=None):
+    """Create and configure the asyncio Books API application"""
+    config = dict(
+        DATABASE=os.environ.get('DATABASE_PATH', '/app/data/books.db'),
+        INIT_SQL=os.environ.get('INIT_SQL_PATH', '/app/init_db.sql'),
+        DB_POOL_SIZE=int(os.environ.get('DB_POOL_SIZE', '8')),
+        PRAGMAS=storage.load_pragmas(),
+        **(config or {}),
+    )
+    database, pragmas = config['DATABASE'], config['PRAGMAS']
+
+    # Create or upgrade the database schema on startup
+    migrations.migrate(database, pragmas, config['INIT_SQL'])
+
+    pool = db_pool.ConnectionPool(database, config['DB_POOL_SIZE'], pragmas, factory=metrics.TimedConnection)
+    coalescer = group_commit.WriteCoalescer(pool.writer)
+    db = async_db.AsyncDatabase(pool, coalescer)
+    book_cache = cache.create_cache(database)
+    replica = None
+    if replication.REPLICA_OF:
+        replica = replication.Replica(database, pragmas, replication.REPLICA_OF, book_cache,
+                                      replication.REPLICA_PRIMARY_PUBLIC_URL)
+
+    @asynccontextmanager
+    async def lifespan(app):
+        if replica is not None:
+            replica.start()
+        yield
+        if replica is not None:
+            replica.close()
+        db.close()
+        metrics.REGISTRY.flush()
+
+    routes = [Route(starlette_path(rule), _timed(_replicated(handler, rule), rule, rule not in UNLIMITED_ROUTES), methods=methods)
+              for rule, methods, handler in ROUTES]
+    app = Starlette(routes=routes, lifespan=lifespan)
+    app.state.config = config
+    app.state.db = db
+    app.state.cache = book_cache
+    app.state.snapshots = snapshot.SnapshotJobs(database, pragmas)
+    app.state.readiness = probes.Readiness(probes.default_checks(database, pragmas, pool, coalescer))
+    app.state.replica = replica
+    if replica is not None:
+        app.state.readiness.add('replication', replica.check)
+        metrics.REGISTRY.collectors['books_replication'] = replica.stats
+    app.state.in_flight = 0
+    app.state.rejected = 0
+    app.state.timed_out = 0
+
+    metrics.REGISTRY.collectors['books_db_pool'] = lambda: {k: v for k, v in pool.stats().items() if k != 'writer'}
+    metrics.REGISTRY.collectors['books_db_writer'] = pool.writer.stats
+    metrics.REGISTRY.collectors['books_db_executor'] = db.stats
+    metrics.REGISTRY.collectors['books_group_commit'] = coalescer.stats
+    metrics.REGISTRY.collectors['books_cache'] = book_cache.stats
+    return app
+
+
+if __name__ == '__main__':
+    # Development server only; production runs under gunicorn with the uvicorn worker
+    import uvicorn
+    uvicorn.run(create_app(), host='0.0.0.0', port=int(os.environ.get('PORT', '5000')))
@@ -0,0 +1,141 @@
+"""
+Asynchronous access to books.db for the asyncio variant of the API
+(app_async.py).
+
+sqlite3 calls block, so they run on a bounded thread pool beside the event
+loop. A job is a plain function taking a connection: reads borrow one
+from the same ConnectionPool the Flask apps use, writes get the
+process-wide writer connection. Writers queue on an asyncio.Lock before
+they are handed to the pool, so waiting writers hold no thread.
+Single-book writes go through group_write() instead and share the
+commits of the group-commit thread.
+
+At most DB_THREADS + DB_QUEUE_SIZE jobs are submitted at once; further
+callers wait on the event loop, where a request timeout can still cancel
+them. A job that has started always runs to completion (a thread cannot
+be interrupted); its slot is freed only when it is done, even if the
+caller has given up waiting.
+
+DB_THREADS       threads running sqlite3 calls (default: DB_POOL_SIZE or 8)
+DB_QUEUE_SIZE    jobs that may wait for a free thread (default: 64)
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import db_pool
+import group_commit
+
+DB_THREADS = int(os.environ.get('DB_THREADS', os.environ.get('DB_POOL_SIZE', '8')))
+DB_QUEUE_SIZE = int(os.environ.get('DB_QUEUE_SIZE', '64'))
+
+# next() default marking the end of a streamed iterator (StopIteration
+# cannot cross the executor)
+_END = object()
+
+
+class AsyncDatabase:
+    """Run blocking database jobs on a bounded executor"""
+
+    def __init__(self, pool, coalescer=None, threads=DB_THREADS, queue_size=DB_QUEUE_SIZE):
+        self.pool = pool
+        self.coalescer = coalescer
+        self.threads = threads
+        self.capacity = threads + queue_size
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='books-db')
+        self._slots = asyncio.Semaphore(self.capacity)
+        self._write_lock = asyncio.Lock()
+        self.submitted = 0
+        self.in_use = 0
+
+    def _release_slot(self, future):
+        self.in_use -= 1
+        self._slots.release()
+
+    async def _submit(self, fn, *args):
+        await self._slots.acquire()
+        self.in_use += 1
+        self.submitted += 1
+        future = asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        future.add_done_callback(self._release_slot)
+        return future
+
+    async def run(self, fn, *args):
+        """Result of fn(*args), called on the executor"""
+        # Cancelling the caller must not release the slot of a running job
+        return await asyncio.shield(await self._submit(fn, *args))
+
+    async def read(self, fn, *args):
+        """Result of fn(conn, *args) on a pooled read-only connection"""
+        return await self.run(self._read, fn, args)
+
+    async def write(self, fn, *args):
+        """Result of fn(conn, *args) on the writer connection"""
+        async with self._write_lock:
+            return await self.run(self._write, fn, args)
+
+    async def group_write(self, fn, *args):
+        """Result of the job fn(conn, *args), committed together with the
+        writes queued meanwhile (see group_commit.py)"""
+        if self.coalescer is None or not self.coalescer.enabled:
+            return await self.write(group_commit.run_alone, fn, *args)
+        # Waiting takes no executor thread; a job still queued when the
+        # request is cancelled or times out is dropped
+        return await asyncio.wait_for(asyncio.wrap_future(self.coalescer.submit(fn, *args)), self.coalescer.timeout)
+
+    async def stream(self, fn, *args):
+        """Items of the iterator fn(conn, *args) on a pooled read-only
+        connection, each one produced on the executor"""
+        conn = await self.run(self.pool.acquire)
+        job = None
+        broken = False
+        try:
+            iterator = fn(conn, *args)
+            while True:
+                job = await self._submit(next, iterator, _END)
+                item = await asyncio.shield(job)
+                if item is _END:
+                    return
+                yield item
+        except BaseException as exc:
+            broken = not isinstance(exc, GeneratorExit)
+            raise
+        finally:
+            if job is not None and not job.done():
+                # The connection is still in use; hand it back when the job ends
+                job.add_done_callback(lambda _: self.pool.release(conn, broken=True))
+            else:
+                self.pool.release(conn, broken=broken)
+
+    def _read(self, fn, args):
+        with db_pool.pooled_connection(self.pool) as conn:
+            return fn(conn, *args)
+
+    def _write(self, fn, args):
+        conn = self.pool.writer.acquire()
+        broken = False
+        try:
+            return fn(conn, *args)
+        except BaseException:
+            broken = True
+            raise
+        finally:
+            self.pool.writer.release(broken=broken)
+
+    def stats(self):
+        return {
+            "threads": self.threads,
+            "capacity": self.capacity,
+            "in_use": self.in_use,
+            "submitted": self.submitted,
+            "writer_busy": self._write_lock.locked(),
+        }
+
+    def close(self):
+        """Wait for running and queued writes, then close the pooled
+        connections"""
+        self.executor.shutdown(wait=True)
+        if self.coalescer is not None:
+            self.coalescer.close()
+        self.pool.close()
@@ -0,0 +1,230 @@
+"""
+Bulk writes for the /books/batch endpoints.
+
+Every batch runs in a single IMMEDIATE transaction on the writer
+connection and is committed once, so loading a feed costs one fsync per
+request instead of one per book. Items are validated one by one; invalid
+items are reported with their index and skipped, the rest are written.
+
+The whole body is read and validated before the writer connection is
+taken and the transaction begun (see read_items), so a slow upload never
+holds the write lock; the transaction only covers the SQL.
+"""
+
+import io
+import json
+import os
+
+import etags
+
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', '100000'))
+CHUNK_SIZE = 1000
+REQUIRED_FIELDS = ('title', 'author', 'year')
+
+
+class BatchError(ValueError):
+    """Malformed batch body, reported to the client as a 400"""
+
+
+def iter_items(request):
+    """Items of a batch request: a JSON array, or NDJSON read line by line"""
+    if request.mimetype == 'application/x-ndjson':
+        stream = request.stream
+        if isinstance(stream, io.RawIOBase):
+            # werkzeug's LimitedStream reads lines a byte at a time; buffer it
+            # (gunicorn hands over its own buffered body instead)
+            stream = io.BufferedReader(stream, 64 * 1024)
+        yield from iter_ndjson(stream)
+    else:
+        yield from json_items(request.get_json(silent=True))
+
+
+def read_items(request):
+    """Every item of a batch request, read before any lock is taken"""
+    return list(iter_items(request))
+
+
+def iter_ndjson(lines, max_items=BATCH_MAX_ITEMS):
+    """Items of an NDJSON body, given as an iterable of lines; max_items
+    None for no limit"""
+    count = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        count += 1
+        if max_items is not None and count > max_items:
+            raise BatchError(f"Batch exceeds {max_items} items")
+        try:
+            yield json.loads(line)
+        except ValueError:
+            # Reported per item like any other invalid entry
+            yield None
+
+
+def json_items(items):
+    """Items of a decoded JSON body: an array, {"books": [...]} or {"ids": [...]}"""
+    if isinstance(items, dict):
+        items = items.get('books', items.get('ids'))
+    if not isinstance(items, list):
+        raise BatchError("Expected a JSON array or an NDJSON body")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise BatchError(f"Batch exceeds {BATCH_MAX_ITEMS} items")
+    yield from items
+
+
+def validate_book(item, partial=False):
+    """Column values of a book item, or raise ValueError"""
+    if not isinstance(item, dict):
+        raise ValueError("Item must be a JSON object")
+    if not partial:
+        missing = [k for k in REQUIRED_FIELDS if k not in item]
+        if missing:
+            raise ValueError(f"Missing required fields: {', '.join(missing)}")
+    values = {k: item[k] for k in REQUIRED_FIELDS if k in item}
+    for key in ('title', 'author'):
+        if key in values and not isinstance(values[key], str):
+            raise ValueError(f"{key} must be a string")
+    if 'year' in values and (isinstance(values['year'], bool) or not isinstance(values['year'], int)):
+        raise ValueError("year must be an integer")
+    return values
+
+
+def validate_id(item):
+    book_id = item.get('id') if isinstance(item, dict) else item
+    if isinstance(book_id, bool) or not isinstance(book_id, int):
+        raise ValueError("id must be an integer")
+    return book_id
+
+
+def _chunks(items, size=CHUNK_SIZE):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _next_id(conn):
+    """Id AUTOINCREMENT will give to the next inserted book"""
+    return conn.execute(
+        """SELECT max(coalesce((SELECT seq FROM sqlite_sequence WHERE name = 'books'), 0),
+                      coalesce((SELECT max(id) FROM books), 0)) + 1"""
+    ).fetchone()[0]
+
+
+def _existing_ids(conn, ids):
+    placeholders = ', '.join('?' * len(ids))
+    rows = conn.execute(f'SELECT id FROM books WHERE id IN ({placeholders})', ids)
+    return {row[0] for row in rows}
+
+
+def insert_books(conn, items):
+    """Insert every valid item; one result per item with its id or error"""
+    results = []
+    rows = []
+    for index, item in enumerate(items):
+        try:
+            values = validate_book(item)
+        except ValueError as e:
+            results.append({"index": index, "error": str(e)})
+            continue
+        results.append({"index": index})
+        rows.append((values['title'], values['author'], values['year']))
+    if not rows:
+        return results
+
+    conn.execute('BEGIN IMMEDIATE')
+    # The writer holds the write lock, so AUTOINCREMENT hands out
+    # consecutive ids starting at _next_id()
+    next_id = _next_id(conn)
+    conn.executemany('INSERT INTO books (title, author, year) VALUES (?, ?, ?)', rows)
+    etags.bump_changes(conn)
+    conn.commit()
+    for result in results:
+        if "error" not in result:
+            result["id"] = next_id
+            next_id += 1
+    return results
+
+
+def update_books(conn, items):
+    """Apply partial updates given as {"id": ..., <fields>}; one result per item"""
+    results = []
+    valid = []
+    for index, item in enumerate(items):
+        try:
+            valid.append((index, validate_id(item), validate_book(item, partial=True)))
+        except ValueError as e:
+            results.append({"index": index, "error": str(e)})
+    if not valid:
+        return results
+
+    conn.execute('BEGIN IMMEDIATE')
+    changed = False
+    for chunk in _chunks(valid):
+        existing = _existing_ids(conn, [book_id for _, book_id, _ in chunk])
+
+        # One executemany per distinct set of updated columns
+        groups = {}
+        for item_index, book_id, values in chunk:
+            if book_id not in existing:
+                results.append({"index": item_index, "id": book_id, "error": "Book not found"})
+                continue
+            results.append({"index": item_index, "id": book_id})
+            if values:
+                keys = tuple(sorted(values))
+                groups.setdefault(keys, []).append([values[k] for k in keys] + [book_id])
+        for keys, rows in groups.items():
+            assignments = ', '.join(f'{k} = ?' for k in keys) + ', version = version + 1'
+            conn.executemany(f'UPDATE books SET {assignments} WHERE id = ?', rows)
+            changed = True
+    if changed:
+        etags.bump_changes(conn)
+    conn.commit()
+    results.sort(key=lambda result: result["index"])
+    return results
+
+
+def delete_books(conn, items):
+    """Delete books by id (bare ids or {"id": ...}); one result per item"""
+    results = []
+    valid = []
+    for index, item in enumerate(items):
+        try:
+            valid.append((index, validate_id(item)))
+        except ValueError as e:
+            results.append({"index": index, "error": str(e)})
+    if not valid:
+        return results
+
+    conn.execute('BEGIN IMMEDIATE')
+    changed = False
+    for chunk in _chunks(valid):
+        existing = _existing_ids(conn, [book_id for _, book_id in chunk])
+        rows = []
+        for item_index, book_id in chunk:
+            if book_id in existing:
+                existing.discard(book_id)
+                results.append({"index": item_index, "id": book_id})
+                rows.append((book_id,))
+            else:
+                results.append({"index": item_index, "id": book_id, "error": "Book not found"})
+        if rows:
+            conn.executemany('DELETE FROM books WHERE id = ?', rows)
+            changed = True
+    if changed:
+        etags.bump_changes(conn)
+    conn.commit()
+    results.sort(key=lambda result: result["index"])
+    return results
+
+
+def status_code(results, success=200):
+    """success if every item succeeded, 207 if some did, 400 if none did"""
+    failed = sum(1 for result in results if "error" in result)
+    if not failed:
+        return success
+    return 207 if failed < len(results) else 400
@@ -0,0 +1,763 @@
+"""
+Load-testing harness for the Books API.
+
+    python benchmark.py seed --db bench/books.db --rows 100000
+    python benchmark.py run --app app --db bench/books.db --concurrency 16 --duration 30
+    python benchmark.py run --url http://localhost:5001 --requests 20000
+    python benchmark.py compare bench/results/base.json bench/results/new.json
+    python benchmark.py versus --apps app app_async --concurrency 1000 --duration 30
+    python benchmark.py json --rows 10000
+    python benchmark.py replicas --app app --replicas 2 --duration 20
+
+`run --app` starts the given module (app, app_with_logging or app_async)
+under gunicorn on a free local port against the seeded database and stops
+it afterwards; `run --url` targets an instance that is already running.
+`versus` runs the same workload against each app in turn, e.g. the
+threaded and the asyncio variants at 1k concurrent connections, and
+prints how the second compares with the first.
+Each run reports p50/p95/p99 latency and requests/second per operation
+and writes them to a JSON file that `compare` checks for regressions.
+`json` times the encoding of one large GET /books response, the old way
+(dicts from sqlite3.Row through jsonify) against serialization.py.
+`replicas` starts a primary and read replicas of it (see replication.py)
+as local processes, writes to the primary while polling the replicas,
+and reports how far behind they trail, whether reads with
+X-Books-Min-Seq see their writes, and whether every replica ends up with
+the primary's catalog.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import requests
+
+import replication
+import serialization
+import snapshot
+import storage
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(ROOT, 'bench', 'results')
+
+OPERATIONS = ('get', 'list', 'search', 'create', 'update', 'delete')
+APPS = ('app', 'app_with_logging', 'app_async')
+# gunicorn worker class per app module; the default is gthread (gunicorn.conf.py)
+WORKER_CLASSES = {'app_async': 'uvicorn_worker.UvicornWorker'}
+DEFAULT_MIX = 'get=60,list=15,search=5,create=8,update=8,delete=4'
+
+SEED_CHUNK = 50000
+FIRST_NAMES = ('Ada', 'Alan', 'Grace', 'Ursula', 'Isaac', 'Mary', 'Jorge', 'Toni', 'Haruki', 'Chinua',
+               'Virginia', 'Gabriel', 'Jane', 'Leo', 'Franz', 'Doris', 'Italo', 'Zadie', 'Octavia', 'Umberto')
+LAST_NAMES = ('Lovelace', 'Turing', 'Hopper', 'Le Guin', 'Asimov', 'Shelley', 'Borges', 'Morrison', 'Murakami',
+              'Achebe', 'Woolf', 'Marquez', 'Austen', 'Tolstoy', 'Kafka', 'Lessing', 'Calvino', 'Smith',
+              'Butler', 'Eco', 'Orwell', 'Lee', 'Fitzgerald', 'Atwood', 'Pratchett')
+TITLE_WORDS = ('The', 'Silent', 'Garden', 'Of', 'Forgotten', 'Stars', 'River', 'Night', 'Machine', 'House',
+               'Last', 'City', 'Winter', 'Song', 'Shadow', 'Glass', 'Empire', 'Little', 'Storm', 'Library',
+               'Dream', 'North', 'Iron', 'Letters', 'Ocean', 'Memory', 'Fire', 'Golden', 'Road', 'Time')
+
+
+# Seeding
+
+def random_book(rng):
+    title = ' '.join(rng.choice(TITLE_WORDS) for _ in range(rng.randint(1, 5)))
+    author = f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}'
+    return title, author, rng.randint(1800, 2024)
+
+
+def generate_books(rows, seed):
+    """Deterministic (title, author, year) rows"""
+    rng = random.Random(seed)
+    for _ in range(rows):
+        yield random_book(rng)
+
+
+def seed_database(database, rows, seed=0, init_sql=os.path.join(ROOT, 'init_db.sql')):
+    """Create database from init_db.sql and fill it with `rows` generated books.
+
+    Only the base table is filled; indexes, the search index and the
+    version column are added by the app on its first start."""
+    if os.path.exists(database):
+        raise SystemExit(f'{database} already exists; remove it or use --force')
+    os.makedirs(os.path.dirname(os.path.abspath(database)), exist_ok=True)
+    conn = sqlite3.connect(database)
+    # Bulk load: durability does not matter until the file is complete
+    conn.execute('PRAGMA journal_mode = off')
+    conn.execute('PRAGMA synchronous = off')
+    with open(init_sql, 'r') as f:
+        conn.executescript(f.read())
+    books = generate_books(rows, seed)
+    inserted = 0
+    while inserted < rows:
+        chunk = [next(books) for _ in range(min(SEED_CHUNK, rows - inserted))]
+        conn.executemany('INSERT INTO books (title, author, year) VALUES (?, ?, ?)', chunk)
+        conn.commit()
+        inserted += len(chunk)
+    conn.close()
+    return inserted
+
+
+# Workload
+
+def parse_mix(raw):
+    """'get=60,create=10' -> {'get': 60, 'create': 10}"""
+    mix = {}
+    for part in raw.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f'Unknown operation: {name} (choose from {", ".join(OPERATIONS)})')
+        try:
+            mix[name] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'Invalid weight for {name}: {weight!r}')
+    return mix
+
+
+class Worker:
+    """One client thread: a keep-alive session and its own random stream"""
+
+    def __init__(self, url, max_id, seed):
+        self.url = url
+        self.max_id = max_id
+        self.rng = random.Random(seed)
+        self.session = requests.Session()
+        self.created = []
+
+    def book_id(self):
+        return self.rng.randint(1, self.max_id)
+
+    def get(self):
+        return self.session.get(f'{self.url}/books/{self.book_id()}')
+
+    def list(self):
+        params = self.rng.choice((
+            {'limit': 20},
+            {'author': f'{self.rng.choice(FIRST_NAMES)} {self.rng.choice(LAST_NAMES)}', 'limit': 20},
+            {'year_min': self.rng.randint(1800, 2000), 'sort': 'year', 'limit': 50},
+            {'title_prefix': self.rng.choice(TITLE_WORDS), 'limit': 20},
+        ))
+        return self.session.get(f'{self.url}/books', params=params)
+
+    def search(self):
+        return self.session.get(f'{self.url}/books/search', params={'q': self.rng.choice(TITLE_WORDS), 'limit': 20})
+
+    def create(self):
+        title, author, year = random_book(self.rng)
+        response = self.session.post(f'{self.url}/books', json={'title': title, 'author': author, 'year': year})
+        if response.status_code == 201:
+            self.created.append(response.json()['id'])
+        return response
+
+    def update(self):
+        return self.session.put(f'{self.url}/books/{self.book_id()}', json={'year': self.rng.randint(1800, 2024)})
+
+    def delete(self):
+        # Only books this run created are deleted, so that reads keep hitting
+        return self.session.delete(f'{self.url}/books/{self.created.pop()}')
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(latencies, statuses, errors, elapsed):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        "requests": count,
+        "errors": errors,
+        "rps": round(count / elapsed, 2) if elapsed else None,
+        "mean_ms": round(sum(latencies) / count * 1000, 3) if count else None,
+        "p50_ms": _ms(percentile(latencies, 50)),
+        "p95_ms": _ms(percentile(latencies, 95)),
+        "p99_ms": _ms(percentile(latencies, 99)),
+        "max_ms": _ms(latencies[-1] if latencies else None),
+        "statuses": {str(status): n for status, n in sorted(statuses.items())},
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def run_workload(url, mix, concurrency, duration=None, total=None, seed=0, warmup=0):
+    """Drive the API from `concurrency` threads and collect per-operation
+    latencies; stops after `duration` seconds or `total` requests"""
+    max_id = _max_book_id(url)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    lock = threading.Lock()
+    # A delete with nothing to delete yet is sent as a create
+    recorded = names + ['create'] if 'delete' in mix and 'create' not in mix else names
+    results = {name: {"latencies": [], "statuses": {}, "errors": 0} for name in recorded}
+    issued = [0]
+    deadline = [None]
+
+    def claim():
+        with lock:
+            if total is not None and issued[0] >= total:
+                return False
+            issued[0] += 1
+        return deadline[0] is None or time.perf_counter() < deadline[0]
+
+    def drive(worker_seed, record):
+        worker = Worker(url, max_id, worker_seed)
+        local = {name: ([], {}, [0]) for name in recorded}
+        while claim() if record else time.perf_counter() < deadline[0]:
+            name = worker.rng.choices(names, weights)[0]
+            if name == 'delete' and not worker.created:
+                name = 'create'
+            start = time.perf_counter()
+            try:
+                response = getattr(worker, name)()
+                status = response.status_code
+            except requests.RequestException:
+                status = None
+            latency = time.perf_counter() - start
+            latencies, statuses, errors = local[name]
+            if status is None or status >= 500:
+                errors[0] += 1
+            if status is not None:
+                latencies.append(latency)
+                statuses[status] = statuses.get(status, 0) + 1
+        if record:
+            with lock:
+                for name, (latencies, statuses, errors) in local.items():
+                    results[name]["latencies"].extend(latencies)
+                    results[name]["errors"] += errors[0]
+                    for status, n in statuses.items():
+                        results[name]["statuses"][status] = results[name]["statuses"].get(status, 0) + n
+
+    def spawn(record, seed_offset):
+        threads = [threading.Thread(target=drive, args=(seed * 1000 + seed_offset + i, record))
+                   for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    if warmup:
+        deadline[0] = time.perf_counter() + warmup
+        spawn(False, 500)
+
+    deadline[0] = time.perf_counter() + duration if duration else None
+    start = time.perf_counter()
+    spawn(True, 0)
+    elapsed = time.perf_counter() - start
+
+    operations = {name: summarize(r["latencies"], r["statuses"], r["errors"], elapsed) for name, r in results.items()}
+    all_statuses = {}
+    for r in results.values():
+        for status, n in r["statuses"].items():
+            all_statuses[status] = all_statuses.get(status, 0) + n
+    overall = summarize([l for r in results.values() for l in r["latencies"]], all_statuses,
+                        sum(r["errors"] for r in results.values()), elapsed)
+    return {"elapsed_s": round(elapsed, 3), "operations": operations, "total": overall}
+
+
+def _max_book_id(url):
+    response = requests.get(f'{url}/books', params={'sort': '-id', 'limit': 1, 'fields': 'id'}, timeout=10)
+    response.raise_for_status()
+    books = response.json()["books"]
+    if not books:
+        raise SystemExit(f'{url} has no books; seed the database first')
+    return books[0]["id"]
+
+
+# Local server
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class LocalServer:
+    """The given app module under gunicorn, on a free port, for one run"""
+
+    def __init__(self, module, database, workers=None, threads=None, env=None):
+        self.module = module
+        self.database = os.path.abspath(database)
+        self.port = _free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.workdir = tempfile.mkdtemp(prefix='books-bench-')
+        self.env = dict(os.environ,
+                        DATABASE_PATH=self.database,
+                        INIT_SQL_PATH=os.path.join(ROOT, 'init_db.sql'),
+                        PORT=str(self.port),
+                        LOG_DIR=os.path.join(self.workdir, 'logs'),
+                        METRICS_DIR=os.path.join(self.workdir, 'metrics'),
+                        RATE_LIMIT_PATH=os.path.join(self.workdir, 'ratelimit.db'))
+        # One load generator is one client: measure the server, not its
+        # per-client limits (see ratelimit.py)
+        for rule in ('RATE_LIMIT_READ', 'RATE_LIMIT_WRITE', 'RATE_LIMIT_EXPORT'):
+            self.env.setdefault(rule, 'off')
+        if workers:
+            self.env['WEB_CONCURRENCY'] = str(workers)
+        if threads:
+            self.env['GUNICORN_THREADS'] = str(threads)
+        self.env.update(env or {})
+        self.process = None
+
+    def __enter__(self):
+        command = [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py']
+        if self.module in WORKER_CLASSES:
+            command += ['--worker-class', WORKER_CLASSES[self.module]]
+        self.process = subprocess.Popen(
+            command + [f'{self.module}:create_app()'],
+            cwd=ROOT, env=self.env, stdout=subprocess.DEVNULL,
+            stderr=open(os.path.join(self.workdir, 'gunicorn.log'), 'w'))
+        # First start may build indexes and the search index on a large database
+        deadline = time.monotonic() + 600
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise SystemExit(f'gunicorn exited, see {self.workdir}/gunicorn.log')
+            try:
+                if requests.get(f'{self.url}/health', timeout=1).status_code == 200:
+                    return self
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        self.__exit__(None, None, None)
+        raise SystemExit(f'{self.module} did not come up, see {self.workdir}/gunicorn.log')
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=35)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+# Replication
+
+class SeqPoller(threading.Thread):
+    """Records when a replica's X-Books-Seq moves, until stopped"""
+
+    def __init__(self, url, interval=0.005):
+        super().__init__(daemon=True)
+        self.url = url
+        self.interval = interval
+        self.stop = threading.Event()
+        self.samples = []
+
+    def run(self):
+        session = requests.Session()
+        while not self.stop.is_set():
+            try:
+                response = session.get(f'{self.url}/books', params={'limit': 1}, allow_redirects=False)
+                seq = response.headers.get(replication.SEQ_HEADER)
+                if seq is not None and (not self.samples or int(seq) > self.samples[-1][1]):
+                    self.samples.append((time.monotonic(), int(seq)))
+            except requests.RequestException:
+                pass
+            self.stop.wait(self.interval)
+
+    def reached(self, seq):
+        """Time the replica first served seq or later, or None"""
+        for at, served in self.samples:
+            if served >= seq:
+                return at
+        return None
+
+
+def replication_workload(primary, replicas, duration, seed=0):
+    """Write to primary for duration seconds, reading each write back from
+    the first replica with X-Books-Min-Seq; returns the writes as
+    (seq, time) and the read-your-writes counts"""
+    rng = random.Random(seed)
+    session = requests.Session()
+    created = []
+    writes = []
+    reads = {"checked": 0, "stale": 0, "from_primary": 0}
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        op = rng.choice(('create', 'create', 'update', 'delete')) if created else 'create'
+        if op == 'create':
+            title, author, year = random_book(rng)
+            response = session.post(f'{primary}/books', json={'title': title, 'author': author, 'year': year})
+            book_id, expected = response.json()['id'], year
+            created.append(book_id)
+        elif op == 'update':
+            book_id, expected = rng.choice(created), rng.randint(1800, 2024)
+            response = session.put(f'{primary}/books/{book_id}', json={'year': expected})
+        else:
+            book_id, expected = created.pop(rng.randrange(len(created))), None
+            response = session.delete(f'{primary}/books/{book_id}')
+        response.raise_for_status()
+        seq = response.headers[replication.SEQ_HEADER]
+        writes.append((int(seq), time.monotonic()))
+
+        read = session.get(f'{replicas[0]}/books/{book_id}', headers={replication.MIN_SEQ_HEADER: seq})
+        reads["checked"] += 1
+        reads["from_primary"] += bool(read.history)
+        year = read.json()['year'] if read.status_code == 200 else None
+        reads["stale"] += year != expected
+    return writes, reads
+
+
+def wait_for_seq(url, seq, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        response = requests.get(f'{url}/books', params={'limit': 1}, allow_redirects=False)
+        if int(response.headers.get(replication.SEQ_HEADER, 0)) >= seq:
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def export_digest(url):
+    response = requests.get(f'{url}/books/export', params={'format': 'ndjson'}, allow_redirects=False)
+    response.raise_for_status()
+    return hashlib.sha256(response.content).hexdigest()
+
+
+# Reports
+
+def raise_open_files_limit():
+    """Allow as many sockets as the hard limit permits, for the client
+    threads and for the local server, which inherits the limit"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _book_count(database):
+    if not database or not os.path.exists(database):
+        return None
+    conn = sqlite3.connect(database)
+    try:
+        return conn.execute('SELECT count(*) FROM books').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def print_report(report, out=sys.stdout):
+    print(f"{'operation':<10} {'requests':>9} {'errors':>7} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}", file=out)
+    rows = list(report["operations"].items()) + [("total", report["total"])]
+    for name, stats in rows:
+        print(f"{name:<10} {stats['requests']:>9} {stats['errors']:>7} {_fmt(stats['rps']):>9} "
+              f"{_fmt(stats['p50_ms']):>9} {_fmt(stats['p95_ms']):>9} {_fmt(stats['p99_ms']):>9}", file=out)
+
+
+def _fmt(value):
+    return '-' if value is None else f'{value:.2f}'
+
+
+def compare_reports(base, new, threshold):
+    """Lines describing each metric, and whether any regressed by more
+    than threshold (a fraction)"""
+    lines = []
+    regressed = False
+    for name in ['total'] + sorted(set(base["operations"]) & set(new["operations"])):
+        old_stats = base["total"] if name == 'total' else base["operations"][name]
+        new_stats = new["total"] if name == 'total' else new["operations"][name]
+        for metric, higher_is_better in (('rps', True), ('p50_ms', False), ('p95_ms', False), ('p99_ms', False)):
+            old, cur = old_stats.get(metric), new_stats.get(metric)
+            if not old or cur is None:
+                continue
+            change = (cur - old) / old
+            worse = -change if higher_is_better else change
+            flag = 'REGRESSION' if worse > threshold else ''
+            regressed = regressed or bool(flag)
+            lines.append(f'{name:<10} {metric:<7} {old:>10.2f} -> {cur:>10.2f} ({change:+.1%}) {flag}'.rstrip())
+    return lines, regressed
+
+
+# Serialization micro-benchmark
+
+def json_benchmark(rows, repeat=5):
+    """Milliseconds to fetch and encode a rows-long page, per approach"""
+    from flask import Flask, jsonify
+    from flask.json.provider import DefaultJSONProvider
+
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE books (id INTEGER PRIMARY KEY, title TEXT, author TEXT, year INTEGER)')
+    conn.executemany('INSERT INTO books (title, author, year) VALUES (?, ?, ?)', generate_books(rows, 0))
+    sql = 'SELECT id, title, author, year FROM books'
+    columns = ('id', 'title', 'author', 'year')
+
+    def dict_rows():
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        books = [dict(book) for book in cursor.execute(sql).fetchall()]
+        return jsonify({"books": books, "count": len(books), "next_after": None}).get_data()
+
+    def tuple_rows():
+        books = conn.execute(sql).fetchall()
+        return serialization.collection(columns, books, count=len(books), next_after=None)
+
+    def best(fn):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - start)
+        return round(min(timings) * 1000, 2)
+
+    app = Flask(__name__)
+    app.json = DefaultJSONProvider(app)
+    results = {}
+    with app.app_context():
+        results["jsonify_dicts_stdlib"] = best(dict_rows)
+        orjson = serialization.orjson
+        try:
+            serialization.orjson = None
+            results["tuples_stdlib"] = best(tuple_rows)
+        finally:
+            serialization.orjson = orjson
+        if orjson is not None:
+            results["tuples_orjson"] = best(tuple_rows)
+    conn.close()
+    return results
+
+
+# Command line
+
+def cmd_seed(args):
+    if args.force and os.path.exists(args.db):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.db + suffix):
+                os.remove(args.db + suffix)
+    start = time.perf_counter()
+    inserted = seed_database(args.db, args.rows, args.seed)
+    print(f'Seeded {args.db} with {inserted} books in {time.perf_counter() - start:.1f}s')
+
+
+def run_report(args, app=None, url=None):
+    """Run the workload against app (started locally) or url and return
+    the report with its metadata"""
+    def execute(url):
+        return run_workload(url, args.mix, args.concurrency, duration=args.duration, total=args.requests,
+                            seed=args.seed, warmup=args.warmup)
+
+    if app:
+        with LocalServer(app, args.db, args.workers, args.threads) as server:
+            report = execute(server.url)
+            target = server.url
+    else:
+        report = execute(url.rstrip('/'))
+        target = url
+
+    report["meta"] = {
+        "timestamp": datetime.now().isoformat(timespec='seconds'),
+        "target": target,
+        "app": app,
+        "label": args.label,
+        "rows": _book_count(args.db) if app else None,
+        "concurrency": args.concurrency,
+        "duration_s": args.duration,
+        "requests": args.requests,
+        "mix": args.mix,
+        "seed": args.seed,
+        "workers": args.workers,
+        "threads": args.threads,
+        "worker_class": WORKER_CLASSES.get(app, 'gthread') if app else None,
+        "sqlite_pragmas": storage.load_pragmas(),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+    return report
+
+
+def save_report(report, output=None, name='remote'):
+    if output is None:
+        output = os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-{name}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {output}')
+
+
+def cmd_run(args):
+    if not args.url and not args.app:
+        raise SystemExit('run needs --app or --url')
+    if args.duration is None and args.requests is None:
+        args.duration = 30
+    raise_open_files_limit()
+
+    report = run_report(args, args.app, args.url)
+    print_report(report)
+    save_report(report, args.output, args.label or args.app or 'remote')
+
+
+def cmd_versus(args):
+    if args.duration is None and args.requests is None:
+        args.duration = 30
+    raise_open_files_limit()
+
+    reports = []
+    for app in args.apps:
+        print(f'== {app} ({args.concurrency} concurrent clients)')
+        report = run_report(args, app)
+        print_report(report)
+        save_report(report, name=f'{args.label or "versus"}-{app}')
+        reports.append(report)
+    base = reports[0]
+    for app, report in zip(args.apps[1:], reports[1:]):
+        print(f'\n== {app} against {args.apps[0]}')
+        lines, _ = compare_reports(base, report, args.threshold)
+        print('\n'.join(lines))
+
+
+def cmd_compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    lines, regressed = compare_reports(base, new, args.threshold)
+    print('\n'.join(lines))
+    if regressed:
+        print(f'Regression beyond {args.threshold:.0%} detected')
+        sys.exit(1)
+
+
+def cmd_json(args):
+    results = json_benchmark(args.rows, args.repeat)
+    baseline = results["jsonify_dicts_stdlib"]
+    print(f'Fetch + encode {args.rows} rows (best of {args.repeat}):')
+    for name, ms in results.items():
+        print(f'  {name:<22} {ms:>9.2f} ms  {baseline / ms:>5.1f}x')
+    if 'tuples_orjson' not in results:
+        print('  (orjson is not installed)')
+
+
+def cmd_replicas(args):
+    if not os.path.exists(args.db):
+        raise SystemExit(f'{args.db} does not exist; create it with the seed command')
+    workdir = tempfile.mkdtemp(prefix='books-replicas-')
+    pragmas = storage.load_pragmas()
+    copies = []
+    for index in range(args.replicas):
+        copy = os.path.join(workdir, f'replica-{index}.db')
+        snapshot.take(args.db, pragmas, copy)
+        copies.append(copy)
+
+    with contextlib.ExitStack() as stack:
+        primary = stack.enter_context(LocalServer(args.app, args.db, args.workers, args.threads))
+        env = {'REPLICA_OF': primary.url, 'REPLICA_POLL_INTERVAL': str(args.poll_interval)}
+        replicas = [stack.enter_context(LocalServer(args.app, copy, args.workers, args.threads, env=env))
+                    for copy in copies]
+        pollers = [SeqPoller(replica.url) for replica in replicas]
+        for poller in pollers:
+            poller.start()
+        writes, reads = replication_workload(primary.url, [r.url for r in replicas], args.duration, args.seed)
+        last_seq = writes[-1][0] if writes else 0
+        caught_up = [wait_for_seq(replica.url, last_seq) for replica in replicas]
+        for poller in pollers:
+            poller.stop.set()
+            poller.join()
+        digest = export_digest(primary.url)
+        consistent = [done and export_digest(replica.url) == digest for done, replica in zip(caught_up, replicas)]
+
+    print(f'{len(writes)} writes to the primary in {args.duration:.0f}s, {args.replicas} replicas '
+          f'polling every {args.poll_interval}s')
+    print(f"{'replica':<10} {'p50 lag ms':>11} {'p95 lag ms':>11} {'max lag ms':>11} {'consistent':>11}")
+    for index, (poller, ok) in enumerate(zip(pollers, consistent)):
+        lags = sorted(max(0.0, poller.reached(seq) - at) * 1000 for seq, at in writes
+                      if poller.reached(seq) is not None)
+        print(f'{index:<10} {_fmt(percentile(lags, 50)):>11} {_fmt(percentile(lags, 95)):>11} '
+              f'{_fmt(lags[-1] if lags else None):>11} {"yes" if ok else "NO":>11}')
+    print(f'Read-your-writes on replica 0: {reads["checked"] - reads["stale"]}/{reads["checked"]} saw their write, '
+          f'{reads["from_primary"]} redirected to the primary')
+    if reads["stale"] or not all(consistent):
+        sys.exit(1)
+
+
+def add_workload_arguments(parser):
+    parser.add_argument('--db', default=os.path.join(ROOT, 'bench', 'books.db'), help='database for --app')
+    parser.add_argument('--workers', type=int, help='gunicorn workers for --app')
+    parser.add_argument('--threads', type=int, help='gunicorn threads per worker for --app')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads')
+    parser.add_argument('--duration', type=float, help='seconds to run (default: 30)')
+    parser.add_argument('--requests', type=int, help='stop after this many requests')
+    parser.add_argument('--warmup', type=float, default=2, help='seconds of unrecorded warm-up traffic')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f'operation weights (default: {DEFAULT_MIX})')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--label', help='name for the results file')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Seed, load-test and compare runs of the Books API')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed = commands.add_parser('seed', help='create a books.db with generated books')
+    seed.add_argument('--db', default=os.path.join(ROOT, 'bench', 'books.db'))
+    seed.add_argument('--rows', type=int, default=100000, help='books to generate (1k to 10M)')
+    seed.add_argument('--seed', type=int, default=0)
+    seed.add_argument('--force', action='store_true', help='replace an existing database')
+    seed.set_defaults(func=cmd_seed)
+
+    run = commands.add_parser('run', help='run a mixed workload and record latencies')
+    target = run.add_mutually_exclusive_group()
+    target.add_argument('--app', choices=APPS, help='start this app locally under gunicorn')
+    target.add_argument('--url', help='benchmark an already running instance')
+    add_workload_arguments(run)
+    run.add_argument('--output', help='results file (default: bench/results/<time>-<label>.json)')
+    run.set_defaults(func=cmd_run)
+
+    compare = commands.add_parser('compare', help='compare two results files')
+    compare.add_argument('base')
+    compare.add_argument('new')
+    compare.add_argument('--threshold', type=float, default=0.10, help='allowed slowdown (default: 0.10)')
+    compare.set_defaults(func=cmd_compare)
+
+    versus = commands.add_parser('versus', help='run the same workload against several apps and compare them')
+    versus.add_argument('--apps', nargs='+', choices=APPS, default=['app', 'app_async'],
+                        help='apps to start in turn; the first is the baseline (default: app app_async)')
+    add_workload_arguments(versus)
+    versus.add_argument('--threshold', type=float, default=0.10, help='change flagged in the comparison')
+    versus.set_defaults(func=cmd_versus)
+
+    json_bench = commands.add_parser('json', help='time JSON encoding of a large page')
+    json_bench.add_argument('--rows', type=int, default=10000)
+    json_bench.add_argument('--repeat', type=int, default=5)
+    json_bench.set_defaults(func=cmd_json)
+
+    replicas = commands.add_parser('replicas', help='write to a primary and measure how its read replicas follow')
+    replicas.add_argument('--app', choices=APPS, default='app', help='app run by the primary and the replicas')
+    replicas.add_argument('--db', default=os.path.join(ROOT, 'bench', 'books.db'),
+                          help='database of the primary; each replica starts from a snapshot of it')
+    replicas.add_argument('--replicas', type=int, default=2)
+    replicas.add_argument('--workers', type=int, help='gunicorn workers per instance')
+    replicas.add_argument('--threads', type=int, help='gunicorn threads per worker')
+    replicas.add_argument('--duration', type=float, default=20, help='seconds of writes')
+    replicas.add_argument('--poll-interval', type=float, default=replication.REPLICA_POLL_INTERVAL,
+                          help='REPLICA_POLL_INTERVAL of the replicas')
+    replicas.add_argument('--seed', type=int, default=0)
+    replicas.set_defaults(func=cmd_replicas)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""
+Bulk import of book catalogs into books.db.
+
+flask import-books FILE loads a CSV file with a title,author,year header
+or an NDJSON file with one {"title", "author", "year"} object per line,
+read as a stream ("-" for stdin). Rows are validated like the items of
+POST /books/batch; invalid ones are reported by row number and skipped.
+Ids are always assigned by the database: to copy a catalog with its ids,
+take a snapshot instead (see snapshot.py).
+
+By default the whole file is loaded in one write transaction with the
+per-row work deferred: the secondary indexes of books and the insert
+triggers of the search index and the change log are dropped, rows are
+inserted IMPORT_CHUNK_SIZE at a time, then the new rows are indexed and
+logged with one statement each and the indexes rebuilt, all before the
+single commit. Readers keep the previous catalog and its indexes until
+then (WAL). API writes wait for the lock and fail after busy_timeout, so
+pause them during a deferred import; a failed import leaves the table as
+it was.
+
+With --online the indexes and triggers stay in place and every
+IMPORT_CHUNK_SIZE rows are committed, so API writes go on between chunks;
+it is several times slower.
+
+IMPORT_CHUNK_SIZE        rows per insert batch, and per commit with --online
+                         (default: 50000)
+IMPORT_CACHE_MB          page cache of the import connection, which the
+                         index builds use (default: 256)
+"""
+
+import contextlib
+import csv
+import itertools
+import os
+import sys
+import time
+
+import click
+
+import batch
+import changefeed
+import etags
+import search
+import storage
+
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', '50000'))
+IMPORT_CACHE_MB = int(os.environ.get('IMPORT_CACHE_MB', '256'))
+MAX_REPORTED_ERRORS = 20
+
+FORMATS = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}
+
+INSERT_BOOK = 'INSERT INTO books (title, author, year) VALUES (?, ?, ?)'
+
+# Row triggers dropped by a deferred import, and the set-based statement
+# that does their work for the imported rows
+DEFERRED_TRIGGERS = {
+    'books_fts_insert': search.index_books,
+    'book_changes_insert': changefeed.record_inserts,
+}
+
+
+def detect_format(path, fmt=None):
+    """csv or ndjson, from fmt or else from the file extension"""
+    if fmt:
+        return fmt
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FORMATS:
+        raise ValueError(f"Cannot tell the format of {path!r}; expected {', '.join(FORMATS)}")
+    return FORMATS[extension]
+
+
+def iter_csv(lines):
+    """Items of a CSV file with a header row"""
+    for row in csv.DictReader(lines):
+        item = {k: v for k, v in row.items() if k in batch.REQUIRED_FIELDS and v is not None}
+        if 'year' in item:
+            try:
+                item['year'] = int(item['year'])
+            except ValueError:
+                # Left as a string, reported by validate_book
+                pass
+        yield item
+
+
+def read_items(path, fmt):
+    """Items of an import file"""
+    if path == '-':
+        stream = contextlib.nullcontext(sys.stdin)
+    else:
+        stream = open(path, 'r', encoding='utf-8', newline='')
+    with stream as lines:
+        if fmt == 'csv':
+            yield from iter_csv(lines)
+        else:
+            yield from batch.iter_ndjson(lines, max_items=None)
+
+
+def _valid_rows(items, report):
+    for index, item in enumerate(items, 1):
+        try:
+            values = batch.validate_book(item)
+        except ValueError as e:
+            report["invalid"] += 1
+            if len(report["errors"]) < MAX_REPORTED_ERRORS:
+                report["errors"].append((index, str(e)))
+            continue
+        yield values['title'], values['author'], values['year']
+
+
+def _chunks(rows, size):
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_books(conn, items, chunk_size=IMPORT_CHUNK_SIZE, online=False):
+    """Insert the valid items; returns the number of imported and invalid
+    rows, the first errors and the time taken"""
+    started = time.monotonic()
+    report = {"imported": 0, "invalid": 0, "errors": []}
+    conn.execute(f'PRAGMA cache_size = {-IMPORT_CACHE_MB * 1024}')
+    rows = _valid_rows(items, report)
+    if online:
+        _import_online(conn, rows, chunk_size, report)
+    else:
+        _import_deferred(conn, rows, chunk_size, report)
+    # A deferred import leaves the whole load in the WAL file
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    report["seconds"] = round(time.monotonic() - started, 3)
+    return report
+
+
+def _import_online(conn, rows, chunk_size, report):
+    for chunk in _chunks(rows, chunk_size):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(INSERT_BOOK, chunk)
+            etags.bump_changes(conn)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        report["imported"] += len(chunk)
+
+
+def _import_deferred(conn, rows, chunk_size, report):
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # AUTOINCREMENT hands out ids above every existing one
+        after_id = conn.execute('SELECT coalesce(max(id), 0) FROM books').fetchone()[0]
+        placeholders = ', '.join('?' * len(DEFERRED_TRIGGERS))
+        deferred = conn.execute(
+            f"""SELECT type, name, sql FROM sqlite_master
+                WHERE tbl_name = 'books' AND sql IS NOT NULL
+                  AND (type = 'index' OR (type = 'trigger' AND name IN ({placeholders})))""",
+            tuple(DEFERRED_TRIGGERS)
+        ).fetchall()
+        for kind, name, _ in deferred:
+            conn.execute(f'DROP {kind.upper()} {name}')
+        imported = 0
+        for chunk in _chunks(rows, chunk_size):
+            conn.executemany(INSERT_BOOK, chunk)
+            imported += len(chunk)
+        if imported:
+            for kind, name, _ in deferred:
+                if kind == 'trigger':
+                    DEFERRED_TRIGGERS[name](conn, after_id)
+            etags.bump_changes(conn)
+        for _, _, sql in deferred:
+            conn.execute(sql)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    report["imported"] = imported
+
+
+def init_app(app, database, pragmas):
+    """Register the import-books CLI command"""
+
+    @app.cli.command('import-books')
+    @click.argument('path')
+    @click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']),
+                  help='file format (default: from the file extension)')
+    @click.option('--online', is_flag=True, help='keep indexes and triggers and commit chunk by chunk')
+    @click.option('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE, show_default=True,
+                  help='rows per insert batch')
+    def import_books_command(path, fmt, online, chunk_size):
+        """Load books from a CSV or NDJSON file into books.db"""
+        try:
+            fmt = detect_format(path, fmt)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+        conn = storage.open_connection(database, pragmas)
+        try:
+            report = import_books(conn, read_items(path, fmt), chunk_size, online)
+        finally:
+            conn.close()
+        for index, message in report["errors"]:
+            click.echo(f'Row {index}: {message}', err=True)
+        click.echo(f'Imported {report["imported"]} books in {report["seconds"]}s '
+                   f'({report["invalid"]} invalid rows skipped)')
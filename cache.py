@@ -0,0 +1,309 @@
+"""
+Read-through cache for GET /books/<id> and GET /books.
+
+Single books are cached under book:<id>. The routes that modify a book
+drop its entry and append its id to the invalidation log, a small ring of
+recently written ids in books.db-cache, a file next to books.db that
+every process maps into memory. Before using the cache a process compares
+the log's generation with the last one it has seen and, if it moved,
+drops the ids written since from its own entries, so no worker serves a
+book another one has changed or deleted. A cache hit costs that one
+comparison and never touches SQLite. A process that falls more than
+INVALIDATION_SLOTS ids behind drops all its entries. Readers take the
+generation before querying SQLite and only store their result if the
+book has not been written since, so a read that raced with a write can
+never put a stale row back in the cache.
+
+List pages depend on every book, so they are cached under a key that
+embeds the table change counter kept in books.db (see etags.py), which
+the list routes read anyway for their ETag: one write from any worker
+orphans every cached page at once (the orphans then age out through
+LRU/TTL).
+
+Backends:
+- local: an in-process LRU with TTL (default)
+- redis: any Redis-protocol server shared by every worker, selected with
+  CACHE_BACKEND=redis and CACHE_REDIS_URL. Writes delete book entries on
+  the server itself; the invalidation log, shared by the processes of one
+  host, only guards against racing reads. The redis package is optional;
+  any client object with get/set/delete can be passed instead, e.g. a
+  local stand-in in tests.
+"""
+
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'local')
+CACHE_MAXSIZE = int(os.environ.get('CACHE_MAXSIZE', '10000'))
+CACHE_TTL = float(os.environ.get('CACHE_TTL', '60'))
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+
+# Ids kept in the invalidation log
+INVALIDATION_SLOTS = 4096
+
+
+class LocalBackend:
+    """Bounded in-process LRU with a per-entry TTL"""
+
+    shared = False
+
+    def __init__(self, maxsize=CACHE_MAXSIZE, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "local",
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class RedisBackend:
+    """Cache shared by every worker through a Redis-protocol server.
+
+    Values are stored as JSON (bytes as-is, behind a marker byte) with a
+    TTL; eviction is left to the server's maxmemory policy.
+    """
+
+    BYTES_MARKER = b'\x00'
+    # Entries live on the server, not in each process
+    shared = True
+
+    def __init__(self, client, ttl=CACHE_TTL):
+        self.client = client
+        self.ttl = ttl
+
+    @classmethod
+    def from_url(cls, url=CACHE_REDIS_URL, ttl=CACHE_TTL):
+        import redis
+        return cls(redis.Redis.from_url(url), ttl)
+
+    def get(self, key):
+        raw = self.client.get(key)
+        if raw is None:
+            return None
+        if raw[:1] == self.BYTES_MARKER:
+            return raw[1:]
+        return json.loads(raw)
+
+    def set(self, key, value):
+        raw = self.BYTES_MARKER + value if isinstance(value, bytes) else json.dumps(value)
+        self.client.set(key, raw, ex=max(1, int(self.ttl)))
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*keys)
+
+    def stats(self):
+        return {"backend": "redis"}
+
+
+class InvalidationLog:
+    """Ring of the last INVALIDATION_SLOTS written book ids, in a file
+    mapped by every process: a generation (the number of ids ever
+    appended) followed by the slots"""
+
+    HEADER = struct.Struct('<Q')
+    SLOT = struct.Struct('<q')
+
+    def __init__(self, path, slots=INVALIDATION_SLOTS):
+        self.slots = slots
+        self._lock = threading.Lock()
+        size = self.HEADER.size + slots * self.SLOT.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+
+    def generation(self):
+        return self.HEADER.unpack_from(self._map, 0)[0]
+
+    def append(self, ids):
+        # lockf locks belong to the process, so it also orders processes
+        # forked with this file open; the thread lock orders threads
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                generation = self.generation()
+                for book_id in ids:
+                    self.SLOT.pack_into(self._map, self.HEADER.size + (generation % self.slots) * self.SLOT.size,
+                                        book_id)
+                    generation += 1
+                # Published last, so readers never see a slot before it is written
+                self.HEADER.pack_into(self._map, 0, generation)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def since(self, seen):
+        """Current generation and the ids appended since generation seen,
+        or None for the ids if they are no longer all in the ring"""
+        generation = self.generation()
+        if not seen <= generation <= seen + self.slots:
+            return generation, None
+        ids = {self.SLOT.unpack_from(self._map, self.HEADER.size + (n % self.slots) * self.SLOT.size)[0]
+               for n in range(seen, generation)}
+        # Slots read meanwhile may have been reused by newer ids
+        if self.generation() > seen + self.slots:
+            return generation, None
+        return generation, ids
+
+
+class BookCache:
+    """Book and list-page cache with hit/miss counters"""
+
+    def __init__(self, backend, log):
+        self.backend = backend
+        self.log = log
+        self._lock = threading.Lock()
+        self._seen = log.generation()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.resets = 0
+
+    def _sync(self):
+        """Drop the local entries of books written by any process since the
+        last call"""
+        if self.log.generation() == self._seen:
+            return
+        with self._lock:
+            self._seen, ids = self.log.since(self._seen)
+            if self.backend.shared:
+                return
+            if ids is None:
+                self.resets += 1
+                self.backend.clear()
+            else:
+                self.backend.delete(*(f'book:{book_id}' for book_id in ids))
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _get(self, key):
+        value = self.backend.get(key)
+        self._count(value is not None)
+        return value
+
+    @staticmethod
+    def list_key(version, namespace, args, encoding=None):
+        key = f'{namespace}:{version}:' + urlencode(sorted(args.items(multi=True)))
+        return f'{key}|{encoding}' if encoding else key
+
+    def read_token(self):
+        """Log generation to pass back to set_book after the query"""
+        self._sync()
+        return self.log.generation()
+
+    def get_book(self, book_id):
+        self._sync()
+        return self._get(f'book:{book_id}')
+
+    def set_book(self, book_id, book, token):
+        _, ids = self.log.since(token)
+        if ids is not None and book_id not in ids:
+            self.backend.set(f'book:{book_id}', book)
+
+    def get_list(self, namespace, args, version, encoding=None):
+        """Cached response body for the given table version and query
+        parameters, compressed with encoding if given"""
+        return self._get(self.list_key(version, namespace, args, encoding))
+
+    def set_list(self, namespace, args, body, version, encoding=None):
+        # version was read before the query, so the body is at least as new
+        self.backend.set(self.list_key(version, namespace, args, encoding), body)
+
+    def invalidate(self, *book_ids):
+        """Forget the given books, in every process; call once the write
+        has committed"""
+        if book_ids:
+            self.backend.delete(*(f'book:{book_id}' for book_id in book_ids))
+            self.log.append(book_ids)
+            with self._lock:
+                self.invalidations += len(book_ids)
+
+    def stats(self):
+        with self._lock:
+            stats = {"hits": self.hits, "misses": self.misses, "invalidations": self.invalidations,
+                     "resets": self.resets}
+        stats.update(self.backend.stats())
+        return stats
+
+
+def create_backend(name=CACHE_BACKEND):
+    if name == 'local':
+        return LocalBackend()
+    if name == 'redis':
+        return RedisBackend.from_url()
+    raise ValueError(f'Unknown CACHE_BACKEND: {name}')
+
+
+def log_path(database):
+    return f'{database}-cache'
+
+
+def create_cache(database, backend=None):
+    """A book cache whose invalidations reach every process using database"""
+    return BookCache(backend or create_backend(), InvalidationLog(log_path(database)))
+
+
+def init_app(app, database, backend=None):
+    """Attach a book cache to the app"""
+    book_cache = create_cache(database, backend)
+    app.extensions['book_cache'] = book_cache
+    return book_cache
+
+
+# The cache of the app handling the current request
+current_cache = LocalProxy(lambda: current_app.extensions['book_cache'])
@@ -0,0 +1,291 @@
+"""
+Change feed of the books table.
+
+Triggers on books append one row per inserted, updated or deleted book to
+book_changes, inside the transaction of the write itself, so the log never
+disagrees with the table. Each entry carries the book as it was written,
+and seq (AUTOINCREMENT, never reused) orders them.
+
+Mirrors catch up with GET /books/changes?since=<seq> and tail the feed
+with GET /books/changes/stream (server-sent events), so syncing costs one
+entry per change instead of one catalog download.
+
+compact() drops entries superseded by a newer one for the same book once
+they are older than CHANGES_RETENTION seconds, then tombstones of that
+age. A client whose since predates the last purged tombstone may have
+missed a deletion; it gets a 410 and must resync from GET /books.
+
+CHANGES_PAGE_SIZE        entries per GET /books/changes page (default: 500)
+CHANGES_MAX_PAGE_SIZE    largest accepted ?limit= (default: 5000)
+CHANGES_RETENTION        seconds of full history kept by compact()
+                         (default: 604800, one week)
+CHANGES_POLL_INTERVAL    seconds between polls of an event stream (default: 1)
+CHANGES_HEARTBEAT        seconds between keep-alive comments (default: 15)
+CHANGES_STREAM_MAX       seconds before an event stream is closed; the
+                         client reconnects with Last-Event-ID (default: 300)
+CHANGES_MAX_STREAMS      event streams open at once per process in the
+                         threaded apps, where each holds a thread (default: 2)
+"""
+
+import os
+import threading
+import time
+
+import click
+
+import queries
+import serialization
+import storage
+
+CHANGES_PAGE_SIZE = int(os.environ.get('CHANGES_PAGE_SIZE', '500'))
+CHANGES_MAX_PAGE_SIZE = int(os.environ.get('CHANGES_MAX_PAGE_SIZE', '5000'))
+CHANGES_RETENTION = float(os.environ.get('CHANGES_RETENTION', str(7 * 24 * 3600)))
+CHANGES_POLL_INTERVAL = float(os.environ.get('CHANGES_POLL_INTERVAL', '1'))
+CHANGES_HEARTBEAT = float(os.environ.get('CHANGES_HEARTBEAT', '15'))
+CHANGES_STREAM_MAX = float(os.environ.get('CHANGES_STREAM_MAX', '300'))
+CHANGES_MAX_STREAMS = int(os.environ.get('CHANGES_MAX_STREAMS', '2'))
+
+_NOW = "(julianday('now') - 2440587.5) * 86400.0"
+
+CHANGES_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS book_changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        book_id INTEGER NOT NULL,
+        op TEXT NOT NULL,
+        title TEXT,
+        author TEXT,
+        year INTEGER,
+        version INTEGER,
+        ts REAL NOT NULL
+    )""",
+    'CREATE INDEX IF NOT EXISTS idx_book_changes_book ON book_changes (book_id, seq)',
+    f"""CREATE TRIGGER IF NOT EXISTS book_changes_insert AFTER INSERT ON books BEGIN
+        INSERT INTO book_changes (book_id, op, title, author, year, version, ts)
+        VALUES (new.id, 'insert', new.title, new.author, new.year, new.version, {_NOW});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS book_changes_update AFTER UPDATE ON books BEGIN
+        INSERT INTO book_changes (book_id, op, title, author, year, version, ts)
+        VALUES (new.id, 'update', new.title, new.author, new.year, new.version, {_NOW});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS book_changes_delete AFTER DELETE ON books BEGIN
+        INSERT INTO book_changes (book_id, op, ts) VALUES (old.id, 'delete', {_NOW});
+    END""",
+    "INSERT OR IGNORE INTO books_meta (key, value) VALUES ('changes_floor', 0)",
+)
+
+CHANGE_COLUMNS = 'seq, op, book_id, title, author, year, version'
+
+
+class ChangesGone(Exception):
+    """since predates compacted deletions; the client must resync"""
+
+    def __init__(self, floor):
+        super().__init__(f"Changes up to seq {floor} have been compacted; resync from GET /books")
+        self.floor = floor
+
+
+def install(conn):
+    """Create the change log and its triggers; needs etags.install first"""
+    for statement in CHANGES_SCHEMA:
+        conn.execute(statement)
+
+
+def record_inserts(conn, after_id):
+    """Log the insertion of the books above after_id, written while
+    book_changes_insert was dropped (see bulk_import.py)"""
+    conn.execute(
+        f"""INSERT INTO book_changes (book_id, op, title, author, year, version, ts)
+            SELECT id, 'insert', title, author, year, version, {_NOW} FROM books WHERE id > ? ORDER BY id""",
+        (after_id,)
+    )
+
+
+def copy_entries(conn, entries):
+    """Insert (seq, book_id, op, title, author, year, version) entries of
+    another instance's log under their own seq (see replication.py)"""
+    conn.executemany(
+        f"""INSERT INTO book_changes (seq, book_id, op, title, author, year, version, ts)
+            VALUES (?, ?, ?, ?, ?, ?, ?, {_NOW})""",
+        entries
+    )
+
+
+def parse_since(raw):
+    if raw is None or raw == '':
+        return 0
+    since = queries.parse_int(raw, 'since')
+    if since < 0:
+        raise queries.QueryError("since must not be negative")
+    return since
+
+
+def parse_limit(raw):
+    if raw is None:
+        return CHANGES_PAGE_SIZE
+    limit = queries.parse_int(raw, 'limit')
+    if limit < 1:
+        raise queries.QueryError("limit must be positive")
+    return min(limit, CHANGES_MAX_PAGE_SIZE)
+
+
+def floor(conn):
+    """Highest seq whose deletion may have been compacted away"""
+    return conn.execute("SELECT value FROM books_meta WHERE key = 'changes_floor'").fetchone()[0]
+
+
+def _entry(row):
+    seq, op, book_id, title, author, year, version = row
+    if op == 'delete':
+        return {"seq": seq, "op": op, "id": book_id, "book": None, "etag": None}
+    return {
+        "seq": seq, "op": op, "id": book_id,
+        "book": {"id": book_id, "title": title, "author": author, "year": year},
+        "etag": f"{book_id}.{version}",
+    }
+
+
+def read(conn, since, limit=CHANGES_PAGE_SIZE):
+    """Entries after since, oldest first, and whether more follow.
+
+    Raises ChangesGone if since predates compacted deletions.
+    """
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    # Same snapshot for the floor check and the entries
+    cursor.execute('BEGIN')
+    try:
+        horizon = floor(conn)
+        if since < horizon:
+            raise ChangesGone(horizon)
+        rows = cursor.execute(
+            f'SELECT {CHANGE_COLUMNS} FROM book_changes WHERE seq > ? ORDER BY seq LIMIT ?', (since, limit + 1)
+        ).fetchall()
+    finally:
+        conn.rollback()
+    return [_entry(row) for row in rows[:limit]], len(rows) > limit
+
+
+def page(conn, since, limit=CHANGES_PAGE_SIZE):
+    """GET /books/changes body as JSON text"""
+    entries, more = read(conn, since, limit)
+    next_since = entries[-1]["seq"] if entries else since
+    return serialization.dumps({"changes": entries, "count": len(entries), "next_since": next_since, "more": more})
+
+
+def compact(conn, retention=CHANGES_RETENTION, now=None):
+    """Drop superseded entries, then tombstones, older than retention
+    seconds; returns the number of each removed. Runs in its own write
+    transaction."""
+    cutoff = (time.time() if now is None else now) - retention
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        superseded = conn.execute(
+            """DELETE FROM book_changes WHERE ts < ? AND seq < (
+                   SELECT max(later.seq) FROM book_changes AS later WHERE later.book_id = book_changes.book_id)""",
+            (cutoff,)
+        ).rowcount
+        # Past this seq a deletion may be gone from the log
+        last_tombstone = conn.execute(
+            "SELECT max(seq) FROM book_changes WHERE op = 'delete' AND ts < ?", (cutoff,)
+        ).fetchone()[0]
+        tombstones = 0
+        if last_tombstone is not None:
+            tombstones = conn.execute(
+                "DELETE FROM book_changes WHERE op = 'delete' AND seq <= ?", (last_tombstone,)
+            ).rowcount
+            conn.execute(
+                "UPDATE books_meta SET value = max(value, ?) WHERE key = 'changes_floor'", (last_tombstone,)
+            )
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return superseded, tombstones
+
+
+# Server-sent events
+
+STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+HEARTBEAT = ': keepalive\n\n'
+
+
+def stream_start(since):
+    """First bytes of an event stream: the reconnect delay and a comment
+    naming the starting point"""
+    return f'retry: {int(CHANGES_POLL_INTERVAL * 1000) or 1000}\n: since {since}\n\n'
+
+
+def format_event(entry):
+    return f'id: {entry["seq"]}\nevent: change\ndata: {serialization.dumps(entry)}\n\n'
+
+
+def format_reset(gone):
+    """Tells the client its position was compacted away; the stream ends"""
+    return f'event: reset\ndata: {serialization.dumps({"error": str(gone), "floor": gone.floor})}\n\n'
+
+
+def stream_since(args, headers):
+    """Starting seq of an event stream: Last-Event-ID on reconnection,
+    ?since= otherwise"""
+    return parse_since(headers.get('Last-Event-ID') or args.get('since'))
+
+
+def iter_events(fetch, since, poll_interval=CHANGES_POLL_INTERVAL, heartbeat=CHANGES_HEARTBEAT,
+                max_duration=CHANGES_STREAM_MAX):
+    """Event stream chunks; fetch(since) returns (entries, more) like read()"""
+    yield stream_start(since)
+    started = last_sent = time.monotonic()
+    while time.monotonic() - started < max_duration:
+        try:
+            entries, more = fetch(since)
+        except ChangesGone as gone:
+            yield format_reset(gone)
+            return
+        if entries:
+            yield ''.join(format_event(entry) for entry in entries)
+            since = entries[-1]["seq"]
+            last_sent = time.monotonic()
+            if more:
+                continue
+        elif time.monotonic() - last_sent >= heartbeat:
+            yield HEARTBEAT
+            last_sent = time.monotonic()
+        time.sleep(poll_interval)
+
+
+class StreamLimit:
+    """Bounds the event streams open in this process"""
+
+    def __init__(self, limit=CHANGES_MAX_STREAMS):
+        self.limit = limit
+        self._slots = threading.BoundedSemaphore(limit)
+        self.rejected = 0
+
+    def acquire(self):
+        """Take a slot without waiting; False if every slot is taken"""
+        if self._slots.acquire(blocking=False):
+            return True
+        self.rejected += 1
+        return False
+
+    def release(self):
+        self._slots.release()
+
+
+def init_app(app, database, pragmas):
+    """Limit the app's event streams and register the compact-changes CLI
+    command"""
+    app.extensions['changefeed_streams'] = StreamLimit()
+
+    @app.cli.command('compact-changes')
+    @click.option('--retention', type=float, default=CHANGES_RETENTION, show_default=True,
+                  help='seconds of full history to keep')
+    def compact_changes(retention):
+        """Compact the change log of books.db"""
+        conn = storage.open_connection(database, pragmas)
+        try:
+            superseded, tombstones = compact(conn, retention)
+        finally:
+            conn.close()
+        click.echo(f'Removed {superseded} superseded entries and {tombstones} tombstones')
@@ -0,0 +1,147 @@
+"""
+Negotiated response compression.
+
+JSON and text responses of at least COMPRESS_MIN_SIZE bytes are sent with
+Content-Encoding br (when the brotli package is installed) or gzip,
+whichever the client's Accept-Encoding prefers. Streamed exports are
+compressed on the fly. An encoded representation gets its own ETag
+(<etag>-gzip, <etag>-br); see etags.is_fresh.
+
+Collection routes mark their response as cacheable with cache_as(); the
+compressed body is then kept in the book cache next to the plain one,
+under the same table version, so repeated reads are not recompressed
+until a write moves the version on.
+
+COMPRESS_MIN_SIZE      smallest body worth compressing (default: 1024)
+COMPRESS_LEVEL         gzip level, 1-9 (default: 6)
+COMPRESS_BROTLI_QUALITY
+                       brotli quality, 0-11 (default: 5)
+"""
+
+import gzip
+import os
+import zlib
+
+from flask import g, request
+
+import cache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', '1024'))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', '6'))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', '5'))
+
+# Server preference, best first
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson')
+# Events must reach the client as they are written, not when a
+# compressor block fills up
+UNCOMPRESSED_TYPES = ('text/event-stream',)
+
+
+def compress(data, encoding, level=COMPRESS_LEVEL, quality=COMPRESS_BROTLI_QUALITY):
+    if encoding == 'br':
+        return brotli.compress(data, quality=quality)
+    # mtime=0 keeps the output, and so its ETag, identical across workers
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def compressor(encoding, level=COMPRESS_LEVEL, quality=COMPRESS_BROTLI_QUALITY):
+    """(process, finish) functions of an incremental compressor"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=quality)
+        return compressor.process, compressor.finish
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: gzip container
+    return compressor.compress, compressor.flush
+
+
+def compress_stream(chunks, encoding, level=COMPRESS_LEVEL, quality=COMPRESS_BROTLI_QUALITY):
+    """Compress an iterable of str/bytes chunks incrementally"""
+    process, finish = compressor(encoding, level, quality)
+    try:
+        for chunk in chunks:
+            data = process(chunk.encode() if isinstance(chunk, str) else chunk)
+            if data:
+                yield data
+        yield finish()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def negotiate():
+    """Encoding to use for the current request, or None"""
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+def compressed_body(data, encoding, book_cache=None, key=None):
+    """data compressed with encoding, through the list cache when key, a
+    (namespace, args, version) tuple, is given"""
+    compressed = book_cache.get_list(*key, encoding=encoding) if key else None
+    if compressed is None:
+        compressed = compress(data, encoding)
+        if key:
+            book_cache.set_list(*key[:2], compressed, key[2], encoding=encoding)
+    return compressed
+
+
+def cache_as(namespace, args, version):
+    """Keep the compressed body of this response in the list cache"""
+    g.compression_cache_key = (namespace, args, version)
+
+
+def compressible_type(mimetype):
+    if mimetype in UNCOMPRESSED_TYPES:
+        return False
+    return mimetype in COMPRESSIBLE_TYPES or mimetype.startswith('text/')
+
+
+def _compressible(response):
+    return (
+        response.status_code in (200, 304)
+        and 'Content-Encoding' not in response.headers
+        and not response.direct_passthrough
+        and compressible_type(response.mimetype)
+    )
+
+
+def compress_response(response):
+    """after_request hook"""
+    if request.method == 'HEAD' or not _compressible(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate()
+    if encoding is None:
+        return response
+
+    etag, weak = response.get_etag()
+    if response.status_code == 304:
+        # Echo the variant the client holds
+        if etag and request.if_none_match.contains_weak(f'{etag}-{encoding}'):
+            response.set_etag(f'{etag}-{encoding}', weak)
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(compressed_body(data, encoding, cache.current_cache, g.get('compression_cache_key')))
+
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        response.set_etag(f'{etag}-{encoding}', weak)
+    return response
+
+
+def init_app(app):
+    """Compress eligible responses of the app"""
+    app.after_request(compress_response)
@@ -3,6 +3,7 @@ Script de test pour vérifier l'accès de l'API à la base de données SQLite.
 Ce script teste la connectivité à la base de données et effectue des opérations CRUD.
 """
 
+import argparse
 import requests
 import json
 import sys
@@ -180,8 +181,22 @@ def test_database_persistence(base_url, api_name):
         print(f"❌ Erreur lors du test de persistance: {e}")
         return False
 
-def main():
+def parse_args(argv=None):
+    """Options de la ligne de commande"""
+    parser = argparse.ArgumentParser(description="Teste l'accès de l'API à la base de données SQLite")
+    parser.add_argument("--api", choices=sorted(API_URLS), action="append",
+                        help="API à tester (répétable, défaut: les deux)")
+    parser.add_argument("--basic-url", default=API_URLS["basic"], help="URL de l'API basique")
+    parser.add_argument("--logging-url", default=API_URLS["with_logging"], help="URL de l'API avec logging")
+    args = parser.parse_args(argv)
+    args.api = args.api or ["basic", "with_logging"]
+    API_URLS["basic"] = args.basic_url
+    API_URLS["with_logging"] = args.logging_url
+    return args
+
+def main(argv=None):
     """Fonction principale"""
+    args = parse_args(argv)
     print_section("🚀 TEST D'ACCÈS À LA BASE DE DONNÉES SQLite")
     
     print("\n📌 Ce script teste:")
@@ -189,21 +204,8 @@ def main():
     print("   2. Les opérations CRUD (Create, Read, Update, Delete)")
     print("   3. La persistance des données")
     
-    # Sélectionner l'API à tester
-    print("\n🔧 APIs disponibles:")
-    print("   1. API basique (port 5000)")
-    print("   2. API avec logging (port 5001)")
-    print("   3. Les deux")
-    
-    choice = input("\nChoisissez une option (1/2/3) [défaut: 3]: ").strip()
-    
-    apis_to_test = []
-    if choice == "1":
-        apis_to_test = [("basic", API_URLS["basic"])]
-    elif choice == "2":
-        apis_to_test = [("with_logging", API_URLS["with_logging"])]
-    else:
-        apis_to_test = [("basic", API_URLS["basic"]), ("with_logging", API_URLS["with_logging"])]
+    # Sélectionner l'API à tester (en argument, pour pouvoir lancer le script sans interaction)
+    apis_to_test = [(name, API_URLS[name]) for name in args.api]
     
     results = {}
     
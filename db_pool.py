@@ -0,0 +1,214 @@
+"""
+SQLite connection pool bound to the Flask application context.
+
+Each request borrows one read-only connection on first use (stored in
+flask.g) and hands it back in teardown_appcontext. Idle connections are
+kept alive so that the next request does not pay sqlite3.connect() again.
+A connection is only ever used by one thread at a time.
+
+Writes go through a single writer connection per process. It is held
+exclusively by the request that asked for it until teardown, so writers
+queue in Python instead of fighting over the SQLite write lock.
+"""
+
+import sqlite3
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from flask import current_app, g
+
+import storage
+
+
+class ConnectionPool:
+    """Bounded pool of reusable read-only SQLite connections"""
+
+    def __init__(self, database, size=8, pragmas=None, factory=sqlite3.Connection):
+        self.database = database
+        self.size = size
+        self.pragmas = storage.load_pragmas() if pragmas is None else pragmas
+        self.factory = factory
+        self.writer = WriteConnection(database, self.pragmas, factory)
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self.in_use = 0
+        self.hits = 0
+        self.misses = 0
+        self.recycled = 0
+        self.discarded = 0
+
+    def connect(self):
+        """Open a new read-only connection configured for the API"""
+        return storage.open_connection(self.database, self.pragmas, readonly=True, factory=self.factory)
+
+    def acquire(self):
+        """Borrow an idle connection, or open a new one if none is available"""
+        with self._lock:
+            self.in_use += 1
+            if self._idle:
+                self.hits += 1
+                return self._idle.pop()
+            self.misses += 1
+        try:
+            return self.connect()
+        except BaseException:
+            with self._lock:
+                self.in_use -= 1
+            raise
+
+    def release(self, conn, broken=False):
+        """Return a connection to the pool, closing it if broken or surplus"""
+        if not broken and conn.in_transaction:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                broken = True
+
+        with self._lock:
+            self.in_use -= 1
+            if broken:
+                self.recycled += 1
+            elif len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+            else:
+                self.discarded += 1
+        conn.close()
+
+    def close(self):
+        """Close every idle connection and the writer"""
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for conn in idle:
+            conn.close()
+        self.writer.close()
+
+    def stats(self):
+        """Snapshot of the pool counters"""
+        with self._lock:
+            return {
+                "size": self.size,
+                "idle": len(self._idle),
+                "in_use": self.in_use,
+                "hits": self.hits,
+                "misses": self.misses,
+                "recycled": self.recycled,
+                "discarded": self.discarded,
+                "writer": self.writer.stats(),
+            }
+
+
+class WriteConnection:
+    """The process-wide writer connection, used by one request at a time"""
+
+    def __init__(self, database, pragmas, factory=sqlite3.Connection):
+        self.database = database
+        self.pragmas = pragmas
+        self.factory = factory
+        self._conn = None
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.recycled = 0
+
+    def acquire(self):
+        """Wait for exclusive use of the writer connection"""
+        self._lock.acquire()
+        try:
+            if self._conn is None:
+                self._conn = storage.open_connection(self.database, self.pragmas, factory=self.factory)
+        except Exception:
+            self._lock.release()
+            raise
+        self.acquired += 1
+        return self._conn
+
+    def release(self, broken=False):
+        """Roll back anything left open and let the next writer in"""
+        try:
+            if not broken and self._conn.in_transaction:
+                try:
+                    self._conn.rollback()
+                except sqlite3.Error:
+                    broken = True
+            if broken:
+                self.recycled += 1
+                self._conn.close()
+                self._conn = None
+        finally:
+            self._lock.release()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def stats(self):
+        return {
+            "acquired": self.acquired,
+            "recycled": self.recycled,
+            "busy": self._lock.locked(),
+        }
+
+
+def init_app(app, database, size=8, pragmas=None, factory=sqlite3.Connection):
+    """Attach a connection pool to the app and release connections on teardown"""
+    pool = ConnectionPool(database, size, pragmas, factory)
+    app.extensions['db_pool'] = pool
+    app.teardown_appcontext(release_connection)
+    return pool
+
+
+def get_pool():
+    return current_app.extensions['db_pool']
+
+
+def _traced(conn):
+    # A profiled request traces its statements (see profiling.py)
+    trace = g.get('sql_trace')
+    if trace is not None:
+        trace.attach(conn)
+    return conn
+
+
+def get_connection():
+    """Read-only connection bound to the current app context"""
+    if 'db_writer' in g:
+        # Read your own writes within the request
+        return g.db_writer
+    if 'db_conn' not in g:
+        g.db_conn = _traced(get_pool().acquire())
+    return g.db_conn
+
+
+def get_write_connection():
+    """The writer connection, held by the current app context until teardown"""
+    if 'db_writer' not in g:
+        g.db_writer = _traced(get_pool().writer.acquire())
+    return g.db_writer
+
+
+@contextmanager
+def pooled_connection(pool=None):
+    """Borrow a read-only connection outside the app context, e.g. for streaming"""
+    pool = pool or get_pool()
+    conn = pool.acquire()
+    broken = False
+    try:
+        yield conn
+    except BaseException as exc:
+        broken = not isinstance(exc, GeneratorExit)
+        raise
+    finally:
+        pool.release(conn, broken=broken)
+
+
+def release_connection(exc=None):
+    """Hand the context's connections back; recycle them if the request failed"""
+    pool = get_pool()
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        pool.release(conn, broken=exc is not None)
+    if g.pop('db_writer', None) is not None:
+        pool.writer.release(broken=exc is not None)
@@ -0,0 +1,112 @@
+"""
+Entity tags for book resources and collections.
+
+Each book carries a version column bumped by every update, and the
+books_meta table holds a change counter bumped once by every write
+transaction. A book's ETag is built from its id and version; a
+collection's ETag from the change counter and the query parameters.
+"""
+
+import hashlib
+from urllib.parse import urlencode
+
+from flask import Response, request
+
+BOOK_COLUMNS = 'id, title, author, year, version'
+
+# compression.py tags an encoded representation as <etag>-<encoding>
+ENCODING_SUFFIXES = ('-gzip', '-br')
+
+
+def install(conn):
+    """Add the version column and the change counter to an existing database"""
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(books)')}
+    if 'version' not in columns:
+        conn.execute('ALTER TABLE books ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+    conn.execute('CREATE TABLE IF NOT EXISTS books_meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+    conn.execute("INSERT OR IGNORE INTO books_meta (key, value) VALUES ('changes', 0)")
+
+
+def bump_changes(conn):
+    """Record a write; call inside the write transaction, before commit"""
+    conn.execute("UPDATE books_meta SET value = value + 1 WHERE key = 'changes'")
+
+
+def changes(conn):
+    return conn.execute("SELECT value FROM books_meta WHERE key = 'changes'").fetchone()[0]
+
+
+def book_etag(row):
+    return f"{row['id']}.{row['version']}"
+
+
+def book_entry(row):
+    """Cacheable {"book": <public fields>, "etag": ...} for a books row"""
+    book = dict(row)
+    del book['version']
+    return {"book": book, "etag": book_etag(row)}
+
+
+def strip_encoding(tag):
+    """The ETag of the unencoded representation"""
+    for suffix in ENCODING_SUFFIXES:
+        if tag.endswith(suffix):
+            return tag[:-len(suffix)]
+    return tag
+
+
+def is_fresh(etag):
+    """Whether the request's If-None-Match holds etag or one of its encoded
+    variants"""
+    return matches(request.if_none_match, etag)
+
+
+def matches(if_none_match, etag):
+    """Whether the parsed If-None-Match holds etag or one of its encoded
+    variants"""
+    if not if_none_match:
+        return False
+    if if_none_match.contains_weak(etag):
+        return True
+    return any(if_none_match.contains_weak(etag + suffix) for suffix in ENCODING_SUFFIXES)
+
+
+def if_match_clause(if_match, book_id):
+    """SQL condition and parameters that restrict a write on books to the
+    versions listed in If-Match; empty when there is no precondition"""
+    if not if_match or if_match.star_tag:
+        return '', ()
+    prefix = f'{book_id}.'
+    tags = [strip_encoding(tag) for tag in if_match.as_set()]
+    versions = [int(tag[len(prefix):]) for tag in tags
+                if tag.startswith(prefix) and tag[len(prefix):].isdigit()]
+    if not versions:
+        return ' AND 0', ()
+    return f' AND version IN ({", ".join("?" * len(versions))})', tuple(versions)
+
+
+def failed_status(conn, book_id, conditional):
+    """Why a write matched no row: 412 if the book exists but failed If-Match,
+    404 otherwise"""
+    if conditional and conn.execute('SELECT 1 FROM books WHERE id = ?', (book_id,)).fetchone():
+        return 412
+    return 404
+
+
+WRITE_ERRORS = {404: "Book not found", 412: "Book has been modified"}
+
+
+def collection_etag(counter, namespace, args):
+    digest = hashlib.sha1(urlencode(sorted(args.items(multi=True))).encode()).hexdigest()[:16]
+    return f"{namespace}.{counter}.{digest}"
+
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def with_etag(response, etag):
+    response.set_etag(etag)
+    return response
@@ -0,0 +1,84 @@
+"""
+Gunicorn settings for the Books API, driven by environment variables.
+
+    gunicorn --config gunicorn.conf.py "app:create_app()"
+    gunicorn --config gunicorn.conf.py --worker-class uvicorn_worker.UvicornWorker "app_async:create_app()"
+
+The asyncio variant (app_async.py) needs the uvicorn worker class; threads
+does not apply to it.
+
+Workers share nothing but books.db and books.db-cache, the invalidation
+log of cache.py: a book written by one worker is dropped from the
+per-process cache of all the others (CACHE_BACKEND=local) before their
+next read of it.
+
+WEB_CONCURRENCY      worker processes (default: 2 x CPU cores + 1)
+GUNICORN_THREADS     threads per worker (default: 4)
+GUNICORN_KEEPALIVE   seconds to hold idle keep-alive connections (default: 5)
+GUNICORN_TIMEOUT     seconds before a silent worker is killed (default: 30)
+GUNICORN_GRACEFUL_TIMEOUT
+                     seconds in-flight requests get to finish on SIGTERM
+                     (default: 30)
+PORT                 listening port (default: 5000)
+METRICS_DIR          directory where workers share their metrics (see
+                     metrics.py); cleared when gunicorn starts
+"""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', '4'))
+worker_class = 'gthread'
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', '5'))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '30'))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+
+# Build the app (and create or upgrade books.db) once in the master instead
+# of racing the schema setup in every worker. Connections are opened lazily,
+# so none is shared across the fork.
+preload_app = True
+
+# Access logging is off unless GUNICORN_ACCESS_LOG names a file (or '-')
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG')
+errorlog = '-'
+
+
+def on_starting(server):
+    """Drop metric snapshots left by workers of a previous run"""
+    import metrics
+    metrics.clear()
+
+
+def post_worker_init(worker):
+    """Start pulling changes right away on a read replica (see
+    replication.py)"""
+    extensions = getattr(getattr(worker, 'wsgi', None), 'extensions', {})
+    replica = extensions.get('replica')
+    if replica is not None:
+        replica.start()
+
+
+def worker_exit(server, worker):
+    """Stop replication, commit queued writes, close the worker's pooled
+    SQLite connections and flush queued log records and metrics on
+    graceful shutdown"""
+    app = getattr(worker, 'wsgi', None)
+    extensions = getattr(app, 'extensions', {})
+    replica = extensions.get('replica')
+    if replica is not None:
+        replica.close()
+    coalescer = extensions.get('write_coalescer')
+    if coalescer is not None:
+        coalescer.close()
+    pool = extensions.get('db_pool')
+    if pool is not None:
+        pool.close()
+    # Workers leave through os._exit(), which skips atexit handlers
+    log_handler = extensions.get('log_pipeline')
+    if log_handler is not None:
+        log_handler.close()
+    registry = extensions.get('metrics')
+    if registry is not None:
+        registry.flush()
@@ -0,0 +1,165 @@
+"""
+Non-blocking logging pipeline for app_with_logging.py.
+
+Request threads only put the LogRecord on a bounded queue; a
+QueueListener thread formats it and writes it to the rotating file and
+the console. Messages use %-style arguments so that nothing is formatted
+unless the record is actually written.
+
+LOG_QUEUE_SIZE     capacity of the queue (default: 10000)
+LOG_QUEUE_POLICY   'drop' (count and discard records when the queue is
+                   full, the default) or 'block' (wait for room)
+LOG_FORMAT         'text' (default) or 'json' for one JSON object per line
+LOG_SAMPLE_<LEVEL> fraction of records kept for a level, e.g.
+                   LOG_SAMPLE_INFO=0.1 keeps one info record in ten;
+                   levels without a setting are always kept
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from flask.logging import default_handler
+
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+LOG_QUEUE_POLICY = os.environ.get('LOG_QUEUE_POLICY', 'drop')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "path": record.pathname,
+            "line": record.lineno,
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of the records of the sampled levels"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno)
+        return rate is None or random.random() < rate
+
+
+def load_sample_rates(environ=None):
+    """{levelno: rate} from the LOG_SAMPLE_<LEVEL> variables"""
+    environ = os.environ if environ is None else environ
+    rates = {}
+    for name in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'):
+        raw = environ.get(f'LOG_SAMPLE_{name}')
+        if raw is not None:
+            rates[logging.getLevelName(name)] = float(raw)
+    return rates
+
+
+class AsyncQueueHandler(QueueHandler):
+    """QueueHandler with a bounded queue, a full-queue policy and its own
+    listener thread"""
+
+    def __init__(self, handlers, maxsize=LOG_QUEUE_SIZE, policy=LOG_QUEUE_POLICY):
+        if policy not in ('drop', 'block'):
+            raise ValueError(f'Unknown LOG_QUEUE_POLICY: {policy}')
+        super().__init__(queue.Queue(maxsize))
+        self.targets = handlers
+        self.policy = policy
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def handle(self, record):
+        # The queue is thread-safe; skip the per-handler lock of Handler.handle
+        if self.filter(record):
+            self.emit(record)
+            return True
+        return False
+
+    def prepare(self, record):
+        # Formatting is left to the listener thread
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        if self.policy == 'block':
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_listener(self):
+        """Start the listener thread, again in each process forked after it"""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # Threads do not survive fork(); neither should the parent's queue
+            self.queue = queue.Queue(self.queue.maxsize)
+            self._listener = QueueListener(self.queue, *self.targets, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def close(self):
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+            self._pid = None
+        super().close()
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "capacity": self.queue.maxsize,
+            "policy": self.policy,
+            "dropped": self.dropped,
+        }
+
+
+def init_app(app, log_file, level=logging.INFO):
+    """Route app.logger through the queue to the log file and the console"""
+    formatter = JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT)
+
+    file_handler = RotatingFileHandler(log_file, maxBytes=10240000, backupCount=10)
+    file_handler.setLevel(level)
+    file_handler.setFormatter(formatter)
+    console_handler = logging.StreamHandler(sys.stderr)
+    console_handler.setLevel(level)
+    console_handler.setFormatter(formatter)
+
+    handler = AsyncQueueHandler([file_handler, console_handler])
+    handler.addFilter(SamplingFilter(load_sample_rates()))
+
+    # app.logger is shared by every app with the same name; keep one pipeline
+    for existing in list(app.logger.handlers):
+        if existing is default_handler or isinstance(existing, AsyncQueueHandler):
+            app.logger.removeHandler(existing)
+            existing.close()
+    app.logger.addHandler(handler)
+    app.logger.setLevel(level)
+    app.extensions['log_pipeline'] = handler
+    atexit.register(handler.close)
+    return handler
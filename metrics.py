@@ -0,0 +1,332 @@
+"""
+Prometheus-style metrics for the Books API, served as text on /metrics.
+
+- books_http_request_duration_seconds: latency histogram per method,
+  route and status (its _count is the request counter)
+- books_http_requests_in_flight: requests being handled
+- books_sqlite_statement_duration_seconds: execution time per statement
+  kind and table, recorded by TimedConnection
+- books_db_pool, books_db_writer, books_cache, books_rate_limit,
+  books_group_commit, books_replication: pool, cache, rate limiter, group
+  commit and read replica counters, read from the app when a snapshot is
+  taken
+
+Recording takes no lock: each thread updates its own shard and shards are
+merged only when a snapshot is taken. With METRICS_DIR set, every process
+also writes its snapshot to that directory (every METRICS_FLUSH_INTERVAL
+seconds and on exit) and /metrics sums the snapshots of all gunicorn
+workers. Gauges of workers that are gone are left out; their histograms
+are kept so that counts never go backwards.
+"""
+
+import bisect
+import glob
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from functools import lru_cache
+
+from flask import Response, g, request
+
+METRICS_DIR = os.environ.get('METRICS_DIR') or None
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+
+HTTP_LATENCY = 'books_http_request_duration_seconds'
+HTTP_IN_FLIGHT = 'books_http_requests_in_flight'
+SQL_LATENCY = 'books_sqlite_statement_duration_seconds'
+
+BUCKETS = {
+    HTTP_LATENCY: (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+    SQL_LATENCY: (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+}
+
+HELP = {
+    HTTP_LATENCY: 'Request latency by method, route and status',
+    HTTP_IN_FLIGHT: 'Requests currently being handled',
+    SQL_LATENCY: 'SQLite statement execution time by statement kind and table',
+    'books_db_pool': 'Read-only connection pool counters',
+    'books_db_writer': 'Writer connection counters',
+    'books_cache': 'Book cache counters',
+    'books_rate_limit': 'Rate limiter and write admission counters',
+    'books_group_commit': 'Group commit counters',
+    'books_replication': 'Read replica counters',
+}
+
+_STATEMENT_RE = re.compile(r'^\s*(\w+)')
+_TABLE_RE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE|ON)\s+(\w+)', re.IGNORECASE)
+
+
+@lru_cache(maxsize=512)
+def statement_labels(sql):
+    """Low-cardinality labels for an SQL statement: its verb and first table"""
+    verb = _STATEMENT_RE.match(sql)
+    table = _TABLE_RE.search(sql)
+    return (
+        ('statement', verb.group(1).upper() if verb else ''),
+        ('table', table.group(1) if table else ''),
+    )
+
+
+class _Shard:
+    """Metrics recorded by one thread"""
+
+    __slots__ = ('gauges', 'histograms')
+
+    def __init__(self):
+        self.gauges = {}
+        self.histograms = {}
+
+
+class Registry:
+    """Per-process metrics, recorded into per-thread shards"""
+
+    def __init__(self, directory=METRICS_DIR, interval=METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.collectors = {}
+        self._lock = threading.Lock()
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # Shards and the flush thread belong to the process that made them
+        self._local = threading.local()
+        self._shards = []
+        self._flusher = None
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._shards.append(shard)
+                if self.directory and self._flusher is None:
+                    self._flusher = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+                    self._flusher.start()
+        return shard
+
+    def observe(self, name, labels, value):
+        """Record value in the histogram name{labels}"""
+        histograms = self._shard().histograms
+        hist = histograms.get((name, labels))
+        if hist is None:
+            buckets = BUCKETS[name]
+            # Per-bucket counts, the +Inf bucket, then the sum
+            hist = histograms[(name, labels)] = [0] * (len(buckets) + 1) + [0.0]
+        hist[bisect.bisect_left(BUCKETS[name], value)] += 1
+        hist[-1] += value
+
+    def add(self, name, labels, delta):
+        """Move the gauge name{labels} by delta"""
+        gauges = self._shard().gauges
+        gauges[(name, labels)] = gauges.get((name, labels), 0) + delta
+
+    def snapshot(self):
+        """This process's metrics, as a JSON-serializable dict"""
+        gauges = {}
+        histograms = {}
+        for shard in list(self._shards):
+            for key, value in list(shard.gauges.items()):
+                gauges[key] = gauges.get(key, 0) + value
+            for key, hist in list(shard.histograms.items()):
+                _merge(histograms, key, hist)
+        for name, collect in list(self.collectors.items()):
+            for stat, value in collect().items():
+                if isinstance(value, (bool, int, float)):
+                    gauges[(name, (('stat', stat),))] = int(value) if isinstance(value, bool) else value
+        return {
+            "pid": os.getpid(),
+            "gauges": [[name, labels, value] for (name, labels), value in gauges.items()],
+            "histograms": [[name, labels, hist] for (name, labels), hist in histograms.items()],
+        }
+
+    def flush(self):
+        """Write this process's snapshot to the metrics directory"""
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.metrics-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, os.path.join(self.directory, f'metrics-{os.getpid()}.json'))
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def collect(self):
+        """Merged (gauges, histograms) of every worker process"""
+        if not self.directory:
+            snapshots = [self.snapshot()]
+        else:
+            self.flush()
+            snapshots = []
+            for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+                try:
+                    with open(path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+
+        gauges = {}
+        histograms = {}
+        for snap in snapshots:
+            alive = snap["pid"] == os.getpid() or _pid_alive(snap["pid"])
+            for name, labels, value in snap["gauges"]:
+                if alive:
+                    key = (name, _labels(labels))
+                    gauges[key] = gauges.get(key, 0) + value
+            for name, labels, hist in snap["histograms"]:
+                _merge(histograms, (name, _labels(labels)), hist)
+        return gauges, histograms
+
+    def render(self):
+        """Prometheus text exposition format"""
+        gauges, histograms = self.collect()
+        lines = []
+        for name in sorted({name for name, _ in gauges}):
+            lines += [f'# HELP {name} {HELP.get(name, name)}', f'# TYPE {name} gauge']
+            for (metric, labels), value in sorted(gauges.items()):
+                if metric == name:
+                    lines.append(f'{name}{_format_labels(labels)} {value}')
+        for name in sorted({name for name, _ in histograms}):
+            lines += [f'# HELP {name} {HELP.get(name, name)}', f'# TYPE {name} histogram']
+            buckets = BUCKETS[name]
+            for (metric, labels), hist in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                count = 0
+                for bound, n in zip(buckets + ('+Inf',), hist[:-1]):
+                    count += n
+                    lines.append(f'{name}_bucket{_format_labels(labels + (("le", str(bound)),))} {count}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {hist[-1]}')
+                lines.append(f'{name}_count{_format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _merge(histograms, key, hist):
+    merged = histograms.get(key)
+    if merged is None:
+        histograms[key] = list(hist)
+    else:
+        for i, value in enumerate(hist):
+            merged[i] += value
+
+
+def _labels(pairs):
+    return tuple(tuple(pair) for pair in pairs)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def clear(directory=METRICS_DIR):
+    """Remove snapshots left by a previous run; call before workers start"""
+    if directory:
+        for path in glob.glob(os.path.join(directory, 'metrics-*.json')):
+            os.remove(path)
+
+
+REGISTRY = Registry()
+
+
+class TimedCursor(sqlite3.Cursor):
+    """sqlite3 cursor that records how long each statement takes to
+    execute, for statements run through conn.cursor()"""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            REGISTRY.observe(SQL_LATENCY, statement_labels(sql), time.perf_counter() - start)
+
+    def executemany(self, sql, parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            REGISTRY.observe(SQL_LATENCY, statement_labels(sql), time.perf_counter() - start)
+
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3 connection that records how long each statement takes to
+    execute (not to fetch the remaining rows), whether it runs through
+    the connection or one of its cursors"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            REGISTRY.observe(SQL_LATENCY, statement_labels(sql), time.perf_counter() - start)
+
+    def executemany(self, sql, parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            REGISTRY.observe(SQL_LATENCY, statement_labels(sql), time.perf_counter() - start)
+
+
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    REGISTRY.add(HTTP_IN_FLIGHT, (), 1)
+
+
+def _record_request(response):
+    start = g.get('metrics_start')
+    if start is not None:
+        rule = request.url_rule.rule if request.url_rule else 'unmatched'
+        labels = (('method', request.method), ('route', rule), ('status', str(response.status_code)))
+        REGISTRY.observe(HTTP_LATENCY, labels, time.perf_counter() - start)
+    return response
+
+
+def _end_request(exc=None):
+    if g.pop('metrics_start', None) is not None:
+        REGISTRY.add(HTTP_IN_FLIGHT, (), -1)
+
+
+def init_app(app, registry=REGISTRY):
+    """Time every request and export the app's pool and cache counters"""
+    app.before_request(_start_request)
+    app.after_request(_record_request)
+    app.teardown_request(_end_request)
+
+    pool = app.extensions['db_pool']
+    book_cache = app.extensions['book_cache']
+    registry.collectors['books_db_pool'] = lambda: {k: v for k, v in pool.stats().items() if k != 'writer'}
+    registry.collectors['books_db_writer'] = pool.writer.stats
+    registry.collectors['books_cache'] = book_cache.stats
+    app.extensions['metrics'] = registry
+    return registry
+
+
+def metrics_response(registry=REGISTRY):
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
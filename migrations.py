@@ -0,0 +1,179 @@
+"""
+Versioned schema migrations of books.db.
+
+The schema version is kept in PRAGMA user_version. On startup migrate()
+applies the steps of migration_plan() above it, in order. Each step runs
+in its own write transaction together with the version bump, so a step
+is either recorded as applied or not applied at all. A file lock next to
+the database serializes processes starting together (gunicorn without
+preload_app, several uvicorn workers), so only one of them migrates and
+the others find the work done.
+
+A step is an SQL statement, a callable taking the connection, or a tuple
+of those. Steps are idempotent, so a database created before versioning
+(user_version 0, tables already there) is adopted by replaying them.
+
+Long data changes commit in batches through storage.run_batches: the
+search index of an existing catalog is filled that way, so writers are
+held up for one batch at a time and, in WAL mode, readers not at all. A
+batched step must record its progress in the database; if it is
+interrupted it resumes from there on the next start. Adding a column with
+a constant default (etags) only rewrites the schema, never the rows. An
+index build is a single statement; it holds the write lock while it runs
+but does not block readers.
+
+Step 1 runs INIT_SQL_PATH on a new database only, creating the books
+table and its sample rows.
+"""
+
+import fcntl
+import os
+import sqlite3
+from contextlib import contextmanager
+from functools import partial
+
+import click
+
+import changefeed
+import etags
+import queries
+import search
+import storage
+
+
+class MigrationError(RuntimeError):
+    """The database cannot be brought to the schema of this code"""
+
+
+def baseline(conn, init_sql):
+    """Create the books table and its sample rows from init_sql, unless the
+    database already has a books table"""
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'books'").fetchone():
+        return
+    with open(init_sql, 'r') as f:
+        script = f.read()
+    # executescript() would commit the step's transaction; run the
+    # statements one by one instead
+    for statement in split_statements(script):
+        conn.execute(statement)
+
+
+def split_statements(script):
+    """Complete SQL statements of a script"""
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement
+            statement = ''
+    rest = [line for line in statement.splitlines() if line.strip() and not line.lstrip().startswith('--')]
+    if rest:
+        raise MigrationError(f'Incomplete SQL statement at the end of the script: {statement.strip()!r}')
+
+
+def migration_plan(init_sql):
+    """(version, description, step) of every migration, oldest first.
+    Append new steps; never renumber or edit one that has shipped."""
+    return (
+        (1, 'books table', partial(baseline, init_sql=init_sql)),
+        (2, 'listing indexes', queries.BOOK_INDEXES),
+        (3, 'full-text search index', search.install),
+        (4, 'book versions and change counter', etags.install),
+        (5, 'change log', changefeed.install),
+    )
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+@contextmanager
+def migration_lock(database):
+    """Exclusive lock held by the process migrating database"""
+    with open(f'{database}.migrate.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _run(conn, step):
+    if callable(step):
+        step(conn)
+    elif isinstance(step, str):
+        conn.execute(step)
+    else:
+        for statement in step:
+            _run(conn, statement)
+
+
+def apply(conn, version, step):
+    """Run step and record version, in one write transaction unless the
+    step commits batches of its own"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        _run(conn, step)
+        if not conn.in_transaction:
+            conn.execute('BEGIN IMMEDIATE')
+        conn.execute(f'PRAGMA user_version = {int(version)}')
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def migrate(database, pragmas, init_sql):
+    """Bring database to the latest schema version, creating it if needed;
+    returns the (version, description) of the migrations applied"""
+    os.makedirs(os.path.dirname(os.path.abspath(database)), exist_ok=True)
+    plan = migration_plan(init_sql)
+    latest = plan[-1][0]
+    applied = []
+    with migration_lock(database):
+        conn = storage.open_connection(database, pragmas)
+        try:
+            current = schema_version(conn)
+            if current > latest:
+                raise MigrationError(
+                    f'{database} is at schema version {current}, newer than this code ({latest})')
+            for version, description, step in plan:
+                if version > current:
+                    apply(conn, version, step)
+                    applied.append((version, description))
+        finally:
+            conn.close()
+    return applied
+
+
+def status(database, pragmas, init_sql):
+    """Current schema version and the (version, description) still pending"""
+    current = 0
+    if os.path.exists(database):
+        conn = storage.open_connection(database, pragmas, readonly=True)
+        try:
+            current = schema_version(conn)
+        finally:
+            conn.close()
+    return current, [(version, description) for version, description, _ in migration_plan(init_sql)
+                     if version > current]
+
+
+def init_app(app, database, pragmas, init_sql):
+    """Register the migrate CLI command"""
+
+    @app.cli.command('migrate')
+    @click.option('--status', 'show_status', is_flag=True, help='list pending migrations without applying them')
+    def migrate_command(show_status):
+        """Apply pending schema migrations to books.db"""
+        if show_status:
+            current, pending = status(database, pragmas, init_sql)
+            click.echo(f'Schema version {current}')
+            for version, description in pending:
+                click.echo(f'  pending {version}: {description}')
+            return
+        applied = migrate(database, pragmas, init_sql)
+        for version, description in applied:
+            click.echo(f'Applied {version}: {description}')
+        if not applied:
+            click.echo('Schema is up to date')
@@ -0,0 +1,193 @@
+"""
+Liveness and readiness probes.
+
+GET /health/live answers as long as the process can handle a request and
+touches nothing else: failing it means the process is wedged and should
+be restarted.
+
+GET /health/ready answers 200 when every readiness check passes and 503
+otherwise, so a load balancer stops sending traffic to an instance that
+cannot serve it. GET /health returns the same report with the pool and
+cache counters. The checks:
+
+- database: a read on a read-only probe connection; fails if books.db
+  cannot be read within HEALTH_DB_TIMEOUT seconds. It never takes the
+  write lock, so a busy writer does not make a loaded instance look
+  unready.
+- disk: free space on the volume of books.db
+- writes: the writer as the group-commit queue sees it (see
+  group_commit.py) and the admitted writes (see ratelimit.py); fails past
+  HEALTH_MAX_WRITE_QUEUE queued jobs, or when a commit has been running
+  for longer than a route waits for it. The error of the last failed
+  batch is reported until a batch commits.
+- db_pool: read connections in use against the pool size, reported only
+  (the pool opens extra connections rather than making readers wait)
+
+plus the checks an app adds, such as its log directory.
+
+A report is reused for HEALTH_CACHE_TTL seconds and only one request at
+a time computes a new one, so frequent probes cost one check per
+interval.
+
+HEALTH_DB_TIMEOUT        seconds the database probe may take (default: 0.5)
+HEALTH_MIN_FREE_MB       free space a volume needs to stay ready
+                         (default: 100)
+HEALTH_MAX_WRITE_QUEUE   queued writes past which the instance is not
+                         ready (default: 1000)
+HEALTH_CACHE_TTL         seconds a readiness report is reused (default: 2)
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app, jsonify
+
+import storage
+
+HEALTH_DB_TIMEOUT = float(os.environ.get('HEALTH_DB_TIMEOUT', '0.5'))
+HEALTH_MIN_FREE_MB = float(os.environ.get('HEALTH_MIN_FREE_MB', '100'))
+HEALTH_MAX_WRITE_QUEUE = int(os.environ.get('HEALTH_MAX_WRITE_QUEUE', '1000'))
+HEALTH_CACHE_TTL = float(os.environ.get('HEALTH_CACHE_TTL', '2'))
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+def database_check(database, pragmas, timeout=HEALTH_DB_TIMEOUT):
+    """Check that books.db answers a read in time"""
+    def check():
+        started = time.monotonic()
+        deadline = started + timeout
+        conn = storage.open_connection(database, dict(pragmas, busy_timeout=str(int(timeout * 1000))),
+                                       readonly=True)
+        try:
+            # Abort anything that outlives the deadline
+            conn.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+            conn.execute('SELECT 1 FROM books_meta').fetchone()
+        finally:
+            conn.close()
+        return {"ok": True, "read_ms": _ms(time.monotonic() - started)}
+    return check
+
+
+def disk_check(path, min_free_mb=HEALTH_MIN_FREE_MB):
+    """Check the free space of the volume holding path"""
+    def check():
+        usage = shutil.disk_usage(path)
+        free_mb = usage.free / 2 ** 20
+        return {"ok": free_mb >= min_free_mb, "free_mb": round(free_mb, 1),
+                "used_percent": round(100 * (usage.total - usage.free) / usage.total, 1)}
+    return check
+
+
+def writable_check(directory, min_free_mb=HEALTH_MIN_FREE_MB):
+    """Check that a file can be created in directory, and its free space"""
+    disk = disk_check(directory, min_free_mb)
+
+    def check():
+        with tempfile.TemporaryFile(dir=directory):
+            pass
+        return disk()
+    return check
+
+
+def pool_check(pool):
+    def check():
+        stats = pool.stats()
+        return {"ok": True, "in_use": stats["in_use"], "size": stats["size"],
+                "saturation": round(stats["in_use"] / stats["size"], 2) if stats["size"] else None,
+                "writer_busy": stats["writer"]["busy"]}
+    return check
+
+
+def writes_check(coalescer, limiter=None, max_queue=HEALTH_MAX_WRITE_QUEUE):
+    def check():
+        result = coalescer.health()
+        result["ok"] = result["queued"] <= max_queue and result["commit_seconds"] < coalescer.timeout
+        if limiter is not None:
+            stats = limiter.stats()
+            result.update(in_flight=stats["writes_in_flight"], max_in_flight=stats["max_writes"])
+        return result
+    return check
+
+
+class Readiness:
+    """Named checks run together, their report cached for ttl seconds.
+
+    A check returns a dict with an "ok" entry; one that raises fails with
+    the error as its report.
+    """
+
+    def __init__(self, checks=None, ttl=HEALTH_CACHE_TTL):
+        self.checks = dict(checks or {})
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._report = None
+        self._expires = 0.0
+        self.runs = 0
+
+    def add(self, name, check):
+        self.checks[name] = check
+
+    def report(self):
+        """The latest report, recomputed if it is older than ttl"""
+        with self._lock:
+            if self._report is None or time.monotonic() >= self._expires:
+                self._report = self._run()
+                self._expires = time.monotonic() + self.ttl
+            return self._report
+
+    def _run(self):
+        results = {}
+        for name, check in self.checks.items():
+            started = time.monotonic()
+            try:
+                result = check()
+            except Exception as exc:
+                result = {"ok": False, "error": str(exc)}
+            result["latency_ms"] = _ms(time.monotonic() - started)
+            results[name] = result
+        self.runs += 1
+        ready = all(result["ok"] for result in results.values())
+        return {
+            "status": "ready" if ready else "unavailable",
+            "checked_at": datetime.now().isoformat(),
+            "checks": results,
+        }
+
+
+def liveness():
+    return {"status": "alive", "timestamp": datetime.now().isoformat()}
+
+
+def status_code(report):
+    return 200 if report["status"] == "ready" else 503
+
+
+def readiness_response():
+    report = current_app.extensions['readiness'].report()
+    return jsonify(report), status_code(report)
+
+
+def default_checks(database, pragmas, pool, coalescer, limiter=None):
+    """The readiness checks every variant of the API runs"""
+    return {
+        "database": database_check(database, pragmas),
+        "disk": disk_check(os.path.dirname(os.path.abspath(database))),
+        "writes": writes_check(coalescer, limiter),
+        "db_pool": pool_check(pool),
+    }
+
+
+def init_app(app, database, pragmas):
+    """Attach the readiness checks of the app; call after db_pool,
+    ratelimit and group_commit"""
+    readiness = Readiness(default_checks(database, pragmas, app.extensions['db_pool'],
+                                         app.extensions['write_coalescer'], app.extensions.get('rate_limiter')))
+    app.extensions['readiness'] = readiness
+    return readiness
@@ -0,0 +1,330 @@
+"""
+On-demand profiling of single requests.
+
+A request is profiled when it carries "X-Profile: sample" (or "cprofile",
+or any other value for PROFILE_MODE) with "Authorization: Bearer
+<ADMIN_TOKEN>", or when it is drawn at random, a PROFILE_RATE fraction of
+all requests. With ADMIN_TOKEN unset and PROFILE_RATE at 0 no hook is
+registered at all, so profiling costs nothing until it is turned on; once
+on, a request that is not profiled only pays a header lookup.
+
+Two profilers:
+
+- sample: a thread records the stack of the request's thread every
+  PROFILE_INTERVAL seconds and writes <name>.collapsed, one "frame;frame
+  count" line per distinct stack, the input of flamegraph.pl and
+  speedscope. Cheap enough to leave PROFILE_RATE on.
+- cprofile: every Python and C call is counted and timed and written to
+  <name>.prof, for pstats or snakeviz. Exact call counts, but it slows the
+  request down several times.
+
+Either way every statement the request runs on its pooled connections is
+traced with sqlite3's set_trace_callback, along with the statements its
+triggers and the search index ran on its behalf. A statement is timed
+from its start to the start of the next one (or the end of the request),
+which includes fetching its rows and the Python code that consumes them.
+<name>.json holds the request, its wall-clock and CPU time, the SQL
+trace and its total, and the files written. Single-book writes run on
+the writer connection through group_commit.py and are not traced: with
+GROUP_COMMIT=on they show up as a wait for the group-commit thread, with
+it off in the profile only. A streamed body (/books/export,
+/books/changes/stream) is produced after the profile ends.
+
+One request at a time is profiled per process; a request asking for a
+profile meanwhile is served without one. The response of a profiled
+request carries X-Profile with the name of its files. Only the
+PROFILE_KEEP newest profiles are kept.
+
+PROFILE_DIR              where profiles are written (default: profiles/
+                         next to books.db)
+PROFILE_RATE             fraction of requests profiled without being asked
+                         (default: 0)
+PROFILE_MODE             profiler of sampled requests and of "X-Profile: 1"
+                         (default: sample)
+PROFILE_INTERVAL         seconds between two stack samples (default: 0.001)
+PROFILE_KEEP             profiles kept, the oldest are removed first
+                         (default: 200)
+"""
+
+import cProfile
+import glob
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from flask import current_app, g, request
+
+import snapshot
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR') or None
+PROFILE_RATE = float(os.environ.get('PROFILE_RATE', '0'))
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'sample')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', '0.001'))
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', '200'))
+
+PROFILE_HEADER = 'X-Profile'
+MODES = ('sample', 'cprofile')
+# Statements kept in the trace of one request, and distinct nested
+# statements kept per statement
+MAX_STATEMENTS = 1000
+MAX_NESTED = 20
+
+
+def profile_dir(database):
+    return PROFILE_DIR or os.path.join(os.path.dirname(os.path.abspath(database)), 'profiles')
+
+
+@lru_cache(maxsize=4096)
+def frame_label(code):
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class StackSampler:
+    """Samples the stack of one thread from a background thread"""
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='books-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        return sum(self.stacks.values())
+
+
+class SQLTrace:
+    """Statements run on the connections attached to it, with their start
+    offsets. Statements SQLite runs on behalf of another one (triggers,
+    the search index) are counted under it."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = []
+        self.dropped = 0
+        self._connections = []
+
+    def attach(self, conn):
+        conn.set_trace_callback(self._trace)
+        self._connections.append(conn)
+
+    def detach(self):
+        for conn in self._connections:
+            conn.set_trace_callback(None)
+        self._connections = []
+
+    def _trace(self, sql):
+        if sql.startswith('-- '):
+            if self.statements:
+                nested = self.statements[-1][2]
+                if sql in nested or len(nested) < MAX_NESTED:
+                    nested[sql] += 1
+        elif len(self.statements) < MAX_STATEMENTS:
+            self.statements.append((time.perf_counter(), sql, Counter()))
+        else:
+            self.dropped += 1
+
+    def report(self, ended):
+        """Each statement with its start and time until the next one, in ms"""
+        statements = []
+        for index, (started, sql, nested) in enumerate(self.statements):
+            until = self.statements[index + 1][0] if index + 1 < len(self.statements) else ended
+            statement = {"start_ms": _ms(started - self.started), "ms": _ms(until - started), "sql": sql}
+            if nested:
+                statement["nested"] = dict(nested.most_common())
+            statements.append(statement)
+        return {
+            "count": len(statements) + self.dropped,
+            "ms": round(sum(s["ms"] for s in statements), 3),
+            "statements": statements,
+        }
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+class RequestProfile:
+    """The profiler and SQL trace of one request"""
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.sql = SQLTrace()
+        self.profiler = None
+        self.sampler = None
+
+    def start(self):
+        self.started_at = datetime.now(timezone.utc)
+        self.cpu = time.thread_time()
+        self.started = time.perf_counter()
+        if self.mode == 'cprofile':
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            self.sampler = StackSampler(threading.get_ident())
+            self.sampler.start()
+        self.sql.started = self.started
+
+    def stop(self):
+        self.ended = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.disable()
+        else:
+            self.sampler.stop()
+        self.cpu = time.thread_time() - self.cpu
+        self.sql.detach()
+
+    def write(self, directory, name, summary):
+        """Write the profile files of the request; returns the summary"""
+        base = os.path.join(directory, name)
+        summary.update(
+            mode=self.mode,
+            started=self.started_at.isoformat(),
+            wall_ms=_ms(self.ended - self.started),
+            cpu_ms=_ms(self.cpu),
+            sql=self.sql.report(self.ended),
+        )
+        if self.profiler is not None:
+            self.profiler.dump_stats(base + '.prof')
+            summary["files"] = [name + '.prof', name + '.json']
+        else:
+            summary["samples"] = self.sampler.write(base + '.collapsed')
+            summary["files"] = [name + '.collapsed', name + '.json']
+        with open(base + '.json', 'w') as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+
+def prune(directory, keep=PROFILE_KEEP):
+    """Remove the files of all but the keep newest profiles of directory"""
+    summaries = sorted(glob.glob(os.path.join(directory, '*.json')), reverse=True)
+    for path in summaries[keep:]:
+        base = path[:-len('.json')]
+        for suffix in ('.json', '.collapsed', '.prof'):
+            try:
+                os.remove(base + suffix)
+            except FileNotFoundError:
+                # Not written in this mode, or pruned by another worker
+                pass
+
+
+class Profiler:
+    """Decides which requests are profiled and writes their profiles"""
+
+    def __init__(self, directory, rate=PROFILE_RATE, mode=PROFILE_MODE, token=snapshot.ADMIN_TOKEN,
+                 keep=PROFILE_KEEP):
+        self.directory = directory
+        self.rate = rate
+        self.mode = mode
+        self.token = token
+        self.keep = keep
+        self._busy = threading.Lock()
+        self._count = 0
+
+    def select(self, header, authorization):
+        """The mode to profile a request in, or None"""
+        if header is not None:
+            if not snapshot.authorized(authorization, self.token):
+                return None
+            mode = header.strip().lower()
+            return mode if mode in MODES else self.mode
+        if self.rate and random.random() < self.rate:
+            return self.mode
+        return None
+
+    def begin(self, mode):
+        """A started RequestProfile, or None while another one runs"""
+        if not self._busy.acquire(blocking=False):
+            return None
+        profile = RequestProfile(mode)
+        profile.start()
+        return profile
+
+    def finish(self, profile, summary):
+        """Stop profile and write it; returns the name of its files"""
+        try:
+            profile.stop()
+            self._count += 1
+            name = f"{profile.started_at:%Y%m%dT%H%M%S%fZ}-{os.getpid()}-{self._count}"
+            os.makedirs(self.directory, exist_ok=True)
+            profile.write(self.directory, name, summary)
+            prune(self.directory, self.keep)
+            return name
+        finally:
+            self._busy.release()
+
+
+def _request_summary(status):
+    return {
+        "method": request.method,
+        "path": request.full_path.rstrip('?'),
+        "route": request.url_rule.rule if request.url_rule else None,
+        "status": status,
+    }
+
+
+def _start_profile():
+    profiler = current_app.extensions['profiler']
+    mode = profiler.select(request.headers.get(PROFILE_HEADER), request.headers.get('Authorization'))
+    if mode is None:
+        return
+    profile = profiler.begin(mode)
+    if profile is not None:
+        g.profile = profile
+        # Picked up by db_pool when the request borrows a connection
+        g.sql_trace = profile.sql
+
+
+def _end_profile(response):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        name = current_app.extensions['profiler'].finish(profile, _request_summary(response.status_code))
+        response.headers[PROFILE_HEADER] = name
+    return response
+
+
+def _abort_profile(exc=None):
+    # The request failed before a response was made
+    profile = g.pop('profile', None)
+    if profile is not None:
+        current_app.extensions['profiler'].finish(profile, _request_summary(500))
+
+
+def init_app(app, database, rate=PROFILE_RATE, token=snapshot.ADMIN_TOKEN):
+    """Profile requests on demand; call right after db_pool, so that the
+    profile covers every other hook. Registers nothing while profiling
+    cannot be asked for."""
+    if not rate and token is None:
+        return None
+    profiler = Profiler(profile_dir(database), rate=rate, token=token)
+    app.extensions['profiler'] = profiler
+    app.before_request(_start_profile)
+    app.after_request(_end_profile)
+    app.teardown_request(_abort_profile)
+    return profiler
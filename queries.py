@@ -0,0 +1,278 @@
+"""
+SQL building blocks for the books listing endpoints.
+
+Listings use keyset pagination (WHERE (sort, id) > (?, ?) ORDER BY sort, id
+LIMIT ?) so that every page costs the same, however deep into the table it
+is. Every filter and sort key is backed by one of BOOK_INDEXES.
+"""
+
+import base64
+import json
+import os
+import sys
+
+import serialization
+
+BOOK_FIELDS = ('id', 'title', 'author', 'year')
+SORT_KEYS = ('id', 'title', 'author', 'year')
+DEFAULT_PAGE_SIZE = int(os.environ.get('BOOKS_PAGE_SIZE', '100'))
+MAX_PAGE_SIZE = int(os.environ.get('BOOKS_MAX_PAGE_SIZE', '1000'))
+# Integers SQLite can bind; larger ones raise OverflowError
+SQLITE_MIN_INT = -2 ** 63
+SQLITE_MAX_INT = 2 ** 63 - 1
+EXPORT_BATCH_SIZE = 1000
+
+# Secondary indexes backing the filters and sort keys below. Each one ends
+# with the implicit rowid, so "ORDER BY <column>, id" is served in order.
+BOOK_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS idx_books_author ON books (author)',
+    'CREATE INDEX IF NOT EXISTS idx_books_year ON books (year)',
+    'CREATE INDEX IF NOT EXISTS idx_books_title ON books (title)',
+)
+
+# Index used for a filtered column, most selective filter first. With
+# "ORDER BY id LIMIT n" the planner may otherwise prefer walking the table
+# in rowid order, which degrades to a full scan on sparse matches.
+FILTER_INDEXES = {
+    'author': 'idx_books_author',
+    'title': 'idx_books_title',
+    'year': 'idx_books_year',
+}
+
+
+class QueryError(ValueError):
+    """Invalid listing parameters, reported to the client as a 400"""
+
+
+def parse_fields(raw, required=('id',)):
+    """Columns requested with ?fields=, always including the required ones"""
+    if not raw:
+        return BOOK_FIELDS
+    requested = [f.strip() for f in raw.split(',') if f.strip()]
+    unknown = [f for f in requested if f not in BOOK_FIELDS]
+    if unknown:
+        raise QueryError(f"Unknown fields: {', '.join(unknown)}")
+    return tuple(f for f in BOOK_FIELDS if f in required or f in requested)
+
+
+def parse_limit(raw):
+    if raw is None:
+        return DEFAULT_PAGE_SIZE
+    limit = parse_int(raw, 'limit')
+    if limit < 1:
+        raise QueryError("limit must be positive")
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def parse_int(raw, name):
+    try:
+        value = int(raw)
+    except ValueError:
+        raise QueryError(f"{name} must be an integer")
+    return check_int(value, name)
+
+
+def check_int(value, name):
+    """value, if SQLite can bind it"""
+    if not SQLITE_MIN_INT <= value <= SQLITE_MAX_INT:
+        raise QueryError(f"{name} is out of range")
+    return value
+
+
+def parse_sort(raw):
+    """?sort=<key> or ?sort=-<key>, as (column, descending)"""
+    if not raw:
+        return 'id', False
+    descending = raw.startswith('-')
+    key = raw.lstrip('-')
+    if key not in SORT_KEYS:
+        raise QueryError(f"Cannot sort by {key}")
+    return key, descending
+
+
+def prefix_upper_bound(prefix):
+    """Smallest string greater than every string starting with prefix, or
+    None if there is none (prefix is only U+10FFFF characters)"""
+    prefix = prefix.rstrip(chr(sys.maxunicode))
+    if not prefix:
+        return None
+    code = ord(prefix[-1]) + 1
+    if 0xD800 <= code <= 0xDFFF:
+        # Surrogates cannot be bound as text; skip to the next character
+        code = 0xE000
+    return prefix[:-1] + chr(code)
+
+
+def parse_filters(args):
+    """WHERE clauses, parameters and filtered columns for the filter
+    query parameters"""
+    clauses, params, columns = [], [], set()
+    if args.get('author'):
+        clauses.append('author = ?')
+        params.append(args['author'])
+        columns.add('author')
+    if args.get('year_min') is not None:
+        clauses.append('year >= ?')
+        params.append(parse_int(args['year_min'], 'year_min'))
+        columns.add('year')
+    if args.get('year_max') is not None:
+        clauses.append('year <= ?')
+        params.append(parse_int(args['year_max'], 'year_max'))
+        columns.add('year')
+    if args.get('title_prefix'):
+        # A range instead of LIKE 'x%' so the title index can be searched
+        prefix = args['title_prefix']
+        upper = prefix_upper_bound(prefix)
+        if upper is None:
+            clauses.append('title >= ?')
+            params.append(prefix)
+        else:
+            clauses.append('title >= ? AND title < ?')
+            params.extend([prefix, upper])
+        columns.add('title')
+    return clauses, params, columns
+
+
+def choose_index(columns, sort):
+    """Index to search for the given filtered columns and sort key"""
+    if sort in columns:
+        return FILTER_INDEXES[sort]
+    for column, index in FILTER_INDEXES.items():
+        if column in columns:
+            return index
+    return None
+
+
+def encode_cursor(sort, after):
+    """next_after for the (sort value, id) or (id,) keyset position"""
+    if sort == 'id':
+        return after[0]
+    raw = json.dumps(list(after)).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(sort, raw):
+    if sort == 'id':
+        return (parse_int(raw, 'after'),)
+    try:
+        value, book_id = json.loads(base64.urlsafe_b64decode(raw.encode()))
+    except (ValueError, TypeError):
+        raise QueryError("after must be a cursor returned as next_after")
+    if type(book_id) is not int or not isinstance(value, (str, int, float, type(None))):
+        raise QueryError("after must be a cursor returned as next_after")
+    if isinstance(value, int):
+        check_int(value, 'after')
+    return value, check_int(book_id, 'after')
+
+
+class Listing:
+    """A filtered, sorted and projected view of the books table"""
+
+    def __init__(self, fields=BOOK_FIELDS, where=(), params=(), sort='id',
+                 descending=False, limit=DEFAULT_PAGE_SIZE, after=None, index=None):
+        self.fields = fields
+        self.where = list(where)
+        self.params = list(params)
+        self.sort = sort
+        self.descending = descending
+        self.limit = limit
+        self.after = after
+        self.index = index
+        # Positions of the keyset columns in the selected rows
+        self._keyset = (fields.index('id'),) if sort == 'id' else (fields.index(sort), fields.index('id'))
+
+    @classmethod
+    def from_args(cls, args):
+        """Build a listing from request query parameters"""
+        sort, descending = parse_sort(args.get('sort'))
+        where, params, columns = parse_filters(args)
+        after = args.get('after')
+        return cls(
+            fields=parse_fields(args.get('fields'), required=('id', sort)),
+            where=where,
+            params=params,
+            sort=sort,
+            descending=descending,
+            limit=parse_limit(args.get('limit')),
+            after=decode_cursor(sort, after) if after else None,
+            index=choose_index(columns, sort),
+        )
+
+    def sql(self, after=None, limit=None):
+        """SELECT statement and parameters for one page"""
+        where, params = list(self.where), list(self.params)
+        op = '<' if self.descending else '>'
+        if after is not None:
+            if self.sort == 'id':
+                where.append(f'id {op} ?')
+            else:
+                where.append(f'({self.sort}, id) {op} (?, ?)')
+            params.extend(after)
+
+        direction = ' DESC' if self.descending else ''
+        order = f'id{direction}' if self.sort == 'id' else f'{self.sort}{direction}, id{direction}'
+        sql = f'SELECT {", ".join(self.fields)} FROM books'
+        if self.index:
+            sql += f' INDEXED BY {self.index}'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += f' ORDER BY {order} LIMIT ?'
+        params.append((limit or self.limit) + 1)
+        return sql, params
+
+    def _fetch(self, conn, after, limit):
+        """Up to limit rows as plain tuples (in the order of self.fields), and
+        the keyset position after them if there are more"""
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        rows = cursor.execute(*self.sql(after, limit)).fetchall()
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            return rows[:limit], tuple(last[i] for i in self._keyset)
+        return rows, None
+
+    def page(self, conn):
+        """One page of book tuples and the cursor of the next page"""
+        rows, after = self._fetch(conn, self.after, self.limit)
+        return rows, encode_cursor(self.sort, after) if after is not None else None
+
+    def iter_pages(self, conn, batch_size=EXPORT_BATCH_SIZE):
+        """Every matching book, one keyset page of tuples at a time"""
+        after = self.after
+        while True:
+            rows, after = self._fetch(conn, after, batch_size)
+            yield rows
+            if after is None:
+                return
+
+    def explain(self, conn):
+        """EXPLAIN QUERY PLAN details for the first page"""
+        sql, params = self.sql(self.after)
+        return [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+
+
+def stream_json(pages, fields):
+    """Chunks of a {"books": [...]} document, one page of rows at a time"""
+    encoder = serialization.RowEncoder(fields)
+    yield '{"books":['
+    first = True
+    for rows in pages:
+        if rows:
+            # Drop the brackets of each page's array and join them with commas
+            yield ('' if first else ',') + encoder.rows(rows)[1:-1]
+            first = False
+    yield ']}'
+
+
+def stream_ndjson(pages, fields):
+    """One JSON document per line"""
+    encoder = serialization.RowEncoder(fields)
+    for rows in pages:
+        if rows:
+            yield '\n'.join([encoder.row(row) for row in rows]) + '\n'
+
+
+EXPORT_FORMATS = {
+    'json': (stream_json, 'application/json'),
+    'ndjson': (stream_ndjson, 'application/x-ndjson'),
+}
@@ -0,0 +1,339 @@
+"""
+Rate limiting and write admission control for the Flask apps.
+
+Every request to a limited route takes a token from the bucket of its
+client and route; a bucket holds up to burst tokens and refills at rate
+tokens per second. An empty bucket gets a 429 with Retry-After set to the
+time until the next token. Rules are given per route class as
+"<rate>/<burst>" (e.g. "20/40"), or "off":
+
+RATE_LIMIT_READ          GET routes (default: 50/100)
+RATE_LIMIT_WRITE         POST, PUT and DELETE routes (default: 10/20)
+RATE_LIMIT_EXPORT        GET /books/export, which reads the whole table
+                         (default: 0.2/2)
+
+/health, its probes and /metrics are never limited. Clients are told
+apart by their address, so every client behind a NAT or a proxy shares
+one bucket. Behind a proxy, set RATE_LIMIT_CLIENT_HEADER to the header
+it forwards the client's address in (X-Forwarded-For): the last value is
+used, the one the proxy added, since a client can forge the ones before
+it. An API key header works too. The header is ignored unless set, as
+anyone can send it to a server that is not behind a proxy.
+
+Buckets live in a store selected with RATE_LIMIT_BACKEND:
+- local: in-process (default). Each worker counts on its own, so a
+  client gets up to WEB_CONCURRENCY times the rate, but checking a
+  bucket takes no I/O.
+- file: a small SQLite database at RATE_LIMIT_PATH, shared by every
+  process on the host. Every limited request, reads included, runs a
+  short write transaction on it that the workers take in turn; it lives
+  in /dev/shm when there is one and is never fsynced.
+- redis: a Redis-protocol server at RATE_LIMIT_REDIS_URL (default:
+  CACHE_REDIS_URL), shared by every host; each update runs as a script
+If the store fails, requests are let through and counted as
+backend_errors.
+
+Besides the buckets, each process admits at most WRITE_MAX_CONCURRENCY
+write requests at once. One more waits up to WRITE_QUEUE_TIMEOUT seconds
+for a slot, then gets a 503 with Retry-After: writers beyond the cap would
+only queue on the writer connection and the SQLite lock until
+busy_timeout turns them into errors. The admitted writes share group
+commits (see group_commit.py), so the cap also bounds a batch.
+
+WRITE_MAX_CONCURRENCY    write requests in flight per process (default: 32)
+WRITE_QUEUE_TIMEOUT      seconds a write waits for a slot (default: 1)
+"""
+
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from flask import current_app, g, jsonify, request
+
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'local')
+# Memory-backed where available: the buckets are not worth a disk write
+RATE_LIMIT_PATH = os.environ.get('RATE_LIMIT_PATH', os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'books-ratelimit.db'))
+RATE_LIMIT_REDIS_URL = os.environ.get('RATE_LIMIT_REDIS_URL', os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0'))
+RATE_LIMIT_CLIENT_HEADER = os.environ.get('RATE_LIMIT_CLIENT_HEADER') or None
+WRITE_MAX_CONCURRENCY = int(os.environ.get('WRITE_MAX_CONCURRENCY', '32'))
+WRITE_QUEUE_TIMEOUT = float(os.environ.get('WRITE_QUEUE_TIMEOUT', '1'))
+
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+EXEMPT_ENDPOINTS = {'books.health', 'books.liveness', 'books.readiness', 'books.metrics_endpoint'}
+ROUTE_CLASSES = {'books.export_books': 'export'}
+
+# Store operations between two purges of idle buckets
+PRUNE_EVERY = 1000
+
+
+def parse_rule(raw):
+    """(rate, burst) from "<rate>/<burst>", None for "off" """
+    if raw.strip().lower() in ('off', '0', ''):
+        return None
+    try:
+        rate, burst = (float(part) for part in raw.split('/'))
+    except ValueError:
+        raise ValueError(f'Invalid rate limit rule {raw!r}, expected "<rate>/<burst>" or "off"') from None
+    if rate <= 0 or burst < 1:
+        raise ValueError(f'Invalid rate limit rule {raw!r}: rate must be positive and burst at least 1')
+    return rate, burst
+
+
+def load_rules(environ=None):
+    environ = os.environ if environ is None else environ
+    defaults = {'read': '50/100', 'write': '10/20', 'export': '0.2/2'}
+    return {name: parse_rule(environ.get(f'RATE_LIMIT_{name.upper()}', default))
+            for name, default in defaults.items()}
+
+
+def spend(state, rate, burst, now, cost=1):
+    """One token bucket step from state, (tokens, updated) or None for a new
+    bucket: the tokens left and the seconds to wait (0 if granted)"""
+    tokens, updated = state if state is not None else (burst, now)
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    if tokens >= cost:
+        return tokens - cost, 0.0
+    return tokens, (cost - tokens) / rate
+
+
+class LocalBackend:
+    """Buckets of this process only"""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._ops = 0
+
+    def take(self, key, rate, burst, now, idle):
+        with self._lock:
+            tokens, wait = spend(self._buckets.get(key), rate, burst, now)
+            self._buckets[key] = (tokens, now)
+            self._ops += 1
+            if self._ops % PRUNE_EVERY == 0:
+                # A bucket idle for longer than idle is full again
+                self._buckets = {k: v for k, v in self._buckets.items() if v[1] >= now - idle}
+            return wait
+
+    def stats(self):
+        return {"backend": "local", "buckets": len(self._buckets)}
+
+
+class FileBackend:
+    """Buckets in an SQLite file shared by the processes of this host.
+
+    Each take is one short write transaction; the file holds nothing worth
+    keeping, so it is written without fsync, by default to /dev/shm.
+    """
+
+    SCHEMA = 'CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL) WITHOUT ROWID'
+
+    def __init__(self, path=RATE_LIMIT_PATH, busy_timeout=100):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._ops = 0
+        conn = self._connection()
+        conn.execute(self.SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            # Connections are per thread and never cross a fork
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode = wal')
+            conn.execute('PRAGMA synchronous = off')
+            conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout)}')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def take(self, key, rate, burst, now, idle):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            state = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens, wait = spend(state, rate, burst, now)
+            conn.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)', (key, tokens, now))
+            self._ops += 1
+            if self._ops % PRUNE_EVERY == 0:
+                conn.execute('DELETE FROM buckets WHERE updated < ?', (now - idle,))
+            conn.execute('COMMIT')
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        return wait
+
+    def stats(self):
+        return {"backend": "file"}
+
+
+class RedisBackend:
+    """Buckets on a Redis-protocol server, updated atomically by a script"""
+
+    SCRIPT = """
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    local tokens = tonumber(state[1]) or burst
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    local wait = 0
+    if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[4])) + 1)
+    return tostring(wait)
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url=RATE_LIMIT_REDIS_URL):
+        import redis
+        return cls(redis.Redis.from_url(url))
+
+    def take(self, key, rate, burst, now, idle):
+        return float(self.client.eval(self.SCRIPT, 1, f'ratelimit:{key}', rate, burst, now, idle))
+
+    def stats(self):
+        return {"backend": "redis"}
+
+
+def create_backend(name=RATE_LIMIT_BACKEND):
+    if name == 'file':
+        return FileBackend()
+    if name == 'local':
+        return LocalBackend()
+    if name == 'redis':
+        return RedisBackend.from_url()
+    raise ValueError(f'Unknown RATE_LIMIT_BACKEND: {name}')
+
+
+class RateLimiter:
+    """Token buckets per client and route, and the write admission cap"""
+
+    def __init__(self, backend, rules=None, max_writes=WRITE_MAX_CONCURRENCY, queue_timeout=WRITE_QUEUE_TIMEOUT):
+        self.backend = backend
+        self.rules = load_rules() if rules is None else rules
+        # Seconds after which any bucket is full again
+        self.idle = max((burst / rate for rate, burst in filter(None, self.rules.values())), default=0)
+        self.max_writes = max_writes
+        self.queue_timeout = queue_timeout
+        self._writes = threading.BoundedSemaphore(max_writes)
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+        self.writes_rejected = 0
+        self.writes_in_flight = 0
+        self.backend_errors = 0
+
+    @staticmethod
+    def route_class(method, endpoint):
+        if method in WRITE_METHODS:
+            return 'write'
+        return ROUTE_CLASSES.get(endpoint, 'read')
+
+    def check(self, client, endpoint, route_class, now=None):
+        """Seconds the client must wait before this route admits it, 0 if
+        it is admitted now"""
+        rule = self.rules.get(route_class)
+        if rule is None:
+            return 0.0
+        rate, burst = rule
+        try:
+            wait = self.backend.take(f'{client}:{endpoint}', rate, burst, time.time() if now is None else now,
+                                     self.idle)
+        except Exception as exc:
+            current_app.logger.warning('Rate limit store failed, request let through: %s', exc)
+            with self._lock:
+                self.backend_errors += 1
+            return 0.0
+        with self._lock:
+            if wait:
+                self.limited += 1
+            else:
+                self.allowed += 1
+        return wait
+
+    def acquire_write(self):
+        """Take a write slot, waiting up to queue_timeout; False if none
+        freed up"""
+        if not self._writes.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self.writes_rejected += 1
+            return False
+        with self._lock:
+            self.writes_in_flight += 1
+        return True
+
+    def release_write(self):
+        with self._lock:
+            self.writes_in_flight -= 1
+        self._writes.release()
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "allowed": self.allowed,
+                "limited": self.limited,
+                "backend_errors": self.backend_errors,
+                "max_writes": self.max_writes,
+                "writes_in_flight": self.writes_in_flight,
+                "writes_rejected": self.writes_rejected,
+            }
+        stats.update(self.backend.stats())
+        return stats
+
+
+def client_id():
+    """Who the current request counts against"""
+    if RATE_LIMIT_CLIENT_HEADER:
+        value = request.headers.get(RATE_LIMIT_CLIENT_HEADER)
+        if value:
+            # Appended by the proxy; earlier values come from the client
+            return value.split(',')[-1].strip()
+    return request.remote_addr or 'unknown'
+
+
+def retry_response(message, status, wait):
+    response = jsonify({"error": message})
+    response.status_code = status
+    response.headers['Retry-After'] = str(max(1, math.ceil(wait)))
+    return response
+
+
+def _admit():
+    endpoint = request.endpoint
+    if endpoint is None or endpoint in EXEMPT_ENDPOINTS:
+        return None
+    limiter = current_app.extensions['rate_limiter']
+    route_class = limiter.route_class(request.method, endpoint)
+    wait = limiter.check(client_id(), endpoint, route_class)
+    if wait:
+        return retry_response("Too many requests, retry later", 429, wait)
+    if route_class == 'write':
+        if not limiter.acquire_write():
+            return retry_response("Too many concurrent writes, retry later", 503, 1)
+        g.write_slot = True
+    return None
+
+
+def _release(exc=None):
+    if g.pop('write_slot', False):
+        current_app.extensions['rate_limiter'].release_write()
+
+
+def init_app(app, limiter=None):
+    """Limit the app's requests; call after metrics.init_app so rejected
+    requests are still measured"""
+    limiter = limiter or RateLimiter(create_backend())
+    app.extensions['rate_limiter'] = limiter
+    app.before_request(_admit)
+    app.teardown_request(_release)
+    registry = app.extensions.get('metrics')
+    if registry is not None:
+        registry.collectors['books_rate_limit'] = limiter.stats
+    return limiter
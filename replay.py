@@ -0,0 +1,300 @@
+"""
+Replay a recorded JSONL request log against a running Books API.
+
+    python replay.py traffic.jsonl --url http://localhost:5000 --speed 1
+    python replay.py traffic.jsonl.gz --url http://localhost:5001 --speed 10 --concurrency 32
+    python replay.py traffic.jsonl --url http://localhost:5000 --speed max --output replay.json
+
+One request per line:
+
+    {"ts": 1718000000.123, "method": "GET", "path": "/books/1", "status": 200}
+    {"ts": "2024-06-10T08:13:20.456", "method": "POST", "path": "/books",
+     "json": {"title": "...", "author": "...", "year": 1999}, "status": 201}
+
+ts (epoch seconds or ISO 8601) drives the pacing, status is the recorded
+response code used for the diff; both are optional. "query", "headers"
+and a raw "body" are passed through. Lines that are not requests are
+counted and skipped.
+
+The log is streamed: a dispatcher thread reads it line by line and hands
+each request to the worker pool when it is due (--speed 1 keeps the
+original timing, --speed N replays N times faster, --speed max sends as
+fast as the workers allow). The hand-off queue is bounded, so memory use
+does not grow with the size of the log.
+"""
+
+import argparse
+import gzip
+import json
+import math
+import queue
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+
+import requests
+
+QUEUE_PER_WORKER = 4
+
+_ID_SEGMENT_RE = re.compile(r'/\d+(?=/|$)')
+
+
+class Record:
+    __slots__ = ('seq', 'ts', 'method', 'path', 'query', 'headers', 'json', 'body', 'status')
+
+    def __init__(self, seq, entry):
+        self.seq = seq
+        self.ts = parse_ts(entry.get('ts'))
+        self.method = entry['method'].upper()
+        self.path = entry['path']
+        self.query = entry.get('query')
+        self.headers = entry.get('headers')
+        self.json = entry.get('json')
+        self.body = entry.get('body')
+        self.status = entry.get('status')
+
+    @property
+    def route(self):
+        """Method and path with numeric ids folded, for grouping"""
+        return f"{self.method} {_ID_SEGMENT_RE.sub('/<id>', self.path.split('?', 1)[0])}"
+
+
+def parse_ts(raw):
+    if raw is None:
+        return None
+    if isinstance(raw, (int, float)):
+        return float(raw)
+    return datetime.fromisoformat(raw).timestamp()
+
+
+def iter_records(path, stats):
+    """Requests from a JSONL (optionally gzipped) log, one line at a time"""
+    if path == '-':
+        f = sys.stdin
+    elif path.endswith('.gz'):
+        f = gzip.open(path, 'rt')
+    else:
+        f = open(path, 'r')
+    with f:
+        for seq, line in enumerate(f):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                yield Record(seq, entry)
+            except (ValueError, KeyError, TypeError, AttributeError):
+                stats["skipped"] += 1
+
+
+class LatencyHistogram:
+    """Log-scale histogram (about 1% resolution) for percentiles in
+    constant memory"""
+
+    BASE = math.log(1.01)
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        bucket = int(math.log(max(seconds, 1e-6) * 1e6) / self.BASE)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, pct):
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(self.count * pct / 100))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return math.exp((bucket + 1) * self.BASE) / 1e6
+        return self.max
+
+    def summary(self):
+        ms = lambda seconds: None if seconds is None else round(seconds * 1000, 3)
+        return {
+            "requests": self.count,
+            "mean_ms": ms(self.total / self.count) if self.count else None,
+            "p50_ms": ms(self.percentile(50)),
+            "p95_ms": ms(self.percentile(95)),
+            "p99_ms": ms(self.percentile(99)),
+            "max_ms": ms(self.max),
+        }
+
+
+class Results:
+    """Latencies and status codes per route, shared by the workers"""
+
+    def __init__(self, mismatch_file=None):
+        self.lock = threading.Lock()
+        self.overall = LatencyHistogram()
+        self.routes = {}
+        self.statuses = {}
+        self.diffs = {}
+        self.errors = 0
+        self.mismatches = 0
+        self.mismatch_file = mismatch_file
+
+    def record(self, rec, status, latency):
+        with self.lock:
+            if status is None:
+                self.errors += 1
+                return
+            self.overall.add(latency)
+            route = self.routes.setdefault(rec.route, LatencyHistogram())
+            route.add(latency)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if rec.status is not None and int(rec.status) != status:
+                self.mismatches += 1
+                key = f"{rec.route} {rec.status}->{status}"
+                self.diffs[key] = self.diffs.get(key, 0) + 1
+                if self.mismatch_file is not None:
+                    self.mismatch_file.write(json.dumps({
+                        "seq": rec.seq, "method": rec.method, "path": rec.path,
+                        "expected": rec.status, "actual": status,
+                    }) + '\n')
+
+
+def send(session, url, rec, timeout):
+    kwargs = {"params": rec.query, "headers": rec.headers, "timeout": timeout}
+    if rec.json is not None:
+        kwargs["json"] = rec.json
+    elif rec.body is not None:
+        kwargs["data"] = rec.body if isinstance(rec.body, str) else json.dumps(rec.body)
+    return session.request(rec.method, url + rec.path, **kwargs).status_code
+
+
+def replay(path, url, speed=None, concurrency=8, limit=None, timeout=30, mismatch_file=None):
+    """Replay the log at path against url; speed None means max throughput"""
+    stats = {"skipped": 0, "dispatched": 0, "max_lag_s": 0.0}
+    results = Results(mismatch_file)
+    pending = queue.Queue(maxsize=concurrency * QUEUE_PER_WORKER)
+    stop = object()
+
+    def work():
+        session = requests.Session()
+        while True:
+            rec = pending.get()
+            if rec is stop:
+                return
+            start = time.perf_counter()
+            try:
+                status = send(session, url, rec, timeout)
+            except requests.RequestException:
+                status = None
+            results.record(rec, status, time.perf_counter() - start)
+
+    workers = [threading.Thread(target=work, daemon=True) for _ in range(concurrency)]
+    for worker in workers:
+        worker.start()
+
+    started = time.perf_counter()
+    first_ts = None
+    for rec in iter_records(path, stats):
+        if limit is not None and stats["dispatched"] >= limit:
+            break
+        if speed is not None and rec.ts is not None:
+            if first_ts is None:
+                first_ts = rec.ts
+            due = started + (rec.ts - first_ts) / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Behind schedule: the target (or this client) cannot keep up
+                stats["max_lag_s"] = max(stats["max_lag_s"], -delay)
+        pending.put(rec)
+        stats["dispatched"] += 1
+
+    for _ in workers:
+        pending.put(stop)
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "dispatched": stats["dispatched"],
+        "skipped": stats["skipped"],
+        "errors": results.errors,
+        "rps": round(results.overall.count / elapsed, 2) if elapsed else None,
+        "max_schedule_lag_s": round(stats["max_lag_s"], 3),
+        "latency": results.overall.summary(),
+        "routes": {route: hist.summary() for route, hist in sorted(results.routes.items())},
+        "statuses": {str(status): n for status, n in sorted(results.statuses.items())},
+        "status_mismatches": results.mismatches,
+        "status_diffs": dict(sorted(results.diffs.items(), key=lambda item: -item[1])),
+    }
+
+
+def print_report(report, out=sys.stdout):
+    latency = report["latency"]
+    print(f"Replayed {report['dispatched']} requests in {report['elapsed_s']}s "
+          f"({report['rps']} req/s), {report['errors']} connection errors, {report['skipped']} lines skipped", file=out)
+    print(f"Latency ms: p50 {latency['p50_ms']}  p95 {latency['p95_ms']}  p99 {latency['p99_ms']}  "
+          f"max {latency['max_ms']}", file=out)
+    if report["max_schedule_lag_s"]:
+        print(f"Fell behind the recorded schedule by up to {report['max_schedule_lag_s']}s", file=out)
+    print(f"\n{'route':<32} {'requests':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}", file=out)
+    for route, stats in report["routes"].items():
+        print(f"{route:<32} {stats['requests']:>9} {stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9}",
+              file=out)
+    print(f"\nStatus codes: {report['statuses']}", file=out)
+    if report["status_mismatches"]:
+        print(f"{report['status_mismatches']} responses differ from the recording:", file=out)
+        for key, n in list(report["status_diffs"].items())[:20]:
+            print(f"  {key}: {n}", file=out)
+
+
+def parse_speed(raw):
+    if raw == 'max':
+        return None
+    speed = float(raw)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError('speed must be positive or "max"')
+    return speed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a JSONL request log against the Books API')
+    parser.add_argument('log', help="JSONL request log (.gz accepted, '-' for stdin)")
+    parser.add_argument('--url', required=True, help='target API, e.g. http://localhost:5000')
+    parser.add_argument('--speed', type=parse_speed, default=None,
+                        help="1 = original timing, N = N times faster, max = no pacing (default: max)")
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent client workers')
+    parser.add_argument('--limit', type=int, help='stop after this many requests')
+    parser.add_argument('--timeout', type=float, default=30, help='per-request timeout in seconds')
+    parser.add_argument('--mismatches', help='write requests whose status differs from the recording here')
+    parser.add_argument('--output', help='write the report as JSON')
+    args = parser.parse_args(argv)
+
+    mismatch_file = open(args.mismatches, 'w') if args.mismatches else None
+    try:
+        report = replay(args.log, args.url.rstrip('/'), args.speed, args.concurrency, args.limit, args.timeout,
+                        mismatch_file)
+    finally:
+        if mismatch_file is not None:
+            mismatch_file.close()
+    report["meta"] = {
+        "log": args.log,
+        "target": args.url,
+        "speed": args.speed or 'max',
+        "concurrency": args.concurrency,
+        "timestamp": datetime.now().isoformat(timespec='seconds'),
+    }
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
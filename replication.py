@@ -0,0 +1,342 @@
+"""
+Read replicas of books.db.
+
+An instance started with REPLICA_OF=<url of the primary> is a read
+replica: it keeps its own books.db in step with the primary by pulling
+the primary's change feed (GET /books/changes, see changefeed.py) and
+applying each page in one transaction. Books are upserted or deleted
+(the search index follows through its triggers) and the entries are
+copied into the replica's book_changes under their primary seq, so the
+replica's feed matches the primary's too. One process per replica file
+applies changes, elected by a file lock next to the database; the other
+workers only serve reads. The books it changes are dropped from the cache
+of every worker (see cache.py).
+
+A replica serves the GET routes from its own file and redirects every
+other request to the primary with a 307, which keeps the method and the
+body. Its responses carry:
+
+X-Books-Seq              seq of the last change in the data served
+X-Replica-Staleness      seconds since the replica last reached the end
+                         of the primary's feed: the data served is at
+                         most that old
+
+A GET is redirected to the primary as well when the replica is more than
+REPLICA_MAX_STALENESS seconds behind, or has not yet applied the seq
+given in X-Books-Min-Seq. Successful writes on the primary answer with
+their X-Books-Seq, so a client reads its own writes by sending it back as
+X-Books-Min-Seq.
+
+Seed a replica with a snapshot of the primary (see snapshot.py), or start
+both from the same init_db.sql. If the primary compacts changes the
+replica has not applied yet (410), the replica stops applying, reports
+not ready and redirects its reads until it is seeded again.
+
+Collection ETags of a replica are built from -seq instead of the change
+counter of the primary, so they agree between replicas at the same seq
+and never collide with one of the primary.
+
+REPLICA_OF               URL of the primary the changes are pulled from
+                         (default: unset, this instance is a primary)
+REPLICA_PRIMARY_PUBLIC_URL
+                         URL of the primary as clients reach it, the target
+                         of redirects when REPLICA_OF is an internal
+                         address (default: REPLICA_OF)
+REPLICA_MAX_STALENESS    seconds behind the primary past which reads are
+                         redirected to it (default: 5)
+REPLICA_POLL_INTERVAL    seconds between two pulls once caught up
+                         (default: 0.5)
+REPLICA_TIMEOUT          seconds a pull may take (default: 5)
+"""
+
+import fcntl
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import urlencode
+
+from flask import current_app, g, jsonify, redirect, request
+
+import changefeed
+import db_pool
+import queries
+import serialization
+import storage
+
+REPLICA_OF = (os.environ.get('REPLICA_OF') or '').rstrip('/') or None
+REPLICA_PRIMARY_PUBLIC_URL = (os.environ.get('REPLICA_PRIMARY_PUBLIC_URL') or '').rstrip('/') or REPLICA_OF
+REPLICA_MAX_STALENESS = float(os.environ.get('REPLICA_MAX_STALENESS', '5'))
+REPLICA_POLL_INTERVAL = float(os.environ.get('REPLICA_POLL_INTERVAL', '0.5'))
+REPLICA_TIMEOUT = float(os.environ.get('REPLICA_TIMEOUT', '5'))
+
+SEQ_HEADER = 'X-Books-Seq'
+STALENESS_HEADER = 'X-Replica-Staleness'
+MIN_SEQ_HEADER = 'X-Books-Min-Seq'
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# Routes a replica always answers itself, whatever the method
+LOCAL_ROUTES = {'/health', '/health/live', '/health/ready', '/metrics', '/admin/snapshots'}
+
+# Seconds between two attempts of a worker to become the applying process
+LOCK_RETRY = 5
+
+APPLIED_SEQ = """SELECT max(coalesce((SELECT max(seq) FROM book_changes), 0),
+                            (SELECT value FROM books_meta WHERE key = 'changes_floor'))"""
+
+UPSERT_BOOK = """INSERT INTO books (id, title, author, year, version) VALUES (?, ?, ?, ?, ?)
+                 ON CONFLICT (id) DO UPDATE SET title = excluded.title, author = excluded.author,
+                                                year = excluded.year, version = excluded.version"""
+
+
+class ReplicaGone(Exception):
+    """The primary no longer has the changes the replica needs next"""
+
+
+def applied_seq(conn):
+    """seq of the last change reflected in books.db"""
+    return conn.execute(APPLIED_SEQ).fetchone()[0]
+
+
+def position(conn):
+    """(seq, staleness in seconds or None if the replica never caught up)"""
+    seq, synced_at = conn.execute(
+        f"SELECT ({APPLIED_SEQ}), (SELECT value FROM books_meta WHERE key = 'replica_synced_at')"
+    ).fetchone()
+    staleness = None if synced_at is None else round(max(0.0, time.time() - synced_at / 1000), 3)
+    return seq, staleness
+
+
+def apply(conn, entries, synced_at=None):
+    """Apply change feed entries in one write transaction; synced_at
+    (epoch seconds) records that they reach the end of the primary's feed
+    as of then. Returns the ids of the books changed."""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        before = applied_seq(conn)
+        log_end = conn.execute('SELECT coalesce(max(seq), 0) FROM book_changes').fetchone()[0]
+        changes = []
+        for entry in entries:
+            if entry["seq"] <= before:
+                continue
+            book = entry["book"]
+            if book is None:
+                conn.execute('DELETE FROM books WHERE id = ?', (entry["id"],))
+                changes.append((entry["seq"], entry["id"], entry["op"], None, None, None, None))
+                continue
+            version = int(entry["etag"].rpartition('.')[2])
+            conn.execute(UPSERT_BOOK, (book["id"], book["title"], book["author"], book["year"], version))
+            changes.append((entry["seq"], entry["id"], entry["op"], book["title"], book["author"], book["year"],
+                            version))
+        if changes:
+            # The triggers logged the writes above under local seqs; keep
+            # the primary's entries instead
+            conn.execute('DELETE FROM book_changes WHERE seq > ?', (log_end,))
+            changefeed.copy_entries(conn, changes)
+            conn.execute("UPDATE books_meta SET value = ? WHERE key = 'changes'", (-changes[-1][0],))
+        if synced_at is not None:
+            conn.execute(
+                """INSERT INTO books_meta (key, value) VALUES ('replica_synced_at', ?)
+                   ON CONFLICT (key) DO UPDATE SET value = excluded.value""",
+                (int(synced_at * 1000),)
+            )
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return [change[1] for change in changes]
+
+
+def fetch(primary, since, limit=changefeed.CHANGES_MAX_PAGE_SIZE, timeout=REPLICA_TIMEOUT):
+    """One page of the primary's change feed"""
+    url = f'{primary}/books/changes?' + urlencode({'since': since, 'limit': limit})
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return serialization.loads(response.read())
+    except urllib.error.HTTPError as exc:
+        if exc.code == 410:
+            raise ReplicaGone(f'{primary} has compacted changes after seq {since}; seed the replica again')
+        raise
+
+
+class Replica:
+    """Keeps a replica file in step with the primary and decides which
+    requests it can answer"""
+
+    def __init__(self, database, pragmas, primary, book_cache, public_url=None,
+                 max_staleness=REPLICA_MAX_STALENESS, poll_interval=REPLICA_POLL_INTERVAL,
+                 timeout=REPLICA_TIMEOUT):
+        self.database = database
+        self.pragmas = pragmas
+        self.primary = primary
+        # Redirected clients may not resolve the address changes are pulled from
+        self.public_url = public_url or primary
+        self.book_cache = book_cache
+        self.max_staleness = max_staleness
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stop = None
+        self.applying = False
+        self.gone = False
+        self.pulls = 0
+        self.applied = 0
+        self.errors = 0
+        self.redirects = 0
+        self.last_error = None
+
+    # Applying
+
+    def start(self):
+        """Start this process's apply thread, once; threads do not survive
+        a fork, so each worker starts its own"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop = threading.Event()
+            threading.Thread(target=self._loop, args=(self._stop,), name='books-replication', daemon=True).start()
+
+    def _loop(self, stop):
+        with open(f'{self.database}.replicate.lock', 'a') as lock:
+            # One process per replica file applies changes; the others
+            # take over if it exits
+            while True:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if stop.wait(LOCK_RETRY):
+                        return
+            self.applying = True
+            conn = storage.open_connection(self.database, self.pragmas)
+            try:
+                while not stop.is_set() and not self.gone:
+                    if not self.sync_once(conn):
+                        stop.wait(self.poll_interval)
+            finally:
+                conn.close()
+                self.applying = False
+
+    def sync_once(self, conn):
+        """Pull and apply one page of the primary's feed; True if more
+        pages follow"""
+        started = time.time()
+        try:
+            page = fetch(self.primary, applied_seq(conn), timeout=self.timeout)
+            book_ids = apply(conn, page["changes"], None if page["more"] else started)
+            # The log reaches every worker serving this file
+            self.book_cache.invalidate(*book_ids)
+            self.applied += len(book_ids)
+        except ReplicaGone as exc:
+            self.gone = True
+            self.last_error = str(exc)
+            return False
+        except (OSError, ValueError, KeyError) as exc:
+            self.errors += 1
+            self.last_error = f'{self.primary}: {exc}'
+            return False
+        self.pulls += 1
+        self.last_error = None
+        return page["more"]
+
+    def close(self):
+        with self._lock:
+            stop, self._pid = self._stop, None
+        if stop is not None:
+            stop.set()
+
+    # Serving
+
+    def falls_behind(self, seq, staleness, min_seq=None):
+        """Whether a read must go to the primary instead; min_seq is the
+        raw X-Books-Min-Seq header"""
+        if self.gone or staleness is None or staleness > self.max_staleness:
+            return True
+        return min_seq is not None and queries.parse_int(min_seq, MIN_SEQ_HEADER) > seq
+
+    def primary_url(self, path, query_string=''):
+        self.redirects += 1
+        return f'{self.public_url}{path}?{query_string}' if query_string else f'{self.public_url}{path}'
+
+    def check(self):
+        """Readiness check: caught up with the primary recently enough"""
+        conn = storage.open_connection(self.database, self.pragmas, readonly=True)
+        try:
+            seq, staleness = position(conn)
+        finally:
+            conn.close()
+        result = {"ok": not self.falls_behind(seq, staleness), "seq": seq, "staleness": staleness,
+                  "primary": self.primary}
+        if self.last_error:
+            result["last_error"] = self.last_error
+        return result
+
+    def stats(self):
+        return {
+            "applying": self.applying,
+            "gone": self.gone,
+            "pulls": self.pulls,
+            "applied": self.applied,
+            "errors": self.errors,
+            "redirects": self.redirects,
+        }
+
+
+def position_headers(seq, staleness):
+    headers = {SEQ_HEADER: str(seq)}
+    if staleness is not None:
+        headers[STALENESS_HEADER] = f'{staleness:.3f}'
+    return headers
+
+
+def _route():
+    replica = current_app.extensions['replica']
+    replica.start()
+    if request.url_rule is None or request.url_rule.rule in LOCAL_ROUTES:
+        return None
+    query_string = request.query_string.decode()
+    if request.method not in READ_METHODS:
+        return redirect(replica.primary_url(request.path, query_string), 307)
+    g.replica_position = position(db_pool.get_connection())
+    try:
+        behind = replica.falls_behind(*g.replica_position, request.headers.get(MIN_SEQ_HEADER))
+    except queries.QueryError as e:
+        return jsonify({"error": str(e)}), 400
+    if behind:
+        return redirect(replica.primary_url(request.path, query_string), 307)
+    return None
+
+
+def _replica_headers(response):
+    position = g.get('replica_position')
+    if position is not None:
+        response.headers.update(position_headers(*position))
+    return response
+
+
+def _write_seq_header(response):
+    if request.method not in READ_METHODS and response.status_code < 300:
+        # Read after the write committed, so it covers the write
+        response.headers[SEQ_HEADER] = str(applied_seq(db_pool.get_connection()))
+    return response
+
+
+def init_app(app, database, pragmas, primary=REPLICA_OF, public_url=REPLICA_PRIMARY_PUBLIC_URL):
+    """Make the app a replica of primary if given; call after metrics and
+    probes. A primary tags its writes with their seq."""
+    if primary is None:
+        app.after_request(_write_seq_header)
+        return None
+    replica = Replica(database, pragmas, primary.rstrip('/'), app.extensions['book_cache'],
+                      public_url.rstrip('/') if public_url else None)
+    app.extensions['replica'] = replica
+    app.before_request(_route)
+    app.after_request(_replica_headers)
+    app.extensions['readiness'].add('replication', replica.check)
+    registry = app.extensions.get('metrics')
+    if registry is not None:
+        registry.collectors['books_replication'] = replica.stats
+    return replica
@@ -0,0 +1,169 @@
+"""
+Full-text search over book titles and authors.
+
+books_fts is an external-content FTS5 table: it stores only the inverted
+index and reads title/author back from books. Triggers on books keep it in
+sync, so every write route updates the index in its own transaction.
+
+A database that predates the index gets it filled in batches (see
+storage.run_batches), so writers are not locked out while a large table is
+indexed. Meanwhile books_fts_backfill records how far the fill has got,
+and the triggers only touch rows already indexed or added since it began;
+the fill reads the others as they are when it reaches them.
+"""
+
+import os
+
+import click
+
+import queries
+import storage
+
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+MAX_SEARCH_OFFSET = int(os.environ.get('SEARCH_MAX_OFFSET', '1000'))
+
+SEARCH_TABLE = """CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+    title, author, content='books', content_rowid='id'
+)"""
+
+SEARCH_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books {when}BEGIN
+        INSERT INTO books_fts (rowid, title, author) VALUES (new.id, new.title, new.author);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books {when}BEGIN
+        INSERT INTO books_fts (books_fts, rowid, title, author)
+        VALUES ('delete', old.id, old.title, old.author);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF title, author ON books {when}BEGIN
+        INSERT INTO books_fts (books_fts, rowid, title, author)
+        VALUES ('delete', old.id, old.title, old.author);
+        INSERT INTO books_fts (rowid, title, author) VALUES (new.id, new.title, new.author);
+    END""",
+)
+
+# While the index is being filled: rows up to watermark are indexed, rows
+# above last_id were inserted since the fill began
+_BACKFILLED = ('WHEN {row}.id <= (SELECT watermark FROM books_fts_backfill) '
+               'OR {row}.id > (SELECT last_id FROM books_fts_backfill) ')
+_BACKFILL_GUARDS = ('new', 'old', 'old')
+
+SEARCH_SCHEMA = (
+    SEARCH_TABLE,
+    *(trigger.format(when='') for trigger in SEARCH_TRIGGERS),
+    # Title matches weigh twice as much as author matches
+    "INSERT INTO books_fts (books_fts, rank) VALUES ('rank', 'bm25(2.0, 1.0)')",
+)
+
+
+def _exists(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).fetchone() is not None
+
+
+def install(conn):
+    """Create the search index, filling it in batches if the database
+    predates it. Commits; an interrupted fill resumes on the next call."""
+    if not _exists(conn, 'books_fts'):
+        conn.execute(SEARCH_TABLE)
+        conn.execute('CREATE TABLE books_fts_backfill (watermark INTEGER NOT NULL, last_id INTEGER NOT NULL)')
+        conn.execute('INSERT INTO books_fts_backfill SELECT 0, coalesce(max(id), 0) FROM books')
+        for trigger, row in zip(SEARCH_TRIGGERS, _BACKFILL_GUARDS):
+            conn.execute(trigger.format(when=_BACKFILLED.format(row=row)))
+        conn.commit()
+    if _exists(conn, 'books_fts_backfill'):
+        storage.run_batches(conn, _backfill_batch)
+        conn.execute('BEGIN IMMEDIATE')
+        for trigger in ('books_fts_insert', 'books_fts_delete', 'books_fts_update'):
+            conn.execute(f'DROP TRIGGER {trigger}')
+        conn.execute('DROP TABLE books_fts_backfill')
+    for statement in SEARCH_SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+
+
+def _backfill_batch(conn, size):
+    """Index the next size rows below last_id; False once there are none"""
+    watermark, last_id = conn.execute('SELECT watermark, last_id FROM books_fts_backfill').fetchone()
+    upper = conn.execute(
+        'SELECT max(id) FROM (SELECT id FROM books WHERE id > ? AND id <= ? ORDER BY id LIMIT ?)',
+        (watermark, last_id, size)
+    ).fetchone()[0]
+    if upper is None:
+        return False
+    conn.execute(
+        'INSERT INTO books_fts (rowid, title, author) SELECT id, title, author FROM books WHERE id > ? AND id <= ?',
+        (watermark, upper)
+    )
+    conn.execute('UPDATE books_fts_backfill SET watermark = ?', (upper,))
+    return True
+
+
+def index_books(conn, after_id):
+    """Index the books above after_id, written while books_fts_insert was
+    dropped (see bulk_import.py)"""
+    conn.execute('INSERT INTO books_fts (rowid, title, author) SELECT id, title, author FROM books WHERE id > ?',
+                 (after_id,))
+
+
+def rebuild(conn):
+    """Rebuild books_fts from the books table"""
+    conn.execute("INSERT INTO books_fts (books_fts) VALUES ('rebuild')")
+    conn.commit()
+
+
+def match_expression(text):
+    """FTS5 query for free text: every term must match, the last as a prefix.
+
+    Terms are quoted so that user input cannot inject FTS5 query syntax.
+    """
+    terms = ['"' + term.replace('"', '""') + '"' for term in text.split()]
+    if not terms:
+        return None
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def parse_paging(args):
+    """?limit= and ?offset= of a search request"""
+    limit = queries.parse_int(args.get('limit', DEFAULT_SEARCH_LIMIT), 'limit')
+    offset = queries.parse_int(args.get('offset', 0), 'offset')
+    if not 1 <= limit <= MAX_SEARCH_LIMIT:
+        raise queries.QueryError(f"limit must be between 1 and {MAX_SEARCH_LIMIT}")
+    if not 0 <= offset <= MAX_SEARCH_OFFSET:
+        raise queries.QueryError(f"offset must be between 0 and {MAX_SEARCH_OFFSET}")
+    return limit, offset
+
+
+def search(conn, text, limit=DEFAULT_SEARCH_LIMIT, offset=0):
+    """One page of books matching text, best bm25 rank first, and the
+    offset of the next page"""
+    expression = match_expression(text)
+    if expression is None:
+        return [], None
+    rows = conn.execute(
+        '''SELECT books.id, books.title, books.author, books.year, books_fts.rank AS score
+           FROM books_fts JOIN books ON books.id = books_fts.rowid
+           WHERE books_fts MATCH ?
+           ORDER BY books_fts.rank
+           LIMIT ? OFFSET ?''',
+        (expression, limit + 1, offset)
+    ).fetchall()
+    if len(rows) > limit:
+        return rows[:limit], offset + limit
+    return rows, None
+
+
+def init_app(app, database, pragmas):
+    """Register the rebuild-search-index CLI command"""
+
+    @app.cli.command('rebuild-search-index')
+    def rebuild_search_index():
+        """Rebuild the full-text index of books.db"""
+        conn = storage.open_connection(database, pragmas)
+        try:
+            install(conn)
+            rebuild(conn)
+            count = conn.execute('SELECT count(*) FROM books').fetchone()[0]
+        finally:
+            conn.close()
+        click.echo(f'Search index rebuilt for {count} books')
@@ -0,0 +1,123 @@
+"""
+JSON encoding for API responses.
+
+Uses orjson when it is installed and the standard library otherwise; set
+JSON_ENCODER=stdlib to force the fallback. FastJSONProvider plugs the
+encoder into Flask (jsonify, request.json), and RowEncoder turns tuple
+rows into JSON objects by column position, without building a dict per
+row or going through sqlite3.Row.
+"""
+
+import json
+import os
+from itertools import chain
+
+from flask import current_app
+from flask.json.provider import DefaultJSONProvider
+
+JSON_ENCODER = os.environ.get('JSON_ENCODER', 'auto')
+
+if JSON_ENCODER == 'stdlib':
+    orjson = None
+else:
+    try:
+        import orjson
+    except ImportError:
+        if JSON_ENCODER == 'orjson':
+            raise
+        orjson = None
+
+ENCODER = 'orjson' if orjson is not None else 'stdlib'
+
+_encode_str = json.encoder.encode_basestring_ascii
+
+
+def _encode_value(value):
+    cls = value.__class__
+    if cls is str:
+        return _encode_str(value)
+    if cls is int:
+        return int.__repr__(value)
+    if value is None:
+        return 'null'
+    return json.dumps(value)
+
+
+def dumps(obj, sort_keys=False):
+    """Compact JSON text for obj"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0).decode()
+    return json.dumps(obj, separators=(',', ':'), sort_keys=sort_keys)
+
+
+def loads(data):
+    """Decode JSON text or bytes"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class RowEncoder:
+    """Encode rows (tuples in the order of columns) as JSON objects"""
+
+    def __init__(self, columns):
+        self.columns = tuple(columns)
+        keys = (json.dumps(column).replace('%', '%%') for column in self.columns)
+        self._template = '{' + ','.join(f'{key}:%s' for key in keys) + '}'
+
+    def row(self, row):
+        if orjson is not None:
+            return orjson.dumps(dict(zip(self.columns, row))).decode()
+        return self._template % tuple(map(_encode_value, row))
+
+    def rows(self, rows):
+        """JSON array of the rows"""
+        if orjson is not None:
+            # orjson encodes short-lived dicts faster than Python can splice text
+            columns = self.columns
+            return orjson.dumps([dict(zip(columns, row)) for row in rows]).decode()
+        # One pass over every value, then a single format of the whole page
+        values = tuple(map(_encode_value, chain.from_iterable(rows)))
+        return '[' + ','.join([self._template] * len(rows)) % values + ']'
+
+
+def collection(columns, rows, **fields):
+    """{"books": [...], <fields>} as JSON text"""
+    extra = ''.join(f',{json.dumps(name)}:{dumps(value)}' for name, value in fields.items())
+    return '{"books":' + RowEncoder(columns).rows(rows) + extra + '}'
+
+
+def json_response(body):
+    """Response for an already encoded JSON body"""
+    return current_app.response_class(body, mimetype=current_app.json.mimetype)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson when available"""
+
+    def _options(self):
+        return orjson.OPT_SORT_KEYS if self.sort_keys else 0
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self._options()).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Pretty-printed debug output stays on the standard library
+        if orjson is None or self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self._options()) + b'\n'
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+def init_app(app):
+    """Serve JSON through FastJSONProvider"""
+    app.json = FastJSONProvider(app)
+    return app.json
@@ -0,0 +1,217 @@
+"""
+Consistent online snapshots of books.db.
+
+A snapshot is a copy made with the SQLite backup API, SNAPSHOT_STEP_PAGES
+pages at a time with a pause of SNAPSHOT_STEP_PAUSE seconds between
+steps. The source connection holds a single read transaction over the
+whole copy, so every step reads the same version of the database and the
+copy never has to restart when a writer commits meanwhile; in WAL mode
+that read transaction does not block writers, it only holds back
+checkpoints until the copy is done. The copy is written to
+<name>.partial, checked with PRAGMA quick_check and renamed, so a
+snapshot file is always complete.
+
+flask snapshot [PATH] takes a snapshot from the command line.
+POST /admin/snapshots takes one in SNAPSHOT_DIR in the background and
+GET /admin/snapshots lists them; both need "Authorization: Bearer
+<ADMIN_TOKEN>" and answer 404 while ADMIN_TOKEN is unset. One snapshot
+at a time is taken per SNAPSHOT_DIR, whichever process asks for it.
+
+A snapshot is a plain database file: to seed a node or move a catalog to
+another volume, stop the API and copy it to DATABASE_PATH (without the
+old -wal and -shm files). Migrations bring it up to date on startup.
+
+SNAPSHOT_DIR             snapshots taken through the API (default:
+                         snapshots/ next to books.db)
+SNAPSHOT_STEP_PAGES      pages copied per backup step (default: 1024)
+SNAPSHOT_STEP_PAUSE      seconds between two steps (default: 0.005)
+SNAPSHOT_KEEP            snapshots kept in SNAPSHOT_DIR, the oldest are
+                         removed first (default: 5)
+ADMIN_TOKEN              bearer token of the /admin endpoints (default:
+                         unset, endpoints disabled)
+"""
+
+import fcntl
+import hmac
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+import click
+
+import storage
+
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR') or None
+SNAPSHOT_STEP_PAGES = int(os.environ.get('SNAPSHOT_STEP_PAGES', '1024'))
+SNAPSHOT_STEP_PAUSE = float(os.environ.get('SNAPSHOT_STEP_PAUSE', '0.005'))
+SNAPSHOT_KEEP = int(os.environ.get('SNAPSHOT_KEEP', '5'))
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN') or None
+
+PARTIAL_SUFFIX = '.partial'
+
+
+class SnapshotError(RuntimeError):
+    """A snapshot could not be taken"""
+
+
+class SnapshotBusy(SnapshotError):
+    """Another snapshot is being taken in the same directory"""
+
+
+def snapshot_dir(database):
+    return SNAPSHOT_DIR or os.path.join(os.path.dirname(os.path.abspath(database)), 'snapshots')
+
+
+def snapshot_name(now=None):
+    now = now or datetime.now(timezone.utc)
+    return now.strftime('books-%Y%m%dT%H%M%SZ.db')
+
+
+def take(database, pragmas, target, pages=SNAPSHOT_STEP_PAGES, pause=SNAPSHOT_STEP_PAUSE):
+    """Copy database to target; returns a summary of the snapshot"""
+    started = time.monotonic()
+    partial = target + PARTIAL_SUFFIX
+    source = storage.open_connection(database, pragmas, readonly=True)
+    try:
+        # Pin one version of the database for every backup step
+        source.execute('BEGIN')
+        version = source.execute('PRAGMA user_version').fetchone()[0]
+        books = source.execute('SELECT count(*) FROM books').fetchone()[0]
+        if os.path.exists(partial):
+            os.remove(partial)
+        dest = sqlite3.connect(partial)
+        try:
+            source.backup(dest, pages=pages, sleep=pause)
+            check = dest.execute('PRAGMA quick_check').fetchone()[0]
+        finally:
+            dest.close()
+        source.rollback()
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    finally:
+        source.close()
+    if check != 'ok':
+        os.remove(partial)
+        raise SnapshotError(f'Snapshot of {database} failed its integrity check: {check}')
+    os.replace(partial, target)
+    return {
+        "path": target,
+        "bytes": os.path.getsize(target),
+        "books": books,
+        "schema_version": version,
+        "seconds": round(time.monotonic() - started, 3),
+    }
+
+
+def list_snapshots(directory):
+    """Snapshots of directory, newest first; one still being written is
+    listed as running"""
+    if not os.path.isdir(directory):
+        return []
+    snapshots = []
+    for name in os.listdir(directory):
+        running = name.endswith(PARTIAL_SUFFIX)
+        if not (name.endswith('.db') or running):
+            continue
+        stat = os.stat(os.path.join(directory, name))
+        snapshots.append({
+            "name": name[:-len(PARTIAL_SUFFIX)] if running else name,
+            "status": "running" if running else "complete",
+            "bytes": stat.st_size,
+            "created": datetime.fromtimestamp(stat.st_mtime, timezone.utc).isoformat(),
+        })
+    snapshots.sort(key=lambda snapshot: snapshot["name"], reverse=True)
+    return snapshots
+
+
+def prune(directory, keep=SNAPSHOT_KEEP):
+    """Remove all but the keep newest complete snapshots of directory"""
+    complete = [s["name"] for s in list_snapshots(directory) if s["status"] == "complete"]
+    for name in complete[keep:]:
+        os.remove(os.path.join(directory, name))
+
+
+class SnapshotJobs:
+    """Snapshots of one database taken in the background, one at a time
+    per directory across processes"""
+
+    def __init__(self, database, pragmas, directory=None, keep=SNAPSHOT_KEEP):
+        self.database = database
+        self.pragmas = pragmas
+        self.directory = directory or snapshot_dir(database)
+        self.keep = keep
+        self.last = None
+        self.last_error = None
+
+    def start(self):
+        """Name of the snapshot started, or raise SnapshotBusy"""
+        os.makedirs(self.directory, exist_ok=True)
+        lock = open(os.path.join(self.directory, '.snapshot.lock'), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            raise SnapshotBusy('A snapshot is already being taken')
+        name = snapshot_name()
+        threading.Thread(target=self._run, args=(lock, name), name='books-snapshot', daemon=True).start()
+        return name
+
+    def _run(self, lock, name):
+        try:
+            self.last = take(self.database, self.pragmas, os.path.join(self.directory, name))
+            self.last_error = None
+            prune(self.directory, self.keep)
+        except Exception as exc:
+            self.last_error = f'{name}: {exc}'
+        finally:
+            # Closing the file releases the lock
+            lock.close()
+
+    def status(self):
+        return {
+            "directory": self.directory,
+            "snapshots": list_snapshots(self.directory),
+            "last_error": self.last_error,
+        }
+
+
+def authorized(header, token=ADMIN_TOKEN):
+    """Whether an Authorization header carries the admin token"""
+    if token is None or not header:
+        return False
+    scheme, _, credentials = header.partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(credentials.strip().encode(), token.encode())
+
+
+def admin_error(header, token=ADMIN_TOKEN):
+    """(error, status) refusing an admin request, or None to let it through"""
+    if token is None:
+        return "Not found", 404
+    if not authorized(header, token):
+        return "Admin token required", 401
+    return None
+
+
+def init_app(app, database, pragmas):
+    """Attach background snapshots and register the snapshot CLI command"""
+    jobs = SnapshotJobs(database, pragmas)
+    app.extensions['snapshots'] = jobs
+
+    @app.cli.command('snapshot')
+    @click.argument('path', required=False)
+    @click.option('--pages', type=int, default=SNAPSHOT_STEP_PAGES, show_default=True,
+                  help='pages copied per backup step')
+    def snapshot_command(path, pages):
+        """Take a consistent snapshot of books.db, by default in SNAPSHOT_DIR"""
+        if path is None:
+            os.makedirs(jobs.directory, exist_ok=True)
+            path = os.path.join(jobs.directory, snapshot_name())
+        summary = take(database, pragmas, path, pages=pages)
+        click.echo(f'Snapshot of {summary["books"]} books written to {summary["path"]} '
+                   f'({summary["bytes"]} bytes, {summary["seconds"]}s)')
+
+    return jobs
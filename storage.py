@@ -0,0 +1,94 @@
+"""
+Storage configuration for books.db.
+
+Holds the PRAGMA profile applied to every SQLite connection. Each setting
+can be overridden with an environment variable named SQLITE_<PRAGMA>, for
+example SQLITE_SYNCHRONOUS=full or SQLITE_BUSY_TIMEOUT=10000.
+
+Long data changes (backfills, table copies) go through run_batches:
+
+MIGRATION_BATCH_SIZE     rows per write transaction (default: 5000)
+MIGRATION_BATCH_PAUSE    seconds between two batches (default: 0.02)
+"""
+
+import os
+import re
+import sqlite3
+import time
+from pathlib import Path
+
+PRAGMA_DEFAULTS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': '-16000',      # negative = KiB, i.e. ~16 MB per connection
+    'mmap_size': '134217728',    # 128 MB
+    'temp_store': 'memory',
+    'busy_timeout': '5000',      # ms
+}
+
+MIGRATION_BATCH_SIZE = int(os.environ.get('MIGRATION_BATCH_SIZE', '5000'))
+MIGRATION_BATCH_PAUSE = float(os.environ.get('MIGRATION_BATCH_PAUSE', '0.02'))
+
+# journal_mode is a property of the database file and can only be changed
+# by a connection that is allowed to write to it
+_WRITER_ONLY = {'journal_mode'}
+
+_VALUE_RE = re.compile(r'^-?[A-Za-z0-9_]+$')
+
+
+def load_pragmas(environ=None):
+    """PRAGMA profile from the defaults and SQLITE_* overrides"""
+    environ = os.environ if environ is None else environ
+    pragmas = {}
+    for name, default in PRAGMA_DEFAULTS.items():
+        value = environ.get(f'SQLITE_{name.upper()}', default)
+        if not _VALUE_RE.match(value):
+            raise ValueError(f'Invalid value for SQLITE_{name.upper()}: {value!r}')
+        pragmas[name] = value
+    return pragmas
+
+
+def apply_pragmas(conn, pragmas, readonly=False):
+    """Apply the PRAGMA profile to an open connection"""
+    for name, value in pragmas.items():
+        if readonly and name in _WRITER_ONLY:
+            continue
+        conn.execute(f'PRAGMA {name} = {value}')
+
+
+def open_connection(database, pragmas, readonly=False, factory=sqlite3.Connection):
+    """Open a configured connection, read-only if requested"""
+    if readonly:
+        uri = Path(database).resolve().as_uri() + '?mode=ro'
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, factory=factory)
+    else:
+        conn = sqlite3.connect(database, check_same_thread=False, factory=factory)
+    conn.row_factory = sqlite3.Row
+    apply_pragmas(conn, pragmas, readonly=readonly)
+    return conn
+
+
+def run_batches(conn, batch, size=MIGRATION_BATCH_SIZE, pause=MIGRATION_BATCH_PAUSE):
+    """Call batch(conn, size), each time in its own write transaction, until
+    it returns False; returns the number of batches that did work.
+
+    The write lock is released for pause seconds between batches, so other
+    writers are held up for one batch at most rather than for the whole
+    operation. batch must record its own progress in the database, so an
+    interrupted run resumes where it stopped.
+    """
+    done = 0
+    if conn.in_transaction:
+        conn.commit()
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            more = batch(conn, size)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        if not more:
+            return done
+        done += 1
+        time.sleep(pause)
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def init_sql():
+    return os.path.join(ROOT, 'init_db.sql')
+
+
+@pytest.fixture
+def books_app(tmp_path, init_sql):
+    """The Flask Books API on a fresh database"""
+    import app
+
+    return app.create_app({'DATABASE': str(tmp_path / 'books.db'), 'INIT_SQL': init_sql})
+
+
+@pytest.fixture
+def client(books_app):
+    return books_app.test_client()
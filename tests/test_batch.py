@@ -0,0 +1,35 @@
+import io
+from types import SimpleNamespace
+
+import batch
+
+
+class GunicornBody:
+    """Like gunicorn's request body: iterable by line, but no readable()"""
+
+    def __init__(self, data):
+        self._lines = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self._lines.read(size)
+
+    def readline(self, size=-1):
+        return self._lines.readline(size)
+
+    def __iter__(self):
+        return iter(self._lines.readline, b'')
+
+
+def test_read_items_from_a_stream_without_readable():
+    body = GunicornBody(b'{"title": "A", "author": "B", "year": 2000}\n\nnot json\n{"id": 3}\n')
+    assert not hasattr(body, 'readable')
+    request = SimpleNamespace(mimetype='application/x-ndjson', stream=body)
+
+    assert batch.read_items(request) == [{"title": "A", "author": "B", "year": 2000}, None, {"id": 3}]
+
+
+def test_ndjson_batch_through_the_app(client):
+    body = b'{"title": "A", "author": "B", "year": 2000}\n{"title": "C", "author": "D", "year": 2001}\n'
+    response = client.post('/books/batch', data=body, content_type='application/x-ndjson')
+    assert response.status_code == 201
+    assert response.json["added"] == 2
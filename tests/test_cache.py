@@ -0,0 +1,65 @@
+import re
+
+import cache
+
+SQL_COUNT = re.compile(r'^books_sqlite_statement_duration_seconds_count\{[^}]*\} (\d+)$', re.MULTILINE)
+
+
+def sql_statements(client):
+    return sum(int(n) for n in SQL_COUNT.findall(client.get('/metrics').get_data(as_text=True)))
+
+
+def two_workers(tmp_path):
+    path = cache.log_path(str(tmp_path / 'books.db'))
+    return [cache.BookCache(cache.LocalBackend(), cache.InvalidationLog(path)) for _ in range(2)]
+
+
+def test_write_in_one_process_drops_the_book_in_the_others(tmp_path):
+    first, second = two_workers(tmp_path)
+    for worker in (first, second):
+        worker.set_book(1, {"title": "old"}, worker.read_token())
+        worker.set_book(2, {"title": "other"}, worker.read_token())
+
+    first.invalidate(1)
+
+    assert second.get_book(1) is None
+    assert second.get_book(2) == {"title": "other"}
+
+
+def test_read_racing_a_write_is_not_stored(tmp_path):
+    reader, writer = two_workers(tmp_path)
+    token = reader.read_token()
+    writer.invalidate(1)
+    reader.set_book(1, {"title": "old"}, token)
+    reader.set_book(2, {"title": "other"}, token)
+
+    assert reader.get_book(1) is None
+    assert reader.get_book(2) == {"title": "other"}
+
+
+def test_falling_behind_the_log_clears_the_cache(tmp_path):
+    reader, writer = two_workers(tmp_path)
+    reader.set_book(1, {"title": "old"}, reader.read_token())
+    writer.invalidate(*range(2, cache.INVALIDATION_SLOTS + 3))
+
+    assert reader.get_book(1) is None
+    assert reader.stats()["resets"] == 1
+
+
+def test_cache_hit_runs_no_sql(client):
+    book_id = client.post('/books', json={"title": "T", "author": "A", "year": 2000}).json["id"]
+    assert client.get(f'/books/{book_id}').status_code == 200
+
+    before = sql_statements(client)
+    assert client.get(f'/books/{book_id}').json["title"] == "T"
+    assert sql_statements(client) == before
+
+
+def test_update_and_delete_are_seen_at_once(client):
+    book_id = client.post('/books', json={"title": "T", "author": "A", "year": 2000}).json["id"]
+    assert client.get(f'/books/{book_id}').json["title"] == "T"
+
+    client.put(f'/books/{book_id}', json={"title": "New"})
+    assert client.get(f'/books/{book_id}').json["title"] == "New"
+    client.delete(f'/books/{book_id}')
+    assert client.get(f'/books/{book_id}').status_code == 404
@@ -0,0 +1,17 @@
+import re
+
+LISTING = re.compile(
+    r'^books_sqlite_statement_duration_seconds_count\{statement="SELECT",table="books"\} (\d+)$', re.MULTILINE)
+
+
+def listing_count(client):
+    match = LISTING.search(client.get('/metrics').get_data(as_text=True))
+    return int(match.group(1)) if match else 0
+
+
+def test_listing_queries_are_timed(client):
+    before = listing_count(client)
+    # Distinct pages, so that none of them is served from the list cache
+    for limit in range(1, 6):
+        assert client.get(f'/books?limit={limit}').status_code == 200
+    assert listing_count(client) >= before + 5
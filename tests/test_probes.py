@@ -0,0 +1,50 @@
+import sqlite3
+import threading
+
+import probes
+import storage
+
+
+def test_database_check_does_not_wait_for_the_write_lock(books_app):
+    database, pragmas = books_app.config['DATABASE'], books_app.config['PRAGMAS']
+    writer = storage.open_connection(database, pragmas)
+    writer.execute('BEGIN IMMEDIATE')
+    try:
+        result = probes.database_check(database, pragmas, timeout=0.2)()
+    finally:
+        writer.rollback()
+        writer.close()
+    assert result["ok"]
+
+
+def test_ready_while_a_write_transaction_is_open(client, books_app):
+    database, pragmas = books_app.config['DATABASE'], books_app.config['PRAGMAS']
+    writer = storage.open_connection(database, pragmas)
+    writer.execute('BEGIN IMMEDIATE')
+    try:
+        response = client.get('/health/ready')
+    finally:
+        writer.rollback()
+        writer.close()
+    assert response.status_code == 200
+    assert response.json["checks"]["writes"]["commit_seconds"] == 0
+
+
+def test_writes_check_reports_the_last_failed_batch(books_app):
+    coalescer = books_app.extensions['write_coalescer']
+    done = threading.Event()
+
+    def unavailable():
+        raise sqlite3.OperationalError('disk I/O error')
+
+    original, coalescer.writer.acquire = coalescer.writer.acquire, unavailable
+    try:
+        future = coalescer.submit(lambda conn: None)
+        future.add_done_callback(lambda _: done.set())
+        assert done.wait(5)
+    finally:
+        coalescer.writer.acquire = original
+    result = probes.writes_check(coalescer)()
+    assert result["last_error"] == 'OperationalError: disk I/O error'
+    coalescer.run(lambda conn: None)
+    assert "last_error" not in probes.writes_check(coalescer)()
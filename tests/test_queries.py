@@ -0,0 +1,33 @@
+import base64
+import json
+
+import pytest
+
+import queries
+
+TOO_BIG = '99999999999999999999999'
+
+
+def cursor(value, book_id):
+    return base64.urlsafe_b64encode(json.dumps([value, book_id]).encode()).decode()
+
+
+@pytest.mark.parametrize('query', [
+    f'after={TOO_BIG}',
+    f'after=-{TOO_BIG}',
+    f'limit={TOO_BIG}',
+    f'sort=year&after={cursor(int(TOO_BIG), 1)}',
+    f'sort=title&after={cursor("a", int(TOO_BIG))}',
+    f'sort=title&after={cursor({"a": 1}, 1)}',
+])
+def test_unbindable_paging_parameters_are_rejected(client, query):
+    response = client.get(f'/books?{query}')
+    assert response.status_code == 400
+    assert 'after' in response.json["error"] or 'limit' in response.json["error"]
+
+
+def test_parse_int_accepts_the_sqlite_range():
+    assert queries.parse_int(str(2 ** 63 - 1), 'after') == 2 ** 63 - 1
+    assert queries.parse_int(str(-2 ** 63), 'after') == -2 ** 63
+    with pytest.raises(queries.QueryError):
+        queries.parse_int(str(2 ** 63), 'after')
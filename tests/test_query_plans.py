@@ -0,0 +1,43 @@
+import pytest
+
+import migrations
+import queries
+import storage
+
+
+@pytest.fixture
+def conn(tmp_path, init_sql):
+    database, pragmas = str(tmp_path / 'books.db'), storage.load_pragmas()
+    migrations.migrate(database, pragmas, init_sql)
+    conn = storage.open_connection(database, pragmas)
+    yield conn
+    conn.close()
+
+
+@pytest.mark.parametrize('args, plan', [
+    ({}, 'SCAN books'),
+    ({"after": "10"}, 'SEARCH books USING INTEGER PRIMARY KEY (rowid>?)'),
+    ({"sort": "title"}, 'SCAN books USING INDEX idx_books_title'),
+    ({"sort": "-author"}, 'SCAN books USING INDEX idx_books_author'),
+    ({"sort": "year"}, 'SCAN books USING INDEX idx_books_year'),
+    ({"author": "George Orwell"}, 'SEARCH books USING INDEX idx_books_author (author=?)'),
+    ({"year_min": "1900"}, 'SEARCH books USING INDEX idx_books_year (year>?)'),
+    ({"year_max": "1950"}, 'SEARCH books USING INDEX idx_books_year (year<?)'),
+    ({"year_min": "1900", "year_max": "1950"}, 'SEARCH books USING INDEX idx_books_year (year>? AND year<?)'),
+    ({"title_prefix": "The"}, 'SEARCH books USING INDEX idx_books_title (title>? AND title<?)'),
+    ({"title_prefix": "\U0010ffff"}, 'SEARCH books USING INDEX idx_books_title (title>?)'),
+    ({"author": "George Orwell", "sort": "-year"}, 'SEARCH books USING INDEX idx_books_author (author=?)'),
+    ({"author": "George Orwell", "title_prefix": "A"}, 'SEARCH books USING INDEX idx_books_author (author=?)'),
+    ({"year_min": "1900", "sort": "title"}, 'SEARCH books USING INDEX idx_books_year (year>?)'),
+    ({"title_prefix": "The", "sort": "-id", "after": "10"},
+     'SEARCH books USING INDEX idx_books_title (title>? AND title<?)'),
+])
+def test_listing_uses_the_expected_index(conn, args, plan):
+    assert queries.Listing.from_args(args).explain(conn)[0] == plan
+
+
+@pytest.mark.parametrize('name', ['year_min', 'year_max'])
+def test_out_of_range_year_filter_is_rejected(client, name):
+    response = client.get(f'/books?{name}=99999999999999999999999')
+    assert response.status_code == 400
+    assert name in response.json["error"]
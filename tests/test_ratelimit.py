@@ -0,0 +1,18 @@
+import ratelimit
+
+
+def test_default_backend_is_in_process():
+    assert isinstance(ratelimit.create_backend(), ratelimit.LocalBackend)
+
+
+def test_forwarded_address_is_the_one_the_proxy_added(books_app, monkeypatch):
+    monkeypatch.setattr(ratelimit, 'RATE_LIMIT_CLIENT_HEADER', 'X-Forwarded-For')
+    with books_app.test_request_context(headers={'X-Forwarded-For': 'forged, 203.0.113.7'}):
+        assert ratelimit.client_id() == '203.0.113.7'
+
+
+def test_forwarded_header_is_ignored_unless_configured(books_app, monkeypatch):
+    monkeypatch.setattr(ratelimit, 'RATE_LIMIT_CLIENT_HEADER', None)
+    with books_app.test_request_context(headers={'X-Forwarded-For': '203.0.113.7'},
+                                        environ_base={'REMOTE_ADDR': '198.51.100.1'}):
+        assert ratelimit.client_id() == '198.51.100.1'
@@ -0,0 +1,12 @@
+import replication
+
+
+def test_redirects_use_the_public_url_of_the_primary(tmp_path):
+    replica = replication.Replica(str(tmp_path / 'books.db'), {}, 'http://api-basic:5000', None,
+                                  public_url='http://localhost:5000')
+    assert replica.primary_url('/books', 'limit=1') == 'http://localhost:5000/books?limit=1'
+
+
+def test_redirects_default_to_the_pulled_url(tmp_path):
+    replica = replication.Replica(str(tmp_path / 'books.db'), {}, 'http://primary:5000', None)
+    assert replica.primary_url('/books/1') == 'http://primary:5000/books/1'